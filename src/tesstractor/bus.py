@@ -0,0 +1,158 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""In-process publish/subscribe bus for the payloads of the readers
+
+The published payloads are appended to a shared log. Each subscription
+has a cursor in the log and takes all the new payloads at once when it
+wakes up, filtered by kind ('cmd') and device name. The payloads are
+delivered by reference, so the subscribers must not modify them.
+"""
+
+import logging
+import threading
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A cursor in the log of a Bus
+
+    kinds is a collection of 'cmd' values, device is a device name;
+    None accepts everything
+    """
+
+    def __init__(self, bus, kinds=None, device=None):
+        self.bus = bus
+        self.kinds = None if kinds is None else frozenset(kinds)
+        self.device = device
+        self.cursor = 0
+        self.closed = False
+        self._injected = []
+
+    def matches(self, payload) -> bool:
+        if self.kinds is not None and payload["cmd"] not in self.kinds:
+            return False
+        if self.device is not None and payload["name"] != self.device:
+            return False
+        return True
+
+    def inject(self, payloads):
+        """Deliver payloads to this subscription only, before the log"""
+        with self.bus._cond:
+            self._injected.extend(p for p in payloads if self.matches(p))
+            self.bus._cond.notify_all()
+
+    def get_batch(self, timeout=None):
+        """Wait for new payloads, return a list of them.
+
+        The list is empty if the timeout expires, and None when
+        the subscription or the bus has been closed
+        """
+        bus = self.bus
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with bus._cond:
+            while True:
+                if self.closed:
+                    return None
+                batch = self._injected
+                self._injected = []
+                if self.cursor < bus._end:
+                    records = bus._log[self.cursor - bus._base :]
+                    self.cursor = bus._end
+                    bus._trim()
+                    batch.extend(p for p in records if self.matches(p))
+                if batch:
+                    return batch
+                if bus.closed:
+                    return None
+                if deadline is None:
+                    bus._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return []
+                    bus._cond.wait(remaining)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class Bus:
+    """Publish payloads to a set of subscriptions.
+
+    put has the interface of queue.Queue, so the bus can be used as
+    the output of the readers
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._log = []
+        # Position of _log[0] in the log
+        self._base = 0
+        self._subs = []
+        self.closed = False
+
+    @property
+    def _end(self):
+        return self._base + len(self._log)
+
+    def _trim(self):
+        """Drop the payloads already read by all the subscriptions"""
+        if not self._subs:
+            self._base = self._end
+            self._log = []
+            return
+        low = min(sub.cursor for sub in self._subs)
+        if low > self._base:
+            del self._log[: low - self._base]
+            self._base = low
+
+    def subscribe(self, kinds=None, device=None) -> Subscription:
+        """Subscribe to the payloads published from now on"""
+        sub = Subscription(self, kinds, device)
+        with self._cond:
+            sub.cursor = self._end
+            self._subs.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._cond:
+            sub.closed = True
+            if sub in self._subs:
+                self._subs.remove(sub)
+                self._trim()
+            self._cond.notify_all()
+
+    def publish(self, payload):
+        with self._cond:
+            if self._subs:
+                self._log.append(payload)
+                self._cond.notify_all()
+
+    def publish_many(self, payloads):
+        with self._cond:
+            if self._subs:
+                self._log.extend(payloads)
+                self._cond.notify_all()
+
+    put = publish
+
+    def close(self):
+        """The subscriptions end after reading the pending payloads"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        """Number of subscriptions"""
+        with self._cond:
+            return len(self._subs)
@@ -0,0 +1,219 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Capture of the raw lines read from the photometers
+
+Every line is stored with its receive time in a daily capture
+file per device, {name}_{YYYYMMDD}.cap (UTC date).
+The file is a sequence of independent gzip members (blocks),
+so it can be read with any gzip tool. A sidecar index file,
+{name}_{YYYYMMDD}.cap.idx, records the offset, size and time
+range of each block, so a time range can be read without
+decompressing the whole file.
+"""
+
+import datetime
+import glob
+import gzip
+import logging
+import os.path
+import queue
+import struct
+import threading
+import time
+
+from tesstractor.timeutil import datetime_to_ns, mono_to_ns, ns_to_datetime
+
+
+_logger = logging.getLogger(__name__)
+
+# receive time (ns since epoch), length of the line
+_RECORD = struct.Struct("<qI")
+# offset, size, first time, last time, number of records
+_INDEX = struct.Struct("<QIqqI")
+
+_DAY_NS = 86400 * 10**9
+
+
+def capture_filename(name, day):
+    return "{name}_{day:%Y%m%d}.cap".format(name=name, day=day)
+
+
+class CaptureLog:
+    """Append raw lines to compressed capture files in a background thread"""
+
+    def __init__(self, dirname, name, block_records=256, flush_interval=60.0):
+        self.dirname = dirname
+        self.name = name
+        self.block_records = block_records
+        self.flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def record(self, msg, tstamp_ns=None):
+        """Queue a raw line, this call never blocks"""
+        if tstamp_ns is None:
+            tstamp_ns = time.time_ns()
+        self._queue.put((tstamp_ns, msg))
+
+    def start(self):
+        os.makedirs(self.dirname, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self._run, name=f"capture_{self.name}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Write pending lines and end the thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        _logger.debug("starting capture thread for %s", self.name)
+        buffer = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                self._flush(buffer)
+                _logger.debug("end capture thread for %s", self.name)
+                break
+
+            if item:
+                buffer.append(item)
+
+            if len(buffer) >= self.block_records or time.monotonic() >= deadline:
+                self._flush(buffer)
+                buffer = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _flush(self, buffer):
+        """Write one block per day file"""
+        start = 0
+        while start < len(buffer):
+            day = buffer[start][0] // _DAY_NS
+            end = start
+            while end < len(buffer) and buffer[end][0] // _DAY_NS == day:
+                end += 1
+            self._write_block(day, buffer[start:end])
+            start = end
+
+    def _write_block(self, day, records):
+        chunks = []
+        for tstamp_ns, msg in records:
+            chunks.append(_RECORD.pack(tstamp_ns, len(msg)))
+            chunks.append(msg)
+        block = gzip.compress(b"".join(chunks), mtime=0)
+
+        fname = capture_filename(self.name, ns_to_datetime(day * _DAY_NS))
+        path = os.path.join(self.dirname, fname)
+        try:
+            with open(path, "ab") as fd:
+                offset = fd.tell()
+                fd.write(block)
+            entry = _INDEX.pack(
+                offset, len(block), records[0][0], records[-1][0], len(records)
+            )
+            with open(path + ".idx", "ab") as fd:
+                fd.write(entry)
+        except OSError:
+            _logger.exception("writing capture block to %s", path)
+
+
+class CaptureTee:
+    """Wrap a connection and capture the lines returned by readline
+
+    The lines are stamped with their arrival, if the connection records it
+    """
+
+    def __init__(self, conn, capture: CaptureLog):
+        self.conn = conn
+        self.capture = capture
+
+    def readline(self, *args, **kwargs):
+        msg = self.conn.readline(*args, **kwargs)
+        if msg:
+            rx_mono = getattr(self.conn, "rx_mono_ns", None)
+            if rx_mono is None:
+                self.capture.record(msg)
+            else:
+                self.capture.record(msg, mono_to_ns(rx_mono))
+        return msg
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def read_index(path):
+    """Read the block index of a capture file"""
+    entries = []
+    with open(path + ".idx", "rb") as fd:
+        data = fd.read()
+    # A partially written entry is ignored
+    nentries = len(data) // _INDEX.size
+    for i in range(nentries):
+        entries.append(_INDEX.unpack_from(data, i * _INDEX.size))
+    return entries
+
+
+def read_capture(path, start_ns=None, end_ns=None):
+    """Iterate over (time, line) in a capture file.
+
+    Only the blocks overlapping [start_ns, end_ns) are read
+    """
+    with open(path, "rb") as fd:
+        for offset, size, first, last, count in read_index(path):
+            if start_ns is not None and last < start_ns:
+                continue
+            if end_ns is not None and first >= end_ns:
+                continue
+            fd.seek(offset)
+            data = gzip.decompress(fd.read(size))
+            pos = 0
+            for _ in range(count):
+                tstamp_ns, length = _RECORD.unpack_from(data, pos)
+                pos += _RECORD.size
+                msg = data[pos : pos + length]
+                pos += length
+                if start_ns is not None and tstamp_ns < start_ns:
+                    continue
+                if end_ns is not None and tstamp_ns >= end_ns:
+                    continue
+                yield tstamp_ns, msg
+
+
+def capture_files(dirname, name):
+    """Return the sorted list of (date, path) of the capture files of a device"""
+    files = []
+    pattern = os.path.join(dirname, f"{glob.escape(name)}_????????.cap")
+    for path in glob.glob(pattern):
+        base = os.path.basename(path)
+        day = datetime.datetime.strptime(base[-12:-4], "%Y%m%d").date()
+        files.append((day, path))
+    files.sort()
+    return files
+
+
+def iter_capture(dirname, name, start=None, end=None):
+    """Iterate over (time, line) captured for a device between two UTC datetimes"""
+    start_ns = None if start is None else datetime_to_ns(start)
+    end_ns = None if end is None else datetime_to_ns(end)
+    for day, path in capture_files(dirname, name):
+        if start is not None and day < start.date():
+            continue
+        if end is not None and day > end.date():
+            continue
+        yield from read_capture(path, start_ns, end_ns)
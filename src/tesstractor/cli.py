@@ -7,30 +7,43 @@
 # License-Filename: LICENSE.txt
 #
 
+import itertools
+import os.path
 import threading
 import queue
+import multiprocessing
 import signal
 import logging
 import argparse
 import configparser
 import sys
+import time
 from typing import List
 
 import serial
 import attr
 import pytz
 
-from tesstractor.sqm import SQMTest, SQMLU
+from tesstractor.sqm import SQMTest, SQMLE, SQMLU
+from tesstractor.replay import ReplayDevice, expand_paths
+from tesstractor.capture import CaptureLog, CaptureTee
 
 # from tesstractor.tess import Tess
-from tesstractor.device import Device
+from tesstractor.bus import Bus, Subscription
+from tesstractor.device import CircuitBreaker, Device
+import tesstractor.discovery as discovery
+import tesstractor.httpapi as httpapi
 import tesstractor.mqtt as mqtt
+import tesstractor.profiling
 import tesstractor.writef
+from tesstractor.writef import COMPRESSION_SUFFIX
+from tesstractor.tiers import TierAggregator, parse_tiers
+from tesstractor.transport import SerialTransport, TCPTransport
 import tesstractor.tess
+from tesstractor.multiproc import DeviceProcess
 from tesstractor.workers import (
-    splitter,
-    simple_buffer,
-    periodic_avg_task,
+    Aggregator,
+    periodic_avg,
     read_photometer_timed,
 )
 
@@ -97,53 +110,154 @@ def build_location_from_ini(conf) -> LocationConf:
     return loc
 
 
+TESS_MODELS = ["TESS-R", "TESS", "TESS-U", "TESSv2"]
+
+
+def device_name_from_ini(section):
+    """Name of a connected device, before its handshake"""
+    name = section.get("name")
+    if name is None and section.get("model") in TESS_MODELS:
+        name = "TESS-test"
+    return name
+
+
+def capture_name_from_ini(section):
+    """Name of the capture files of a device"""
+    return device_name_from_ini(section) or section.name
+
+
+def build_capture_from_ini(section):
+    """Create a CaptureLog if raw capture is enabled"""
+    dirname = section.get("capture_dir")
+    if not dirname:
+        return None
+    capture = CaptureLog(
+        dirname,
+        capture_name_from_ini(section),
+        block_records=section.getint("capture_block", 256),
+        flush_interval=section.getfloat("capture_flush", 60.0),
+    )
+    capture.start()
+    return capture
+
+
+def build_breaker_from_ini(section) -> CircuitBreaker:
+    """Error budget of a device connection"""
+    return CircuitBreaker(
+        budget=section.getint("error_budget", 10),
+        window=section.getfloat("error_window", 60.0),
+        backoff=section.getfloat("reset_backoff", 1.0),
+        max_backoff=section.getfloat("max_backoff", 300.0),
+    )
+
+
 def build_dev_from_ini(section) -> Device:
     """Create a Device from the configuration"""
+    photo_dev = _build_dev_from_ini(section)
+    photo_dev.breaker = build_breaker_from_ini(section)
+    return photo_dev
+
+
+def _build_dev_from_ini(section) -> Device:
     logger = logging.getLogger(__name__)
 
     model = section.get("model", "SQM-TEST")
     logger.debug("model is %s", model)
     if model == "SQM-TEST":
         return SQMTest()
+    elif model == "REPLAY":
+        name = section.get("name", "replay")
+        path = section.get("path")
+        if path is None:
+            raise ValueError("REPLAY model requires a 'path'")
+        paths = expand_paths(path)
+        if not paths:
+            logger.warning("no files to replay in %s", path)
+        speed = section.getfloat("speed", 1.0)
+        retime = section.getboolean("retime", False)
+        photo_dev = ReplayDevice(paths, name, speed=speed, retime=retime)
+        mac = section.get("mac")
+        if mac:
+            photo_dev.mac = mac
+        return photo_dev
     elif model == "SQM-LU":
         name = section.get("name")
         port = section.get("port", "/dev/ttyUSB0")
         baudrate = section.getint("baudrate", 115200)
         timeout = section.getfloat("timeout", 2.0)
-        conn = serial.Serial(port, baudrate, timeout=timeout)
+        conn = SerialTransport(serial.Serial(port, baudrate, timeout=timeout))
+        capture = build_capture_from_ini(section)
+        if capture:
+            conn = CaptureTee(conn, capture)
         photo_dev = SQMLU(conn, name)
+        # Wait between a command and its answer. With 0, readline waits
+        # for the answer and the time stamp is its arrival, but the
+        # timeout must be longer than the answer time of the photometer
+        photo_dev.cmd_wait = section.getfloat("cmd_wait", 1.0)
+        photo_dev.capture = capture
         mac = section.get("mac")
         if mac:
             photo_dev.mac = mac
         return photo_dev
-    elif model in ["TESS-R", "TESS", "TESS-U"]:
+    elif model == "SQM-LE":
         name = section.get("name")
+        host = section.get("host")
+        if host is None:
+            raise ValueError("SQM-LE model requires a 'host'")
+        conn = TCPTransport(
+            host,
+            section.getint("port", 10001),
+            timeout=section.getfloat("timeout", 2.0),
+            backoff=section.getfloat("reconnect_backoff", 1.0),
+            max_backoff=section.getfloat("max_reconnect_backoff", 60.0),
+        )
+        capture = build_capture_from_ini(section)
+        if capture:
+            conn = CaptureTee(conn, capture)
+        photo_dev = SQMLE(conn, name)
+        photo_dev.cmd_wait = section.getfloat("cmd_wait", 0.0)
+        photo_dev.capture = capture
+        mac = section.get("mac")
+        if mac:
+            photo_dev.mac = mac
+        return photo_dev
+    elif model in ["TESS-R", "TESS", "TESS-U"]:
+        name = device_name_from_ini(section)
         port = section.get("port", "/dev/ttyUSB0")
         baudrate = section.getint("baudrate", 9600)
         timeout = section.getfloat("timeout", 1.0)
-        conn = serial.Serial(port, baudrate, timeout=timeout)
-        if name is None:
+        conn = SerialTransport(serial.Serial(port, baudrate, timeout=timeout))
+        if section.get("name") is None:
             logger.warning("name is none, this should be automatic")
-            name = "TESS-test"
+
+        capture = build_capture_from_ini(section)
+        if capture:
+            conn = CaptureTee(conn, capture)
 
         photo_dev = tesstractor.tess.TessR(conn, name)
+        photo_dev.capture = capture
         zero_point = section.getfloat("zero_point", 20.0)
         photo_dev.calibration = zero_point
         mac = section.get("mac")
         if mac:
             photo_dev.mac = mac
 
+        return photo_dev
     elif model in ["TESSv2"]:
-        name = section.get("name")
+        name = device_name_from_ini(section)
         port = section.get("port", "/dev/ttyUSB0")
         baudrate = section.getint("baudrate", 9600)
         timeout = section.getfloat("timeout", 1.0)
-        conn = serial.Serial(port, baudrate, timeout=timeout)
-        if name is None:
+        conn = SerialTransport(serial.Serial(port, baudrate, timeout=timeout))
+        if section.get("name") is None:
             logger.warning("name is none, this should be automatic")
-            name = "TESS-test"
+
+        capture = build_capture_from_ini(section)
+        if capture:
+            conn = CaptureTee(conn, capture)
 
         photo_dev = tesstractor.tess.TessV2(conn, name)
+        photo_dev.capture = capture
         zero_point = section.getfloat("zero_point", 20.0)
         photo_dev.calibration = zero_point
         mac = section.get("mac")
@@ -158,106 +272,633 @@ def build_dev_from_ini(section) -> Device:
 def readerconf_from_ini(section):
     readerconf = dict()
     readerconf["nsamples"] = section.getint("nsamples", 0)
-    readerconf["tsample"] = section.getfloat("tsample", 1.0)
+    # A replay is paced by the device itself
+    if section.get("model") == "REPLAY":
+        tsample_default = 0.0
+    else:
+        tsample_default = 1.0
+    readerconf["tsample"] = section.getfloat("tsample", tsample_default)
+    readerconf["status_interval"] = section.getfloat("status_interval", 60.0)
     return readerconf
 
 
-def create_mqtt_workers(q_worker: queue.Queue, mqtt_config) -> List[threading.Thread]:
-    """Create MQTT workers"""
-    otherx = OtherConf()
-    # otherx.send_event = send_event
+def aggregator_from_ini(section) -> Aggregator:
+    """Estimators of a sink"""
+    percentiles = section.get("percentiles", "")
+    return Aggregator(
+        estimator=section.get("estimator", "median"),
+        sigma=section.getfloat("sigma", 3.0),
+        trim=section.getfloat("trim", 0.1),
+        mad=section.getboolean("mad", False),
+        percentiles=[float(val) for val in percentiles.split(",") if val.strip()],
+    )
 
-    q_mqtt_in = queue.Queue()  # Queue for MQTT
-    q_buffer = queue.Queue()  # Queue for MQTT buffer
 
-    filter_thread = threading.Thread(
-        target=simple_buffer,
-        name="simple_filter_mqtt",
-        args=(q_worker, q_mqtt_in, q_buffer, otherx),
-    )
+def create_mqtt_workers(
+    sub: Subscription, mqtt_config, device
+) -> List[threading.Thread]:
+    """Create MQTT workers, sub has the payloads of one device"""
+    q_mqtt_in = queue.Queue()  # Queue for MQTT
 
     interval = mqtt_config.getfloat("interval", 60.0)
     other_mqtt = mqtt.MqttConsumer(mqtt_config)
     consumer_mqtt = threading.Thread(
-        target=mqtt.consumer_mqtt, name="mqtt_consumer", args=(q_mqtt_in, other_mqtt)
+        target=mqtt.consumer_mqtt,
+        name=f"mqtt_consumer_{device}",
+        args=(q_mqtt_in, other_mqtt),
     )
 
-    send_event = None
-    timed_buffer = threading.Timer(
-        interval, periodic_avg_task, args=(q_buffer, q_mqtt_in, send_event)
+    other_avg = OtherConf()
+    other_avg.aggregator = aggregator_from_ini(mqtt_config)
+    avg_thread = threading.Thread(
+        target=periodic_avg,
+        name=f"periodic_avg_mqtt_{device}",
+        args=(sub, q_mqtt_in, interval, other_avg),
     )
-    timed_buffer.name = "timed_buffer_mqtt"
 
-    filter_thread.start()
-    timed_buffer.start()
+    avg_thread.start()
     consumer_mqtt.start()
 
-    return [filter_thread, consumer_mqtt]
+    return [avg_thread, consumer_mqtt]
+
+
+def create_http_workers(sub: Subscription, http_config) -> List[threading.Thread]:
+    """Create the HTTP API worker, it keeps the payloads of all the devices"""
+    consumer = threading.Thread(
+        target=httpapi.consumer_http,
+        name=f"http_consumer_{http_config.name}",
+        args=(sub, http_config),
+    )
+    consumer.start()
+    return [consumer]
 
 
 def create_file_writer_workers(
-    q_worker: queue.Queue, file_config: OtherConf
+    sub: Subscription, file_config: OtherConf
 ) -> List[threading.Thread]:
-
-    otherx = OtherConf()
+    """Create file writer workers, sub has the payloads of one device"""
+    device = getattr(file_config, "device", None)
     q_file_in = queue.Queue()  # Queue for file writer
-    q_buffer = queue.Queue()  # Queue for file writer buffer
-    send_event = None
-
-    # This thread splits messages
-    # cmd="ID" are sent directly to writer (q_file_in)
-    # cmd="R" are sent to a buffer (q_buffer)
-    filter_thread = threading.Thread(
-        target=simple_buffer,
-        name="simple_filter_file",
-        args=(q_worker, q_file_in, q_buffer, otherx),
-    )
-
-    # This Timer thread wakes up periodically and averages values in (q_buffer)
-    # After that, the average is sent to writer queue (q_file_in)
-    interval = file_config.interval
-    timed_buffer = threading.Timer(
-        interval, periodic_avg_task, args=(q_buffer, q_file_in, send_event)
+    other_avg = OtherConf()
+    other_avg.aggregator = getattr(file_config, "aggregator", None)
+    tiers = getattr(file_config, "tiers", ())
+    if tiers:
+        # The tiers are narrower than the interval, they get the readings
+        other_avg.tier_agg = TierAggregator(
+            os.path.join(file_config.dirname, "tiers"),
+            file_config.devconf.name,
+            tiers,
+        )
+
+    # This thread sends cmd="id" directly to the writer (q_file_in)
+    # and the periodic average of cmd="r"
+    avg_thread = threading.Thread(
+        target=periodic_avg,
+        name=f"periodic_avg_file_{device}",
+        args=(sub, q_file_in, file_config.interval, other_avg),
     )
-    timed_buffer.name = "timed_buffer_file"
 
     # This thread writes the values in writer queue (q_file_in)
     consumer_file = threading.Thread(
         target=tesstractor.writef.consumer_write_file,
-        name="consumer_write_file",
+        name=f"consumer_write_file_{device}",
         args=(q_file_in, file_config),
     )
 
     consumer_file.start()
-    filter_thread.start()
-    timed_buffer.start()
+    avg_thread.start()
+
+    return [avg_thread, consumer_file]
+
+
+def file_config_from_ini(sec, devname, devconf, loc_conf) -> OtherConf:
+    """Configuration of the file writer of a device"""
+    file_config = OtherConf()
+    file_config.dirname = sec.get("dirname", "/var/lib/pysqm")
+    file_config.format = sec.get("format")
+    compression = sec.get("compression", "none")
+    if compression == "none":
+        compression = None
+    if compression not in COMPRESSION_SUFFIX:
+        raise ValueError("unknown compression {}".format(compression))
+    file_config.compression = compression
+    file_config.flush_lines = sec.getint("flush_lines", 32)
+    file_config.flush_interval = sec.getfloat("flush_interval", 600.0)
+    # Open files of all the devices
+    file_config.max_open = sec.getint("max_open", 64)
+    file_config.tiers = parse_tiers(sec.get("tiers"))
+    file_config.summary = sec.getboolean("summary", False)
+    file_config.journal = sec.getboolean("journal", False)
+    file_config.journal_lines = sec.getint("journal_lines", 16)
+    file_config.journal_interval = sec.getfloat("journal_interval", 30.0)
+    file_config.interval = sec.getfloat("interval", 300.0)
+    file_config.aggregator = aggregator_from_ini(sec)
+    file_config.device = devname
+    file_config.devconf = devconf
+    file_config.location = loc_conf
+    return file_config
+
+
+def read_config(pargs) -> configparser.ConfigParser:
+    """Read the configuration file and apply the CLI overrides"""
+    cparser = configparser.ConfigParser(defaults={"dirname": "/var/lib/tesstractor"})
 
-    return [filter_thread, consumer_file]
+    cparser.read_dict(ini_defaults)
+    if pargs.config:
+        cparser.read(pargs.config)
 
+    ini_overrides = {}
+    if pargs.dirname is not None:
+        ini_overrides["file"] = {}
+        ini_overrides["file"]["dirname"] = pargs.dirname
 
-def main(args=None):
-    # Register events and signal
-    exit_event = threading.Event()
-    error_event = threading.Event()
-    send_event = threading.Event()
+    cparser.read_dict(ini_overrides)
+    return cparser
 
-    exit_code = 0
 
-    send_event.clear()
+def profile_dir_from_config(pargs, cparser) -> str:
+    """Directory of the profile dumps, default is {dirname}/profile"""
+    if pargs.profile_dir:
+        return pargs.profile_dir
+    if pargs.dirname is not None:
+        dirname = pargs.dirname
+    elif cparser.has_section("file"):
+        dirname = cparser["file"].get("dirname")
+    else:
+        dirname = None
+    if not dirname:
+        dirname = cparser.defaults().get("dirname", "/var/lib/tesstractor")
+    return os.path.join(dirname, "profile")
 
-    def signal_handler(signum, frame):
-        return signal_handler_function(signum, frame, exit_event)
 
-    # On SIGTERM, set exit_event
-    signal.signal(signal.SIGTERM, signal_handler)
-    # On SIGINT, set exit_event
-    signal.signal(signal.SIGINT, signal_handler)
+def resolve_auto_ports(sections, in_use=()):
+    """Find the port of the sections with 'port: auto'.
+
+    Returns a dict with a copy of each of these sections, with the port,
+    baudrate and model of the device found, or None if it is not found
+    """
+    logger = logging.getLogger(__name__)
+    auto = {
+        secname: section
+        for secname, section in sections.items()
+        if section.get("port") == "auto"
+    }
+    if not auto:
+        return {}
+
+    explicit = {
+        section.get("port")
+        for section in sections.values()
+        if section.get("port") not in [None, "auto"]
+    }
+    ports = [
+        port
+        for port in discovery.list_ports()
+        if port not in explicit and port not in in_use
+    ]
+    timeout = max(section.getfloat("probe_timeout", 3.0) for section in auto.values())
+    results = discovery.discover(ports, timeout=timeout)
+
+    resolved = {}
+    for secname, section in auto.items():
+        found = discovery.match_section(section, results)
+        if found is None:
+            logger.error("device of section %s not found", secname)
+            resolved[secname] = None
+            continue
+        logger.info("section %s is %s in %s", secname, found.model, found.port)
+        secdict = dict(section.items())
+        secdict["port"] = found.port
+        secdict["baudrate"] = str(found.baudrate)
+        if secdict.get("model", "auto") == "auto":
+            secdict["model"] = found.model
+        if found.mac and "mac" not in secdict:
+            secdict["mac"] = found.mac
+        cparser = configparser.ConfigParser()
+        cparser.read_dict({secname: secdict})
+        resolved[secname] = cparser[secname]
+    return resolved
+
+
+# Options of a photometer section that only affect the reader thread,
+# the connection is kept if only these change
+READER_KEYS = ["nsamples", "tsample", "status_interval"]
+
+
+class _IdTap:
+    """Output of the readers, keeps the last 'id' payload of each device"""
+
+    def __init__(self, output_q: Bus):
+        self.output_q = output_q
+        self.id_payloads = {}
+
+    def put(self, payload):
+        if payload is not None and payload["cmd"] == "id":
+            self.id_payloads[payload["name"]] = payload
+        self.output_q.put(payload)
+
+
+class DeviceHandle:
+    """A device and its reader, in a thread or in a process"""
+
+    def __init__(self, section, readerconf, processes=False):
+        self.secname = section.name
+        self.secdict = dict(section.items())
+        self.readerconf = readerconf
+        self.processes = processes
+        self.name = None
+        self.devconf = None
+        self.photo_dev = None
+        self.devproc = None
+        self.thread = None
+        self.stop_event = None
+        self.stopping = False
+        self.generation = 0
+        self.port = None
+        self.deadline = None
+
+    @staticmethod
+    def conn_key(secdict):
+        return {key: val for key, val in secdict.items() if key not in READER_KEYS}
+
+    def connect(self, section, timeout=None) -> bool:
+        """Open the connection with the device"""
+        logger = logging.getLogger(__name__)
+        if self.processes:
+            self.stop_event = multiprocessing.Event()
+            self.devproc = DeviceProcess(section, self.readerconf, self.stop_event)
+            self.devproc.start()
+            if not self.devproc.wait_ready(timeout):
+                if self.devproc.process.is_alive():
+                    # Still in the handshake
+                    self.devproc.process.terminate()
+                self.devproc.stop()
+                return False
+            self.name = self.devproc.name
+            self.devconf = self.devproc.static_conf
+        else:
+            try:
+                self.photo_dev = build_dev_from_ini(section)
+                self.photo_dev.start_connection()
+            except Exception:
+                logger.exception("starting device %s", section.name)
+                self.close()
+                return False
+            self.name = self.photo_dev.name
+            self.devconf = self.photo_dev.static_conf()
+        return True
+
+    def start_reader(self, output_q, error_event):
+        self.stopping = False
+        if self.processes:
+            self.thread = threading.Thread(
+                target=self.devproc.forward,
+                name=f"ring_reader_{self.name}",
+                args=(output_q, error_event),
+            )
+        else:
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(
+                target=read_photometer_timed,
+                name=f"photo_reader_{self.name}",
+                args=(
+                    self.photo_dev,
+                    output_q,
+                    self.readerconf,
+                    self.stop_event,
+                    error_event,
+                ),
+            )
+        self.thread.start()
+
+    def stop_reader(self):
+        self.stopping = True
+        if self.stop_event is not None:
+            self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def ended(self) -> bool:
+        """The reader has ended without being stopped"""
+        return (
+            self.thread is not None and not self.stopping and not self.thread.is_alive()
+        )
+
+    def close(self):
+        """Stop the reader and close the connection"""
+        self.stop_reader()
+        if self.photo_dev is not None:
+            if self.photo_dev.capture:
+                self.photo_dev.capture.stop()
+            close_connection = getattr(self.photo_dev, "close_connection", None)
+            if close_connection is not None:
+                try:
+                    close_connection()
+                except Exception:
+                    logging.getLogger(__name__).exception(
+                        "closing device %s", self.secname
+                    )
+            self.photo_dev = None
+
+
+class SinkHandle:
+    """The subscription and the threads of a MQTT, HTTP or file sink"""
+
+    def __init__(self, signature, sub, threads):
+        self.signature = signature
+        self.sub = sub
+        self.threads = threads
+
+
+class Station:
+    """Devices and sinks created from the configuration.
+
+    apply can be called again with a new configuration, only the
+    devices and sinks whose configuration has changed are restarted
+    """
+
+    def __init__(self, processes=False, error_event=None):
+        self.processes = processes
+        self.error_event = error_event or threading.Event()
+        self.bus = Bus()
+        self.reader_out = _IdTap(self.bus)
+        # section name -> DeviceHandle
+        self.devices = {}
+        # section name -> DeviceHandle, during the handshake
+        self.pending = {}
+        # (section name, device name) -> SinkHandle
+        self.sinks = {}
+        self._generation = itertools.count()
+        self._lock = threading.RLock()
+        self._cparser = None
+        self._loc_conf = None
+
+    def apply(self, cparser):
+        """Start, stop or restart devices and sinks to match cparser.
+
+        The sinks are started at once. The new devices are connected
+        in background threads, the file writers of a device are
+        started when its handshake ends
+        """
+        loc_conf = build_location_from_ini(cparser)
+        with self._lock:
+            self._cparser = cparser
+            self._loc_conf = loc_conf
+            new_sections = self._apply_devices(cparser, loc_conf)
+            self._apply_sinks(cparser, loc_conf)
+        self._connect_devices(new_sections, loc_conf)
+
+    def _apply_devices(self, cparser, loc_conf):
+        """Stop or restart the running devices, return the new sections"""
+        logger = logging.getLogger(__name__)
+        loc_tz = pytz.timezone(loc_conf.timezone)
+        wanted = {}
+        for secname in cparser.sections():
+            if not secname.startswith("photometer"):
+                continue
+            section = cparser[secname]
+            if section.getboolean("enabled", True):
+                wanted[secname] = section
+
+        for secname in list(self.pending):
+            handle = self.pending[secname]
+            section = wanted.get(secname)
+            if section is None or dict(section.items()) != handle.secdict:
+                # The handle is closed when its handshake ends
+                logger.info("abandoning connection of %s", secname)
+                del self.pending[secname]
+            else:
+                handle.readerconf = readerconf_from_ini(section)
+                handle.readerconf["tz"] = loc_tz
+
+        for secname in list(self.devices):
+            handle = self.devices[secname]
+            section = wanted.get(secname)
+            if section is None:
+                logger.info("removing device %s", handle.name)
+                handle.close()
+                del self.devices[secname]
+                continue
+            secdict = dict(section.items())
+            readerconf = readerconf_from_ini(section)
+            readerconf["tz"] = loc_tz
+            if secdict == handle.secdict and readerconf == handle.readerconf:
+                continue
+            same_conn = DeviceHandle.conn_key(secdict) == handle.conn_key(
+                handle.secdict
+            )
+            if same_conn and not self.processes:
+                logger.info("restarting reader of device %s", handle.name)
+                handle.stop_reader()
+                handle.secdict = secdict
+                handle.readerconf = readerconf
+                handle.start_reader(self.reader_out, self.error_event)
+            else:
+                logger.info("reconnecting device %s", handle.name)
+                handle.close()
+                del self.devices[secname]
+
+        return {
+            secname: section
+            for secname, section in wanted.items()
+            if secname not in self.devices and secname not in self.pending
+        }
+
+    def _connect_devices(self, new_sections, loc_conf):
+        """Start the handshake of each new device in its own thread"""
+        loc_tz = pytz.timezone(loc_conf.timezone)
+        with self._lock:
+            in_use = {handle.port for handle in self.devices.values()}
+            in_use.update(handle.port for handle in self.pending.values())
+        resolved = resolve_auto_ports(new_sections, in_use)
+
+        for secname, section in new_sections.items():
+            conn_section = resolved.get(secname, section)
+            if conn_section is None:
+                self.error_event.set()
+                continue
+            readerconf = readerconf_from_ini(section)
+            readerconf["tz"] = loc_tz
+            handle = DeviceHandle(section, readerconf, self.processes)
+            handle.generation = next(self._generation)
+            handle.port = conn_section.get("port")
+            timeout = section.getfloat("handshake_timeout", 60.0)
+            handle.deadline = time.monotonic() + timeout
+            with self._lock:
+                self.pending[secname] = handle
+            connect = threading.Thread(
+                target=self._connect_device,
+                name=f"connect_{secname}",
+                args=(secname, handle, conn_section, timeout),
+                daemon=True,
+            )
+            connect.start()
+
+    def _connect_device(self, secname, handle, section, timeout):
+        logger = logging.getLogger(__name__)
+        connected = handle.connect(section, timeout=timeout)
+        with self._lock:
+            if self.pending.get(secname) is not handle:
+                # Timed out, or removed from the configuration
+                if connected:
+                    logger.info("closing abandoned device %s", handle.name)
+                    handle.close()
+                return
+            if connected:
+                logger.info("device %s ready", handle.name)
+                self.devices[secname] = handle
+                # The file writers of the device are ready before the first payload
+                self._apply_sinks(self._cparser, self._loc_conf)
+                handle.start_reader(self.reader_out, self.error_event)
+            else:
+                self.error_event.set()
+            del self.pending[secname]
+
+    def check_pending(self):
+        """Abandon the devices whose handshake has not ended in time"""
+        logger = logging.getLogger(__name__)
+        now = time.monotonic()
+        with self._lock:
+            for secname, handle in list(self.pending.items()):
+                if now > handle.deadline:
+                    logger.error("handshake of %s has timed out", secname)
+                    del self.pending[secname]
+                    self.error_event.set()
+
+    def _sink_wanted(self, cparser, loc_conf):
+        """Signature of the configured sinks"""
+        wanted = {}
+        loc_key = attr.astuple(loc_conf)
+        for sec_name in cparser.sections():
+            if not sec_name.startswith("http"):
+                continue
+            sec = cparser[sec_name]
+            if sec.getboolean("enabled", True):
+                wanted[(sec_name, None)] = (sec, dict(sec.items()))
+
+        for sec_name in cparser.sections():
+            if not sec_name.startswith(("file", "mqtt")):
+                continue
+            sec = cparser[sec_name]
+            if not sec.getboolean("enabled", True):
+                continue
+            # One writer and one MQTT averaging chain per device
+            for handle in self.devices.values():
+                # The device may have been reconnected with a new configuration
+                signature = (dict(sec.items()), loc_key, handle.generation)
+                wanted[(sec_name, handle.name)] = (sec, signature)
+        return wanted
+
+    def _apply_sinks(self, cparser, loc_conf):
+        logger = logging.getLogger(__name__)
+        wanted = self._sink_wanted(cparser, loc_conf)
+
+        for key in list(self.sinks):
+            sink = self.sinks[key]
+            if key in wanted and wanted[key][1] == sink.signature:
+                continue
+            logger.info("stopping sink %s", key)
+            self._stop_sink(sink)
+            del self.sinks[key]
+
+        devconfs = {handle.name: handle.devconf for handle in self.devices.values()}
+        for key, (sec, signature) in wanted.items():
+            if key in self.sinks:
+                continue
+            sec_name, devname = key
+            logger.info("starting sink %s", key)
+            # A file writer or a MQTT chain only sees the payloads of its device
+            kinds = ["id", "r"]
+            if sec_name.startswith("http"):
+                # The HTTP API serves the latency statistics too
+                kinds.append("status")
+            sub = self.bus.subscribe(kinds=kinds, device=devname)
+            # The sink has not seen the registration of the running devices
+            sub.inject(
+                self.reader_out.id_payloads[handle.name]
+                for handle in self.devices.values()
+                if handle.name in self.reader_out.id_payloads
+            )
+            if sec_name.startswith("http"):
+                ts = create_http_workers(sub, sec)
+            elif sec_name.startswith("mqtt"):
+                ts = create_mqtt_workers(sub, sec, devname)
+            else:
+                file_config = file_config_from_ini(
+                    sec, devname, devconfs[devname], loc_conf
+                )
+                ts = create_file_writer_workers(sub, file_config)
+            self.sinks[key] = SinkHandle(signature, sub, ts)
+
+    def _stop_sink(self, sink: SinkHandle):
+        sink.sub.close()
+        for t in sink.threads:
+            t.join()
+
+    def ended(self) -> bool:
+        """A reader has ended by itself, or no device could be started"""
+        with self._lock:
+            if not self.devices and not self.pending:
+                return True
+            return any(handle.ended() for handle in self.devices.values())
+
+    def stop(self):
+        """Stop the readers, and then the sinks"""
+        with self._lock:
+            # Pending devices are closed when their handshake ends
+            self.pending = {}
+        for handle in self.devices.values():
+            handle.stop_reader()
+        # All the readers have ended, signal consumers to end
+        self.bus.close()
+        for sink in self.sinks.values():
+            for t in sink.threads:
+                t.join()
+        for handle in self.devices.values():
+            handle.close()
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] == "collect":
+        import tesstractor.collect as collect
+
+        return collect.main(args[1:])
 
     # Parse CLI
     parser = argparse.ArgumentParser()
     parser.add_argument("--dirname")
     parser.add_argument("-c", "--config")
     parser.add_argument("-g", "--generate-config", action="store_true")
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="run each photometer reader in its own process",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=tesstractor.profiling.MODES,
+        help="profile the threads, dumped on SIGUSR1 and at exit",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        type=int,
+        default=0,
+        metavar="FRAMES",
+        help="trace memory allocations, keeping FRAMES frames",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="dump the profile every SECONDS too",
+    )
+    parser.add_argument(
+        "--profile-dir", help="directory of the dumps, default is {dirname}/profile"
+    )
     parser.add_argument(
         "--log",
         default="INFO",
@@ -266,6 +907,26 @@ def main(args=None):
 
     pargs = parser.parse_args(args=args)
 
+    # Register events and signal
+    exit_event = threading.Event()
+    reload_event = threading.Event()
+    error_event = threading.Event()
+
+    exit_code = 0
+
+    def signal_handler(signum, frame):
+        return signal_handler_function(signum, frame, exit_event)
+
+    # On SIGTERM, set exit_event
+    signal.signal(signal.SIGTERM, signal_handler)
+    # On SIGINT, set exit_event
+    signal.signal(signal.SIGINT, signal_handler)
+    # On SIGHUP, reload the configuration
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_event.set())
+    # On SIGUSR1, dump the profile
+    dump_event = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump_event.set())
+
     loglevel = getattr(logging, pargs.log.upper())
 
     logging.basicConfig(level=loglevel)
@@ -280,126 +941,45 @@ def main(args=None):
         print(data.decode("utf-8"))
         return 0
 
-    cparser = configparser.ConfigParser(defaults={"dirname": "/var/lib/tesstractor"})
-
-    cparser.read_dict(ini_defaults)
-    if pargs.config:
-        cparser.read(pargs.config)
-
-    ini_overrides = {}
-    if pargs.dirname is not None:
-        ini_overrides["file"] = {}
-        ini_overrides["file"]["dirname"] = pargs.dirname
-
-    cparser.read_dict(ini_overrides)
-
-    loc_conf = build_location_from_ini(cparser)
-    loc_tz = pytz.timezone(loc_conf.timezone)
-    photo_sections = [sec for sec in cparser.sections() if sec.startswith("photometer")]
+    cparser = read_config(pargs)
 
-    photolist = []
-    readerlist = []
-    for secname in photo_sections:
-        section = cparser[secname]
-        if section.getboolean("enabled", True):
-            newdev = build_dev_from_ini(section)
-            newread = readerconf_from_ini(section)
-            newread["tz"] = loc_tz
-            photolist.append(newdev)
-            readerlist.append(newread)
+    # Start before the threads, to profile them
+    profiler = tesstractor.profiling.Profiler(
+        profile_dir_from_config(pargs, cparser),
+        mode=pargs.profile,
+        tracemalloc_frames=pargs.profile_memory,
+        period=pargs.profile_interval,
+    )
+    profiler.start()
 
-    nsqm = len(photolist)
+    station = Station(processes=pargs.processes, error_event=error_event)
+    station.apply(cparser)
 
-    if nsqm == 0:
+    if not station.devices and not station.pending:
         logger.warning("No devices enabled. Exit")
+        station.stop()
+        profiler.stop()
         sys.exit(1)
 
-    # photoconf = []
-    # for photodev in photolist:
-    #    photodev.start_connection()
-    #    photoconf.append(photodev.static_conf())
-
-    # Using first device
-    photo_dev = photolist[0]
-    readerconf = readerlist[0]
-    photo_dev.start_connection()
-
-    # Working queues
-    working_qs = []
-    # joinable threads
-    joinable_threads = []
-
-    # Section for MQTT connections
-    mqtt_sections = [sec for sec in cparser.sections() if sec.startswith("mqtt")]
-    for sec_name in mqtt_sections:
-        logger.info("creating MQTT conection")
-        mqtt_config = cparser[sec_name]
-        if mqtt_config.getboolean("enabled", True):
-            q_w = queue.Queue()
-            ts = create_mqtt_workers(q_w, mqtt_config)
-            working_qs.append(q_w)
-            joinable_threads.extend(ts)
-        else:
-            logger.info("MQTT section %s disabled", sec_name)
-
-    # Section for files
-    file_sections = [sec for sec in cparser.sections() if sec.startswith("file")]
-    for sec_name in file_sections:
-        logger.info("Creating file output")
-        sec = cparser[sec_name]
-        if sec.getboolean("enabled", True):
-            file_config = OtherConf()
-            file_config.dirname = sec.get("dirname", "/var/lib/pysqm")
-            file_config.format = sec.get("format")
-            file_config.interval = sec.getfloat("interval", 300.0)
-            file_config.devconf = photo_dev.static_conf()
-            file_config.location = loc_conf
-
-            q_w = queue.Queue()
-            ts = create_file_writer_workers(q_w, file_config)
-            working_qs.append(q_w)
-            joinable_threads.extend(ts)
-        else:
-            logger.info("file section %s disabled", sec_name)
-
-    # reader queue
-    q_reader = queue.Queue()
-
-    # Send data to workers
-    # basically, write-to-file and mqtt
-    consd = threading.Thread(
-        name="splitter", target=splitter, args=(q_reader, working_qs)
-    )
-    consd.start()
-    joinable_threads.append(consd)
-
-    all_readers = []
-
-    # starting only one reader
-    # Preliminary configuration here
-    readerconf["tz"] = pytz.timezone(loc_conf.timezone)
-
-    # This thread ends in exit_event
-    reader = threading.Thread(
-        target=read_photometer_timed,
-        name=f"photo_reader_{photo_dev.name}",
-        args=(photo_dev, q_reader, readerconf, exit_event, error_event),
-    )
-    reader.start()
-    all_readers.append(reader)
-
-    for t in joinable_threads:
-        t.join()
-
-    for t in all_readers:
-        t.join()
-
-    # Ending main thread
-    # Timer threads must be "cancel()" instead
-    for t in threading.enumerate():
-        if isinstance(t, threading.Timer):
-            logger.debug("cancel timer {}".format(t.name))
-            t.cancel()
+    while not exit_event.wait(timeout=1.0):
+        if reload_event.is_set():
+            reload_event.clear()
+            logger.info("reloading configuration")
+            try:
+                station.apply(read_config(pargs))
+            except Exception:
+                logger.exception("reloading configuration, keeping the old one")
+        if dump_event.is_set() or profiler.due():
+            dump_event.clear()
+            profiler.dump()
+        station.check_pending()
+        if station.ended():
+            # A device has failed or has no more data
+            break
+
+    station.stop()
+    profiler.dump()
+    profiler.stop()
 
     if error_event.is_set():
         exit_code = 1
@@ -0,0 +1,285 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Archive the readings that many photometers publish over MQTT
+
+The collector subscribes to the register and publish topics of the
+first enabled mqtt section, with the device name in publish_topic replaced by a
+wildcard. The register messages give the static configuration of
+each device. The readings are written to nightly IDA files per
+device, in batches.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import os.path
+import queue
+import re
+import signal
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import pytz
+
+import tesstractor.cli as cli
+import tesstractor.writef as writef
+from tesstractor.tess import TESSConf
+from tesstractor.timeutil import datetime_to_ns, set_tstamp
+
+
+_logger = logging.getLogger(__name__)
+
+
+def topic_pattern(publish_topic):
+    """MQTT subscription and regex of the names for publish_topic"""
+    prefix, sep, suffix = publish_topic.partition("{name}")
+    if not sep:
+        raise ValueError("publish_topic must contain {name}")
+    regex = re.compile(
+        "^{}(?P<name>[^/]+){}$".format(re.escape(prefix), re.escape(suffix))
+    )
+    return prefix + "+" + suffix, regex
+
+
+def conf_from_register(msg):
+    """Static configuration of a device from its register message"""
+    conf = TESSConf()
+    conf.name = msg["name"]
+    model = msg.get("model", "TESS")
+    # Unknown models use the TESS header
+    conf.model = model if model in writef.IDA_TMPL else "TESS"
+    conf.mac_address = msg.get("mac", conf.mac_address)
+    conf.serial_number = msg.get("mac", msg["name"])
+    conf.zero_point = msg.get("calib", math.nan)
+    return conf
+
+
+def conf_from_reading(msg):
+    """Static configuration of a device that has not registered"""
+    conf = TESSConf()
+    conf.name = msg["name"]
+    conf.model = "TESS"
+    conf.mac_address = ""
+    conf.serial_number = msg["name"]
+    conf.zero_point = math.nan
+    return conf
+
+
+class Collector:
+    """Convert MQTT messages to IDA lines, and write them in batches
+
+    The files are kept open in a writef.NightlyFiles, up to max_open
+    """
+
+    def __init__(self, dirname, location, compression=None, max_open=64):
+        self.local_tz = pytz.timezone(location.timezone)
+        self.files = writef.NightlyFiles(dirname, location, compression, max_open)
+        # device name -> static configuration
+        self.devices = {}
+        self.pending = 0
+        self.received = 0
+
+    def register(self, msg):
+        conf = conf_from_register(msg)
+        if conf.name not in self.devices:
+            _logger.info("device %s registered", conf.name)
+        # Used in the header of the next file
+        self.devices[conf.name] = conf
+
+    def reading(self, msg):
+        """Convert a reading to a IDA line"""
+        name = msg["name"]
+        conf = self.devices.get(name)
+        if conf is None:
+            _logger.info("device %s has not registered", name)
+            conf = self.devices[name] = conf_from_reading(msg)
+        freq = msg["freq"]
+        mag = msg["mag"]
+        # As in avg_device_buffer, the magnitude of a invalid reading is -99
+        valid = freq > 0 and math.isfinite(mag)
+        zero_point = conf.zero_point
+        if math.isnan(zero_point):
+            if not valid:
+                _logger.debug("zero point of %s is unknown, reading skipped", name)
+                return
+            # mag = zp - 2.5 log10(freq)
+            zero_point = round(mag + 2.5 * math.log10(freq), 2)
+            conf.zero_point = zero_point
+        if not valid:
+            freq = 0
+            mag = -99
+
+        payload = dict(
+            cmd="r",
+            name=name,
+            freq_sensor=freq,
+            magnitude=mag,
+            temp_ambient=msg.get("tamb", 0.0),
+            temp_sky=msg.get("tsky", 0.0),
+            zero_point=zero_point,
+            localtz=self.local_tz,
+        )
+        tstamp = datetime.datetime.fromisoformat(msg["tstamp"])
+        set_tstamp(payload, datetime_to_ns(tstamp))
+        writef.update_p(payload)
+        self.files.write(conf, payload["tstamp_local_ns"], writef.format_line(payload))
+        self.pending += 1
+
+    def handle(self, kind, data):
+        """Process a message, kind is 'register' or 'reading'"""
+        self.received += 1
+        try:
+            msg = json.loads(data)
+            if kind == "register":
+                self.register(msg)
+            else:
+                self.reading(msg)
+        except (ValueError, KeyError, TypeError) as ex:
+            _logger.warning("invalid %s message: %s", kind, ex)
+        except OSError as ex:
+            # i.e. the disk is full, the message is lost
+            _logger.error("unable to write %s message: %s", kind, ex)
+
+    def flush(self):
+        """Write the buffered lines"""
+        try:
+            self.files.flush()
+        except OSError as ex:
+            _logger.error("unable to write %d lines: %s", self.pending, ex)
+        self.pending = 0
+
+    def close(self):
+        self.files.close()
+        self.pending = 0
+
+
+def mqtt_section_from_ini(cparser):
+    """The first enabled mqtt section"""
+    for sec_name in cparser.sections():
+        if not sec_name.startswith("mqtt"):
+            continue
+        sec = cparser[sec_name]
+        if sec.getboolean("enabled", True):
+            return sec
+    raise ValueError("no mqtt section is enabled in the configuration")
+
+
+def collect(collector: Collector, msg_q, stop_event, batch_lines, flush_interval):
+    """Process the messages in msg_q, until stop_event is set and msg_q is empty"""
+    thisth = threading.current_thread()
+    _logger.info("starting {} thread".format(thisth.name))
+    deadline = time.monotonic() + flush_interval
+    while True:
+        try:
+            item = msg_q.get(timeout=max(0.0, deadline - time.monotonic()))
+            while True:
+                collector.handle(*item)
+                if collector.pending >= batch_lines:
+                    collector.flush()
+                item = msg_q.get_nowait()
+        except queue.Empty:
+            pass
+        stop = stop_event.is_set()
+        if stop or time.monotonic() >= deadline:
+            collector.flush()
+            deadline = time.monotonic() + flush_interval
+            if stop and msg_q.empty():
+                collector.close()
+                break
+    _logger.info("end {} thread".format(thisth.name))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="tesstractor collect",
+        description="Archive the readings of photometers published over MQTT",
+    )
+    parser.add_argument("--dirname")
+    parser.add_argument("-c", "--config", required=True)
+    parser.add_argument(
+        "--log",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRTICAL", "NOTSET"],
+    )
+    pargs = parser.parse_args(args=args)
+
+    logging.basicConfig(level=getattr(logging, pargs.log.upper()))
+    cparser = cli.read_config(pargs)
+    location = cli.build_location_from_ini(cparser)
+    try:
+        mqtt_config = mqtt_section_from_ini(cparser)
+    except ValueError as ex:
+        _logger.error("%s", ex)
+        return 1
+    _logger.info("using section %s", mqtt_config.name)
+    sec = cparser["collect"] if cparser.has_section("collect") else cparser["DEFAULT"]
+    compression = sec.get("compression", "none")
+    if compression == "none":
+        compression = None
+    if compression not in writef.COMPRESSION_SUFFIX:
+        raise ValueError("unknown compression {}".format(compression))
+    dirname = pargs.dirname or sec.get("dirname")
+    os.makedirs(dirname, exist_ok=True)
+    collector = Collector(
+        dirname, location, compression, max_open=sec.getint("max_open", 64)
+    )
+
+    register_topic = mqtt_config["register_topic"]
+    publish_sub, publish_re = topic_pattern(mqtt_config["publish_topic"])
+    msg_q = queue.SimpleQueue()
+
+    def on_connect(client, userdata, flags, rc):
+        _logger.info("connected to %s, subscribing", mqtt_config["hostname"])
+        client.subscribe([(register_topic, 0), (publish_sub, 0)])
+
+    def on_message(client, userdata, message):
+        if message.topic == register_topic:
+            msg_q.put(("register", message.payload))
+        elif publish_re.match(message.topic):
+            msg_q.put(("reading", message.payload))
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    if mqtt_config.get("username"):
+        client.username_pw_set(
+            mqtt_config["username"], password=mqtt_config.get("password")
+        )
+    client.connect(mqtt_config["hostname"], mqtt_config.getint("port", 1883), 60)
+
+    exit_event = threading.Event()
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: exit_event.set())
+
+    worker = threading.Thread(
+        target=collect,
+        name="collector",
+        args=(
+            collector,
+            msg_q,
+            stop_event,
+            sec.getint("batch_lines", 5000),
+            sec.getfloat("flush_interval", 5.0),
+        ),
+    )
+    worker.start()
+    client.loop_start()
+    exit_event.wait()
+    client.loop_stop()
+    client.disconnect()
+    # No more messages, write the pending ones
+    stop_event.set()
+    worker.join()
+    _logger.info("received %d messages", collector.received)
+    return 0
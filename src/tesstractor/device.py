@@ -7,6 +7,103 @@
 # License-Filename: LICENSE.txt
 #
 
+import collections
+import logging
+import time
+
+from .timeutil import mono_to_ns, now_ns
+
+
+_logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Error budget of the connection with a device.
+
+    Malformed messages are counted; when more than budget of them
+    happen in window seconds, the connection must be reset. After a
+    failed reset, the next one is allowed after backoff seconds, that
+    doubles with each failure up to max_backoff. The errors during
+    a reset are counted, but they don't start another reset
+    """
+
+    def __init__(
+        self, budget=10, window=60.0, backoff=1.0, max_backoff=300.0, clock=None
+    ):
+        self.budget = budget
+        self.window = window
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock or time.monotonic
+
+        self._errors = collections.deque()
+        self._delay = backoff
+        self._next_reset = None
+        # A reset is in progress
+        self.resetting = False
+
+    @property
+    def is_open(self) -> bool:
+        """Resets are not allowed until the backoff has passed"""
+        return self._next_reset is not None and self.clock() < self._next_reset
+
+    def record_error(self) -> bool:
+        """Count a malformed message, return True if the connection must be reset"""
+        now = self.clock()
+        self._errors.append(now)
+        while self._errors and self._errors[0] < now - self.window:
+            self._errors.popleft()
+        if self.resetting or self.is_open:
+            return False
+        return len(self._errors) > self.budget
+
+    def reset_succeeded(self):
+        self._errors.clear()
+        self._delay = self.backoff
+        self._next_reset = None
+
+    def reset_failed(self):
+        self._next_reset = self.clock() + self._delay
+        self._delay = min(2 * self._delay, self.max_backoff)
+
+
+class LatencyStats:
+    """Latencies of the messages of a device, over the last size messages
+
+    - delay, from the arrival of a message to its time stamp, the
+      error of stamping the message when it is processed
+    - response, from the command to the arrival of the answer
+    """
+
+    def __init__(self, size=256):
+        self.count = 0
+        self.delay = collections.deque(maxlen=size)
+        self.response = collections.deque(maxlen=size)
+
+    def record(self, delay_ns, response_ns=None):
+        self.count += 1
+        self.delay.append(delay_ns)
+        if response_ns is not None:
+            self.response.append(response_ns)
+
+    @staticmethod
+    def _summary(values):
+        if not values:
+            return None
+        ordered = sorted(values)
+        return {
+            "mean_ms": sum(ordered) / len(ordered) / 1e6,
+            "p95_ms": ordered[int(0.95 * (len(ordered) - 1))] / 1e6,
+            "max_ms": ordered[-1] / 1e6,
+        }
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "delay": self._summary(self.delay),
+            "response": self._summary(self.response),
+        }
+
 
 class Device:
     """Photometric device"""
@@ -18,6 +115,12 @@ class Device:
 
         self.serial_number = self.name
         self.calibration = 20.5
+        # Optional CaptureLog of the raw lines
+        self.capture = None
+        self.breaker = CircuitBreaker()
+        # Connection, a transport or alike
+        self.transport = None
+        self.latency = LatencyStats()
 
     def start_connection(self):
         pass
@@ -53,6 +156,52 @@ class Device:
         text = f"unable to read data after {tries} tries"
         raise ValueError(text)
 
+    def reset_device(self):
+        pass
+
+    def receive_ns(self):
+        """Time of arrival of the last message read, or now if unknown"""
+        rx_mono = getattr(self.transport, "rx_mono_ns", None)
+        if rx_mono is None:
+            return now_ns()
+        delay = time.monotonic_ns() - rx_mono
+        tx_mono = getattr(self.transport, "tx_mono_ns", None)
+        response = None
+        if tx_mono is not None and tx_mono <= rx_mono:
+            response = rx_mono - tx_mono
+        self.latency.record(delay, response)
+        return mono_to_ns(rx_mono)
+
+    def resync(self, flush_input=False):
+        """Recover from a malformed message.
+
+        The next message starts a new frame, so the connection is
+        kept. It is reset only if the error budget is exhausted.
+        With flush_input, the pending input is dropped, for devices
+        that answer to commands
+        """
+        reset_input = getattr(self.transport, "reset_input_buffer", None)
+        if flush_input and reset_input is not None:
+            try:
+                reset_input()
+            except Exception:
+                _logger.debug("unable to clear input buffer of %s", self.name)
+
+        if not self.breaker.record_error():
+            return
+        _logger.warning("error budget of %s exhausted, reset device", self.name)
+        # The reset reads from the device, its errors don't reset again
+        self.breaker.resetting = True
+        try:
+            self.reset_device()
+        except Exception:
+            self.breaker.reset_failed()
+            _logger.exception("reset of %s failed", self.name)
+        else:
+            self.breaker.reset_succeeded()
+        finally:
+            self.breaker.resetting = False
+
     def filter_buffer(self, list_of_payload):
         pass
 
@@ -0,0 +1,191 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Discovery of the photometers connected to serial ports
+
+All the ports are probed at the same time. In each port, an SQM is
+asked for its metadata with 'ix' at 115200 baud; if there is no
+answer, the port is read at 9600 baud, looking for the lines sent
+by TESS-R and TESSv2 photometers.
+"""
+
+import concurrent.futures
+import glob
+import json
+import logging
+import time
+
+import attr
+import serial
+
+import tesstractor.sqm as sqm
+import tesstractor.tess as tess
+
+
+_logger = logging.getLogger(__name__)
+
+PORT_PATTERNS = ["/dev/ttyUSB*", "/dev/ttyACM*"]
+
+# Models handled by the same class in build_dev_from_ini
+_SAME_MODEL = {"TESS": "TESS-R", "TESS-U": "TESS-R"}
+
+
+@attr.s
+class ProbeResult:
+    port = attr.ib()
+    model = attr.ib()
+    baudrate = attr.ib()
+    serial_number = attr.ib(default=None)
+    name = attr.ib(default=None)
+    mac = attr.ib(default=None)
+    zero_point = attr.ib(default=None)
+
+
+def list_ports(patterns=PORT_PATTERNS):
+    ports = []
+    for pattern in patterns:
+        ports.extend(glob.glob(pattern))
+    return sorted(ports)
+
+
+def identify_sqm(msg):
+    """Return the serial number if msg is the answer of an SQM to 'ix'"""
+    match = sqm.META_RE.match(msg)
+    if match:
+        return int(match.group("serial_number"))
+    return None
+
+
+def identify_tess(msg):
+    """Identify a line sent by a TESS, return a dict or None"""
+    if tess.MEASURE_RE.match(msg):
+        return dict(model="TESS-R")
+    try:
+        res = json.loads(msg)
+    except ValueError:
+        return None
+    if isinstance(res, dict) and "mag" in res and "freq" in res:
+        return dict(
+            model="TESSv2",
+            name=res.get("name"),
+            mac=res.get("mac"),
+            zero_point=res.get("ZP"),
+        )
+    return None
+
+
+def _read_until(conn, deadline, identify):
+    while time.monotonic() < deadline:
+        msg = conn.readline()
+        if not msg:
+            continue
+        res = identify(msg)
+        if res is not None:
+            return res
+    return None
+
+
+def probe_port(port, timeout=3.0, serial_factory=serial.Serial):
+    """Identify the photometer in a port, return a ProbeResult or None"""
+    start = time.monotonic()
+    # SQM, answers to 'ix'
+    try:
+        conn = serial_factory(port, 115200, timeout=0.2)
+    except (OSError, serial.SerialException) as ex:
+        _logger.debug("unable to open %s: %s", port, ex)
+        return None
+    try:
+        conn.write(b"ix")
+        serial_number = _read_until(conn, start + timeout / 3, identify_sqm)
+    finally:
+        conn.close()
+    if serial_number is not None:
+        return ProbeResult(
+            port=port, model="SQM-LU", baudrate=115200, serial_number=serial_number
+        )
+
+    # TESS, sends data periodically
+    try:
+        conn = serial_factory(port, 9600, timeout=0.2)
+    except (OSError, serial.SerialException) as ex:
+        _logger.debug("unable to open %s: %s", port, ex)
+        return None
+    try:
+        res = _read_until(conn, start + timeout, identify_tess)
+    finally:
+        conn.close()
+    if res is not None:
+        return ProbeResult(port=port, baudrate=9600, **res)
+    return None
+
+
+def discover(ports=None, timeout=3.0, serial_factory=serial.Serial):
+    """Probe the ports concurrently, return the list of ProbeResult"""
+    if ports is None:
+        ports = list_ports()
+    if not ports:
+        return []
+    _logger.info("probing ports %s", ", ".join(ports))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        futures = [
+            executor.submit(probe_port, port, timeout, serial_factory) for port in ports
+        ]
+        results = []
+        for future in futures:
+            res = future.result()
+            if res is not None:
+                _logger.info("found %s in %s", res.model, res.port)
+                results.append(res)
+    return results
+
+
+def _same_id(value, wanted):
+    if value is None:
+        return False
+    value = str(value).strip().lower()
+    wanted = wanted.strip().lower()
+    if value.isdigit() and wanted.isdigit():
+        return int(value) == int(wanted)
+    return value == wanted
+
+
+def match_section(section, results):
+    """Find the probed device for a configuration section.
+
+    The device is matched by serial number, MAC or name, if they are
+    present in the section, and by model if only one device of the
+    model has been found. The matched result is removed from results
+    """
+    model = section.get("model", "auto")
+    model = _SAME_MODEL.get(model, model)
+    candidates = [res for res in results if model in ["auto", res.model]]
+    keys = [
+        ("serial_number", lambda res: res.serial_number),
+        ("mac", lambda res: res.mac),
+        ("name", lambda res: res.name),
+    ]
+    for key, value in keys:
+        wanted = section.get(key)
+        if wanted is None:
+            continue
+        found = [res for res in candidates if _same_id(value(res), wanted)]
+        if found:
+            results.remove(found[0])
+            return found[0]
+
+    # The device may not report the identifier used in the configuration
+    unknown = [
+        res
+        for res in candidates
+        if all(value(res) is None for key, value in keys if section.get(key))
+    ]
+    if len(unknown) == 1:
+        results.remove(unknown[0])
+        return unknown[0]
+    return None
@@ -0,0 +1,249 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Export IDA archives to columnar files
+
+Each IDA file is converted once to {outdir}/nights/{file name}.npz,
+the file is converted again only if it has changed. Then the nights
+of each device are joined in one store:
+
+- npz, {outdir}/{device}.npz
+- npy, {outdir}/{device}/{column}.npy and meta.json, can be memory mapped
+- parquet and arrow, {outdir}/{device}.parquet or .arrow, need pyarrow
+
+The times are datetime64[ns]. The header of the IDA files is kept
+in 'meta', as JSON, with the names of the files in meta['files'].
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import json
+import logging
+import os
+import os.path
+
+import numpy
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import tesstractor.reader
+import tesstractor.writef as writef
+
+
+_logger = logging.getLogger(__name__)
+
+FORMATS = ["npz", "npy", "parquet", "arrow"]
+
+_TIME_COLUMNS = ["time_utc", "time_local"]
+_FLOAT_COLUMNS = ["temp", "sky_temp", "freq", "mag", "zp"]
+
+
+def _meta_value(value):
+    """Header value as a JSON type"""
+    if hasattr(value, "unit"):
+        return float(value.value)
+    if isinstance(value, (str, int, float)) or value is None:
+        return value
+    return str(value)
+
+
+def table_to_columns(table_obj):
+    """Convert a table read from a IDA file to a dict of numpy arrays"""
+    columns = {}
+    for name in _TIME_COLUMNS:
+        values = numpy.asarray(table_obj[name], dtype=str) if len(table_obj) else []
+        columns[name] = numpy.array(values, dtype="datetime64[ms]").astype(
+            "datetime64[ns]"
+        )
+    for name in _FLOAT_COLUMNS:
+        columns[name] = numpy.asarray(table_obj[name], dtype="f8")
+    return columns
+
+
+def night_filename(outdir, path):
+    return os.path.join(outdir, "nights", os.path.basename(path) + ".npz")
+
+
+def _save_npz(filename, columns, meta):
+    # Write and rename, a partial file is never seen
+    tmpname = filename + ".tmp.npz"
+    numpy.savez(tmpname, meta=json.dumps(meta), **columns)
+    os.replace(tmpname, filename)
+
+
+def _load_npz(filename):
+    with numpy.load(filename) as data:
+        meta = json.loads(str(data["meta"]))
+        columns = {name: data[name] for name in _TIME_COLUMNS + _FLOAT_COLUMNS}
+    return columns, meta
+
+
+def convert_night(path, outdir):
+    """Convert a IDA file to npz, if needed. Return the name of the npz file"""
+    filename = night_filename(outdir, path)
+    if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(
+        path
+    ):
+        return filename
+    _logger.debug("converting %s", path)
+    table_obj = tesstractor.reader.read_file(path)
+    meta = {key: _meta_value(value) for key, value in table_obj.meta.items()}
+    meta["file"] = os.path.basename(path)
+    _save_npz(filename, table_to_columns(table_obj), meta)
+    return filename
+
+
+def select_files(dirname, name, start=None, end=None):
+    """IDA files of a device of the nights between start and end (dates)"""
+    selected = []
+    for fname, dt in writef.list_files(dirname, name):
+        # The night of a file is the date of its noon-to-noon start
+        night = (dt - datetime.timedelta(hours=12)).date()
+        if start is not None and night < start:
+            continue
+        if end is not None and night > end:
+            continue
+        selected.append(os.path.join(dirname, fname))
+    return selected
+
+
+def list_devices(dirname):
+    """Names of the devices with IDA files in dirname"""
+    names = set()
+    for path in glob.glob(os.path.join(dirname, "????????_??????_*.dat*")):
+        fname = os.path.basename(path)
+        if fname.endswith(writef.IDA_SUFFIXES):
+            names.add(fname[16:].split(".dat")[0])
+    return sorted(names)
+
+
+def join_nights(filenames):
+    """Join the columns of converted nights, return columns and metadata"""
+    parts = [_load_npz(filename) for filename in filenames]
+    if not parts:
+        return {}, {"files": []}
+    columns = {
+        name: numpy.concatenate([cols[name] for cols, _ in parts])
+        for name in _TIME_COLUMNS + _FLOAT_COLUMNS
+    }
+    meta = dict(parts[-1][1])
+    del meta["file"]
+    meta["files"] = [part_meta["file"] for _, part_meta in parts]
+    return columns, meta
+
+
+def write_store(filename_base, columns, meta, fmt):
+    """Write the columns in a format, return the name of the output"""
+    if fmt == "npz":
+        filename = filename_base + ".npz"
+        _save_npz(filename, columns, meta)
+    elif fmt == "npy":
+        filename = filename_base
+        os.makedirs(filename, exist_ok=True)
+        for name, values in columns.items():
+            numpy.save(os.path.join(filename, name + ".npy"), values)
+        with open(os.path.join(filename, "meta.json"), "w") as fd:
+            json.dump(meta, fd)
+    elif fmt in ["parquet", "arrow"]:
+        if pyarrow is None:
+            raise RuntimeError("format {} requires pyarrow".format(fmt))
+        table = pyarrow.table(columns)
+        table = table.replace_schema_metadata({"ida": json.dumps(meta)})
+        if fmt == "parquet":
+            filename = filename_base + ".parquet"
+            pyarrow.parquet.write_table(table, filename)
+        else:
+            filename = filename_base + ".arrow"
+            pyarrow.feather.write_feather(table, filename)
+    else:
+        raise ValueError("unknown format {}".format(fmt))
+    return filename
+
+
+def export_device(dirname, name, outdir, fmt="npz", start=None, end=None, jobs=None):
+    """Export the IDA files of a device, return the name of the output"""
+    paths = select_files(dirname, name, start, end)
+    os.makedirs(os.path.join(outdir, "nights"), exist_ok=True)
+    if jobs == 1 or len(paths) <= 1:
+        filenames = [convert_night(path, outdir) for path in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            filenames = list(executor.map(convert_night, paths, [outdir] * len(paths)))
+    columns, meta = join_nights(filenames)
+    if not columns:
+        _logger.warning("no data of %s", name)
+        return None
+    filename = write_store(os.path.join(outdir, name), columns, meta, fmt)
+    _logger.info(
+        "%s: %d rows from %d files in %s",
+        name,
+        len(columns["time_utc"]),
+        len(filenames),
+        filename,
+    )
+    return filename
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Export IDA files to columnar files")
+    parser.add_argument(
+        "--device", action="append", help="name of the device, default is all"
+    )
+    parser.add_argument(
+        "--from",
+        dest="night_from",
+        type=datetime.date.fromisoformat,
+        help="first night (date of the evening)",
+    )
+    parser.add_argument(
+        "--to",
+        dest="night_to",
+        type=datetime.date.fromisoformat,
+        help="last night (date of the evening)",
+    )
+    parser.add_argument("--format", default="npz", choices=FORMATS)
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("-o", "--outdir", required=True)
+    parser.add_argument(
+        "--log",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRTICAL", "NOTSET"],
+    )
+    parser.add_argument("dirname")
+    pargs = parser.parse_args(args=args)
+
+    loglevel = getattr(logging, pargs.log.upper())
+    logging.basicConfig(level=loglevel)
+
+    if pargs.format in ["parquet", "arrow"] and pyarrow is None:
+        parser.error("format {} requires pyarrow".format(pargs.format))
+
+    names = pargs.device or list_devices(pargs.dirname)
+    for name in names:
+        export_device(
+            pargs.dirname,
+            name,
+            pargs.outdir,
+            pargs.format,
+            pargs.night_from,
+            pargs.night_to,
+            pargs.jobs,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    main()
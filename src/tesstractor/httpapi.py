@@ -0,0 +1,360 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Local HTTP API with the recent measurements of the devices
+
+The measurements of the last hours are kept in memory, in a numpy
+array per device sorted by time. The endpoints are:
+
+- /devices, the devices, the time of their last measurement and
+  their latency statistics
+- /latest?device=NAME, the last measurement of a device, or of all
+  the devices without device
+- /range?device=NAME&from=ISO&to=ISO, the measurements of a device
+  in a time range (UTC). from and to are optional
+- /latency?device=NAME, the latency statistics of a device, or of
+  all the devices without device, as sent by the readers
+
+The results are JSON, or CSV with format=csv
+"""
+
+import datetime
+import http.server
+import json
+import logging
+import math
+import threading
+import urllib.parse
+
+import numpy
+
+from tesstractor.bus import Subscription
+from tesstractor.timeutil import datetime_to_ns, format_ns, payload_iso, payload_ns
+
+
+_logger = logging.getLogger(__name__)
+
+HISTORY_DTYPE = numpy.dtype(
+    [
+        ("tstamp", "i8"),
+        ("freq_sensor", "f8"),
+        ("magnitude", "f8"),
+        ("zero_point", "f8"),
+        ("temp_ambient", "f8"),
+        ("temp_sky", "f8"),
+    ]
+)
+
+# Output name of each field, as in the columns of the IDA files
+_COLUMNS = [
+    ("tstamp", "time_utc"),
+    ("temp_ambient", "temp"),
+    ("temp_sky", "sky_temp"),
+    ("freq_sensor", "freq"),
+    ("magnitude", "mag"),
+    ("zero_point", "zp"),
+]
+
+
+class DeviceHistory:
+    """Measurements of a device in the last span ns, sorted by time"""
+
+    def __init__(self, span, capacity=1024):
+        self.span = span
+        self._data = numpy.zeros(capacity, dtype=HISTORY_DTYPE)
+        self._start = 0
+        self._stop = 0
+
+    def __len__(self):
+        return self._stop - self._start
+
+    @property
+    def records(self):
+        return self._data[self._start : self._stop]
+
+    def _reserve(self, n):
+        """Make room for n more records at the end"""
+        if self._stop + n <= len(self._data):
+            return
+        live = self.records
+        capacity = len(self._data)
+        while capacity < 2 * (len(live) + n):
+            capacity *= 2
+        if capacity != len(self._data):
+            data = numpy.zeros(capacity, dtype=HISTORY_DTYPE)
+        else:
+            data = self._data
+        data[: len(live)] = live
+        self._data = data
+        self._start = 0
+        self._stop = len(live)
+
+    def extend(self, rows):
+        """Add an array of records of HISTORY_DTYPE"""
+        if len(rows) == 0:
+            return
+        last = self._data[self._stop - 1]["tstamp"] if len(self) else None
+        self._reserve(len(rows))
+        self._data[self._stop : self._stop + len(rows)] = rows
+        self._stop += len(rows)
+        unsorted = numpy.any(numpy.diff(rows["tstamp"]) < 0)
+        if unsorted or (last is not None and rows["tstamp"][0] < last):
+            # Rare, the clock has been set back
+            live = self.records
+            live[:] = live[numpy.argsort(live["tstamp"], kind="stable")]
+        # Forget the old records
+        newest = self._data[self._stop - 1]["tstamp"]
+        self._start += int(
+            numpy.searchsorted(self.records["tstamp"], newest - self.span)
+        )
+
+    def latest(self):
+        if len(self) == 0:
+            return None
+        return self._data[self._stop - 1]
+
+    def range(self, start=None, end=None):
+        """Copy of the records in [start, end), in ns"""
+        records = self.records
+        tstamps = records["tstamp"]
+        lo = 0 if start is None else numpy.searchsorted(tstamps, start)
+        hi = len(records) if end is None else numpy.searchsorted(tstamps, end)
+        return records[lo:hi].copy()
+
+
+def payloads_to_rows(payloads):
+    """Convert 'r' payloads to an array of HISTORY_DTYPE"""
+    rows = numpy.empty(len(payloads), dtype=HISTORY_DTYPE)
+    for row, payload in zip(rows, payloads):
+        row["tstamp"] = payload_ns(payload)
+        row["freq_sensor"] = payload["freq_sensor"]
+        row["magnitude"] = payload["magnitude"]
+        row["zero_point"] = payload["zero_point"]
+        row["temp_ambient"] = payload.get("temp_ambient", math.nan)
+        row["temp_sky"] = payload.get("temp_sky", math.nan)
+    return rows
+
+
+class RecentStore:
+    """Recent measurements of all the devices"""
+
+    def __init__(self, hours=24.0):
+        self.span = int(hours * 3600 * 10**9)
+        self._lock = threading.Lock()
+        self._devices = {}
+        # name -> last 'status' payload
+        self._status = {}
+
+    def add(self, payloads):
+        """Add a batch of payloads, valid 'r' and 'status' payloads are kept"""
+        by_device = {}
+        for payload in payloads:
+            if payload["cmd"] == "r" and payload.get("valid", True):
+                by_device.setdefault(payload["name"], []).append(payload)
+            elif payload["cmd"] == "status":
+                with self._lock:
+                    self._status[payload["name"]] = payload
+        for name, dev_payloads in by_device.items():
+            rows = payloads_to_rows(dev_payloads)
+            with self._lock:
+                history = self._devices.get(name)
+                if history is None:
+                    history = self._devices[name] = DeviceHistory(self.span)
+                history.extend(rows)
+
+    def devices(self):
+        with self._lock:
+            return {
+                name: history.latest().copy() for name, history in self._devices.items()
+            }
+
+    def latest(self, name):
+        with self._lock:
+            history = self._devices.get(name)
+            if history is None:
+                return None
+            return history.latest().copy()
+
+    def range(self, name, start=None, end=None):
+        with self._lock:
+            history = self._devices.get(name)
+            if history is None:
+                return None
+            return history.range(start, end)
+
+    def latency(self, name):
+        """Last latency statistics of a device, with their time"""
+        with self._lock:
+            payload = self._status.get(name)
+        if payload is None:
+            return None
+        result = {"name": name, "time_utc": payload_iso(payload)}
+        result.update(payload["latency"])
+        return result
+
+    def latency_devices(self):
+        with self._lock:
+            return sorted(self._status)
+
+
+def _value(value):
+    value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def record_to_dict(name, rec):
+    result = {"name": name}
+    for field, column in _COLUMNS:
+        if field == "tstamp":
+            result[column] = format_ns(int(rec[field]))
+        else:
+            result[column] = _value(rec[field])
+    return result
+
+
+def records_to_csv(records):
+    """CSV of a list of (name, record)"""
+    lines = [",".join(["name"] + [column for _, column in _COLUMNS])]
+    for name, rec in records:
+        values = [name, format_ns(int(rec["tstamp"]))]
+        for field, _ in _COLUMNS[1:]:
+            value = _value(rec[field])
+            values.append("" if value is None else repr(value))
+        lines.append(",".join(values))
+    return "\n".join(lines) + "\n"
+
+
+def parse_time_ns(value):
+    """Parse a ISO time, naive times are UTC"""
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return datetime_to_ns(dt)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answer the queries with the data in server.store"""
+
+    def log_message(self, format, *args):
+        _logger.debug("%s %s", self.address_string(), format % args)
+
+    def _send(self, code, body, content_type):
+        data = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, code, msg):
+        self._send(code, json.dumps({"error": msg}) + "\n", "application/json")
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {
+            key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()
+        }
+        fmt = params.get("format", "json")
+        if fmt not in ["json", "csv"]:
+            return self._error(400, "unknown format {}".format(fmt))
+        store = self.server.store
+        try:
+            if url.path == "/devices":
+                result = [
+                    {
+                        "name": name,
+                        "last": format_ns(int(rec["tstamp"])),
+                        "latency": store.latency(name),
+                    }
+                    for name, rec in sorted(store.devices().items())
+                ]
+                return self._send(200, json.dumps(result) + "\n", "application/json")
+            elif url.path == "/latency":
+                if "device" in params:
+                    result = store.latency(params["device"])
+                    if result is None:
+                        msg = "no latency of {}".format(params["device"])
+                        return self._error(404, msg)
+                else:
+                    result = [store.latency(name) for name in store.latency_devices()]
+                return self._send(200, json.dumps(result) + "\n", "application/json")
+            elif url.path == "/latest":
+                names = [params["device"]] if "device" in params else None
+                if names is None:
+                    names = sorted(store.devices())
+                records = [(name, store.latest(name)) for name in names]
+                records = [(name, rec) for name, rec in records if rec is not None]
+                if "device" in params and not records:
+                    return self._error(404, "no data of {}".format(params["device"]))
+            elif url.path == "/range":
+                if "device" not in params:
+                    return self._error(400, "device is required")
+                name = params["device"]
+                start = end = None
+                if "from" in params:
+                    start = parse_time_ns(params["from"])
+                if "to" in params:
+                    end = parse_time_ns(params["to"])
+                recs = store.range(name, start, end)
+                if recs is None:
+                    return self._error(404, "no data of {}".format(name))
+                records = [(name, rec) for rec in recs]
+            else:
+                return self._error(404, "unknown path {}".format(url.path))
+        except ValueError as ex:
+            return self._error(400, str(ex))
+
+        if fmt == "csv":
+            return self._send(200, records_to_csv(records), "text/csv")
+        result = [record_to_dict(name, rec) for name, rec in records]
+        if url.path == "/latest" and "device" in params:
+            result = result[0]
+        return self._send(200, json.dumps(result) + "\n", "application/json")
+
+
+class HttpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store: RecentStore):
+        super().__init__(address, RequestHandler)
+        self.store = store
+
+
+def consumer_http(sub: Subscription, config):
+    """Keep the payloads of the subscription and serve them over HTTP"""
+    thisth = threading.current_thread()
+    _logger.info("starting {} thread".format(thisth.name))
+    store = RecentStore(config.getfloat("hours", 24.0))
+    address = (config.get("host", "127.0.0.1"), config.getint("port", 8080))
+    try:
+        server = HttpServer(address, store)
+    except OSError:
+        _logger.exception("starting HTTP server at %s:%d", *address)
+        # Keep reading, the bus must not grow
+        while sub.get_batch() is not None:
+            pass
+        return
+    _logger.info("HTTP server at %s:%d", *server.server_address[:2])
+    server_thread = threading.Thread(
+        target=server.serve_forever, name=f"{thisth.name}_server"
+    )
+    server_thread.start()
+    try:
+        while True:
+            batch = sub.get_batch()
+            if batch is None:
+                break
+            store.add(batch)
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+        _logger.info("end {} thread".format(thisth.name))
@@ -7,15 +7,14 @@
 # License-Filename: LICENSE.txt
 #
 
-import datetime
 import logging
 import json
 import queue
 
 import paho.mqtt.client as mqtt
 
+from tesstractor.timeutil import payload_iso
 
-_HALF_S = datetime.timedelta(seconds=0.5)
 
 _logger = logging.getLogger(__name__)
 
@@ -51,10 +50,12 @@ class MqttConsumer:
             payload = dict(msg)
             del payload["cmd"]
             del payload["localtz"]
-            if "tstamp_local" in payload:
-                del payload["tstamp_local"]
+            # The time stamps are sent as a string
+            for key in list(payload):
+                if key.startswith("tstamp"):
+                    del payload[key]
             # round to nearest second
-            payload["tstamp"] = (msg["tstamp"] + _HALF_S).strftime("%FT%T")
+            payload["tstamp"] = payload_iso(msg, "seconds")
             payload["chan"] = self.config["publish_topic"].format(name=msg["name"])
 
             spayload = json.dumps(payload)
@@ -84,9 +85,17 @@ class MqttConsumer:
             if "temp_sky" in msg:
                 payload["tsky"] = msg["temp_sky"]
             # round to nearest second
-            payload["tstamp"] = (msg["tstamp"] + _HALF_S).strftime("%FT%T")
+            payload["tstamp"] = payload_iso(msg, "seconds")
 
             spayload = self.MSG.format(**payload)
+            # Dispersion of the magnitude, if computed
+            extra = [
+                '"{}": {:.2f}'.format(key[4:], msg[key])
+                for key in sorted(msg)
+                if key == "mag_mad" or key.startswith("mag_p")
+            ]
+            if extra:
+                spayload = ", ".join([spayload] + extra)
             spayload = "{{{}}}".format(spayload)
             # With this I can't control numeric precision
             # spayload = json.dumps(payload)
@@ -0,0 +1,312 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Run each photometer reader in its own process
+
+The readers write fixed-layout records into a ring buffer in shared
+memory, that is read by a thread in the main process without pickling.
+The (rare) registration messages go through a multiprocessing.Queue.
+"""
+
+import configparser
+import logging
+import math
+import multiprocessing
+import multiprocessing.shared_memory
+import queue
+import signal
+import threading
+import time
+
+import numpy
+
+from tesstractor.timeutil import payload_ns, set_tstamp
+
+
+_logger = logging.getLogger(__name__)
+
+
+RECORD_DTYPE = numpy.dtype(
+    [
+        ("tstamp", "i8"),
+        ("seq", "i8"),
+        ("freq_sensor", "f8"),
+        ("magnitude", "f8"),
+        ("zero_point", "f8"),
+        ("temp_ambient", "f8"),
+        ("temp_sky", "f8"),
+        ("protocol_revision", "i4"),
+        ("valid", "?"),
+    ]
+)
+
+# Fields that may be missing in a payload, stored as NaN or 0
+_OPTIONAL_FLOAT = ["temp_ambient", "temp_sky"]
+_OPTIONAL_INT = ["protocol_revision"]
+
+# head (records written) and tail (records read)
+_HEADER_DTYPE = numpy.dtype("i8")
+_HEADER_SIZE = 2 * _HEADER_DTYPE.itemsize
+
+
+class RecordRing:
+    """Single producer, single consumer ring of records in shared memory"""
+
+    def __init__(self, capacity=4096, name=None):
+        self.capacity = capacity
+        size = _HEADER_SIZE + capacity * RECORD_DTYPE.itemsize
+        if name is None:
+            self.shm = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=size
+            )
+        else:
+            self.shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        self._counters = numpy.ndarray((2,), dtype=_HEADER_DTYPE, buffer=self.shm.buf)
+        self._records = numpy.ndarray(
+            (capacity,), dtype=RECORD_DTYPE, buffer=self.shm.buf, offset=_HEADER_SIZE
+        )
+        if name is None:
+            self._counters[:] = 0
+        self.dropped = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def put(self, payload) -> bool:
+        """Write a payload, return False if the ring is full"""
+        head = int(self._counters[0])
+        tail = int(self._counters[1])
+        if head - tail >= self.capacity:
+            self.dropped += 1
+            return False
+
+        rec = self._records[head % self.capacity]
+        rec["tstamp"] = payload_ns(payload)
+        rec["seq"] = payload.get("seq", 0)
+        rec["freq_sensor"] = payload["freq_sensor"]
+        rec["magnitude"] = payload["magnitude"]
+        rec["zero_point"] = payload["zero_point"]
+        for key in _OPTIONAL_FLOAT:
+            rec[key] = payload.get(key, math.nan)
+        for key in _OPTIONAL_INT:
+            rec[key] = payload.get(key, 0)
+        rec["valid"] = payload["valid"]
+        # The record is complete before it is published
+        self._counters[0] = head + 1
+        return True
+
+    def get_all(self):
+        """Read all the pending records, as a copy"""
+        head = int(self._counters[0])
+        tail = int(self._counters[1])
+        if head == tail:
+            return self._records[:0].copy()
+        idx = numpy.arange(tail, head) % self.capacity
+        recs = self._records[idx]
+        self._counters[1] = head
+        return recs
+
+    def close(self):
+        # Views must be released before closing the shared memory
+        del self._counters
+        del self._records
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def record_to_payload(rec, base):
+    """Convert a record into a payload, adding the static fields in base"""
+    payload = dict(base)
+    payload["cmd"] = "r"
+    set_tstamp(payload, int(rec["tstamp"]))
+    payload["seq"] = int(rec["seq"])
+    payload["freq_sensor"] = float(rec["freq_sensor"])
+    payload["magnitude"] = float(rec["magnitude"])
+    payload["zero_point"] = float(rec["zero_point"])
+    for key in _OPTIONAL_FLOAT:
+        if not math.isnan(rec[key]):
+            payload[key] = float(rec[key])
+    for key in _OPTIONAL_INT:
+        if rec[key]:
+            payload[key] = int(rec[key])
+    payload["valid"] = bool(rec["valid"])
+    return payload
+
+
+class _RingOutput:
+    """Queue-like output of read_photometer_timed in the device process"""
+
+    def __init__(self, ring: RecordRing, ctrl_q):
+        self.ring = ring
+        self.ctrl_q = ctrl_q
+
+    def put(self, payload):
+        if payload is None:
+            return
+        if payload["cmd"] == "r":
+            if not self.ring.put(payload):
+                _logger.warning("ring buffer full, dropping record")
+        else:
+            self.ctrl_q.put(("id", payload))
+
+
+def device_process(
+    secname, secdict, readerconf, ring_name, capacity, ctrl_q, exit_event
+):
+    """Target of the device process"""
+    # imported here to avoid a circular import
+    from tesstractor.cli import build_dev_from_ini
+    from tesstractor.workers import read_photometer_timed
+
+    # The main process handles the signals
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    cparser = configparser.ConfigParser()
+    cparser.read_dict({secname: secdict})
+    try:
+        photo_dev = build_dev_from_ini(cparser[secname])
+        photo_dev.start_connection()
+    except Exception as ex:
+        ctrl_q.put(("error", str(ex)))
+        return
+
+    ctrl_q.put(("ready", photo_dev.name, photo_dev.static_conf()))
+    ring = RecordRing(capacity, name=ring_name)
+    output = _RingOutput(ring, ctrl_q)
+    error_event = threading.Event()
+    try:
+        read_photometer_timed(photo_dev, output, readerconf, exit_event, error_event)
+    finally:
+        if photo_dev.capture:
+            photo_dev.capture.stop()
+        ring.close()
+        ctrl_q.put(("end", error_event.is_set()))
+
+
+class DeviceProcess:
+    """Handle a device process from the main process"""
+
+    def __init__(self, section, readerconf, exit_event, capacity=4096, poll=0.2):
+        self.secname = section.name
+        self.secdict = dict(section.items())
+        self.readerconf = readerconf
+        self.exit_event = exit_event
+        self.capacity = capacity
+        self.poll = poll
+        self.name = section.get("name", section.name)
+        self.static_conf = None
+
+        self.ring = None
+        self.ctrl_q = multiprocessing.Queue()
+        self.process = None
+        self._base = None
+
+    def start(self):
+        self.ring = RecordRing(self.capacity)
+        self.process = multiprocessing.Process(
+            target=device_process,
+            name=f"photo_reader_{self.name}",
+            args=(
+                self.secname,
+                self.secdict,
+                self.readerconf,
+                self.ring.name,
+                self.capacity,
+                self.ctrl_q,
+                self.exit_event,
+            ),
+        )
+        self.process.start()
+
+    def wait_ready(self, timeout=None) -> bool:
+        """Wait until the device connection has started"""
+        try:
+            msg = self.ctrl_q.get(timeout=timeout)
+        except queue.Empty:
+            _logger.error("device %s not ready after %s s", self.name, timeout)
+            return False
+        if msg[0] == "ready":
+            _, self.name, self.static_conf = msg
+            return True
+        _logger.error("device %s failed to start: %s", self.name, msg[1:])
+        return False
+
+    def _handle_ctrl(self, msg, output_q, error_event) -> bool:
+        """Handle a control message, return True at the end of the process"""
+        if msg[0] == "id":
+            # 'id' and 'status' payloads
+            payload = msg[1]
+            if payload["cmd"] == "id":
+                self._base = dict(
+                    name=payload["name"],
+                    model=payload["model"],
+                    localtz=payload["localtz"],
+                )
+            output_q.put(payload)
+        elif msg[0] == "end":
+            if msg[1]:
+                error_event.set()
+            return True
+        return False
+
+    def _drain_ctrl(self, output_q, error_event, timeout=None) -> bool:
+        """Handle the pending control messages, return True at the end.
+
+        With timeout, wait for each message up to timeout seconds
+        """
+        ended = False
+        while not ended:
+            try:
+                if timeout is None:
+                    msg = self.ctrl_q.get_nowait()
+                else:
+                    msg = self.ctrl_q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            ended = self._handle_ctrl(msg, output_q, error_event)
+        return ended
+
+    def forward(self, output_q: queue.Queue, error_event):
+        """Copy records from the ring into output_q until the process ends"""
+        thisth = threading.current_thread()
+        _logger.info("starting {} thread".format(thisth.name))
+        while True:
+            ended = self._drain_ctrl(output_q, error_event)
+            if not ended and not self.process.is_alive():
+                # The last messages may still be in transit
+                ended = self._drain_ctrl(output_q, error_event, timeout=self.poll)
+                if not ended:
+                    _logger.error("device process %s ended unexpectedly", self.name)
+                    error_event.set()
+                    ended = True
+
+            if self._base is not None:
+                for rec in self.ring.get_all():
+                    output_q.put(record_to_payload(rec, self._base))
+
+            if ended:
+                break
+            time.sleep(self.poll)
+
+        # Records written after the last read
+        if self._base is not None:
+            for rec in self.ring.get_all():
+                output_q.put(record_to_payload(rec, self._base))
+        self.stop()
+        _logger.debug("end {} thread".format(thisth.name))
+
+    def stop(self):
+        """Wait for the process and release the ring"""
+        self.process.join()
+        self.ring.close()
+        self.ring.unlink()
@@ -11,6 +11,7 @@
 import os.path
 import logging
 import argparse
+import time
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -21,12 +22,13 @@ import matplotlib.patches as mpatches
 from astropy.coordinates import get_sun, get_moon
 from astropy.coordinates import EarthLocation
 from astropy.time import Time
-import astropy.table
 import astropy.units as u
 import astroplan
 
 # Import IDA format reader
-import tesstractor.reader  # noqa
+import tesstractor.reader
+from tesstractor.writef import IDA_SUFFIXES
+from tesstractor.watch import DebouncedScheduler, make_watcher
 
 # Style for saving into PNG
 my_style1 = {"figure.figsize": (9, 7), "savefig.dpi": 200, "axes.labelsize": 14}
@@ -137,17 +139,22 @@ def plot_moon(ax, site, base_time):
 
 def gen_plot(ax, tval, magval, site, ref_day, meta):
 
-    hours = mdates.HourLocator(interval=2)
-    mins = mdates.MinuteLocator(byminute=[0, 30])
-    hoursfmt = mdates.DateFormatter("%H", tz=site.timezone)
-    next_day = ref_day + timedelta(days=1)
-    base_time = Time(ref_day.astimezone(pytz.utc))
     if len(tval) > 0:
         ax.plot(tval, magval, "+")
     else:
         t1 = ref_day
         t2 = ref_day + timedelta(seconds=7200)
         ax.set_xlim(t1, t2)
+    setup_axes(ax, site, ref_day, meta)
+
+
+def setup_axes(ax, site, ref_day, meta):
+    """Add the static parts of the plot of a night, for the current x limits"""
+    hours = mdates.HourLocator(interval=2)
+    mins = mdates.MinuteLocator(byminute=[0, 30])
+    hoursfmt = mdates.DateFormatter("%H", tz=site.timezone)
+    next_day = ref_day + timedelta(days=1)
+    base_time = Time(ref_day.astimezone(pytz.utc))
     utco = ref_day.strftime("%z")
     day1 = ref_day.strftime("%Y-%m-%d")
     day2 = next_day.strftime("%Y-%m-%d")
@@ -175,12 +182,11 @@ def do_plots_on_dir(dirname):
 
     data_files = []
     for f in os.listdir(dirname):
-        if f.endswith(".dat"):
+        if f.endswith(IDA_SUFFIXES):
             data_files.append(f)
 
     for filed in sorted(data_files):
-        fname, ext = os.path.splitext(filed)
-        filep = fname + ".png"
+        filep = plot_filename(filed)
         filed_f = os.path.join(dirname, filed)
         filep_f = os.path.join(dirname, filep)
         tfiled = os.path.getmtime(filed_f)
@@ -197,37 +203,84 @@ def do_plots_on_dir(dirname):
             logger.debug("%s plot older than data, nothing to do", filep)
 
 
+def watch_plots(dirname, debounce=5.0, min_period=60.0, exit_event=None):
+    """Update the plots of the files modified in dirname, until exit_event is set"""
+    logger = logging.getLogger(__name__)
+
+    do_plots_on_dir(dirname)
+    watcher = make_watcher(dirname)
+    renderers = RendererCache()
+    scheduler = DebouncedScheduler(debounce=debounce, min_period=min_period)
+    logger.info("watching %s", dirname)
+    try:
+        while exit_event is None or not exit_event.is_set():
+            now = time.monotonic()
+            timeout = scheduler.next_timeout(now, default=1.0)
+            for name in watcher.read(timeout):
+                if name.endswith(IDA_SUFFIXES):
+                    scheduler.add(name, time.monotonic())
+            for name in scheduler.due(time.monotonic()):
+                filed_f = os.path.join(dirname, name)
+                filep_f = os.path.join(dirname, plot_filename(name))
+                logger.debug("%s modified, update plot", name)
+                try:
+                    renderers.plot_file(filed_f, filep_f)
+                except Exception:
+                    logger.exception("plotting %s", name)
+    finally:
+        renderers.close()
+        watcher.close()
+
+
+def plot_filename(filename):
+    """Name of the plot of a IDA file, plain or compressed"""
+    fname = filename
+    for suffix in IDA_SUFFIXES:
+        if filename.endswith(suffix):
+            fname = filename[: -len(suffix)]
+            break
+    else:
+        fname, ext = os.path.splitext(filename)
+    return fname + ".png"
+
+
 def do_plots_on_file(filename):
-    fname, ext = os.path.splitext(filename)
-    filep = fname + ".png"
+    filep = plot_filename(filename)
     plot_file(filename, filep)
 
 
 def plot_file(filed_f, filep_f):
-    table_obj = astropy.table.Table.read(filed_f, format="ascii.IDA")
+    table_obj = tesstractor.reader.read_file(filed_f)
 
     with plt.style.context(my_style1):
         fig = plot_table(table_obj)
+        if fig is None:
+            logging.getLogger(__name__).info("%s is empty, not plotted", filed_f)
+            return
         fig.savefig(filep_f)
         plt.close(fig)
 
 
-def plot_table(tab):
-    min_mag = 12
-
-    lat = tab.meta["lat"]
-    lon = tab.meta["lon"]
-    height = tab.meta["height"]
-    timezone = tab.meta["timezone"]
-    location = EarthLocation(lat=lat, lon=lon, height=height)
-    site = astroplan.Observer(
-        location=location, name=tab.meta["location_name"], timezone=timezone
+def site_from_meta(meta):
+    """Observer of the location in the metadata of a IDA file"""
+    location = EarthLocation(lat=meta["lat"], lon=meta["lon"], height=meta["height"])
+    return astroplan.Observer(
+        location=location, name=meta["location_name"], timezone=meta["timezone"]
     )
 
+
+def local_times(tab, site):
     t1 = np.array(
         [pytz.utc.localize(datetime.fromisoformat(value)) for value in tab["time_utc"]]
     )
-    tval_local = np.array([tutc.astimezone(site.timezone) for tutc in t1])
+    return np.array([tutc.astimezone(site.timezone) for tutc in t1])
+
+
+def plot_table(tab):
+    min_mag = 12
+
+    site = site_from_meta(tab.meta)
+    tval_local = local_times(tab, site)
     magval_local = tab["mag"]
 
     # Filter mag values above 12
@@ -258,6 +311,99 @@ def plot_table(tab):
     return fig
 
 
+class NightRenderer:
+    """Plot of a night that can be updated with new data.
+
+    The axes, the Sun and Moon overlays and the formatters are
+    created once, for a fixed window from noon to noon (local time).
+    Each update only replaces the data of the measurements.
+    """
+
+    min_mag = 12
+
+    def __init__(self, meta, first_time):
+        self.key = self.meta_key(meta)
+        self.site = site_from_meta(meta)
+        first_local = first_time.astimezone(self.site.timezone)
+        # The night starts at noon
+        night = (first_local - timedelta(hours=12)).date()
+        noon = self.site.timezone.localize(
+            datetime(year=night.year, month=night.month, day=night.day, hour=12)
+        )
+        ref_day = noon + timedelta(hours=11, minutes=55)
+
+        with plt.style.context(my_style1):
+            self.fig = plt.figure()
+            self.ax = self.fig.add_subplot()
+            self.ax.set_xlim(noon, noon + timedelta(days=1))
+            self.line = self.ax.plot([], [], "+")[0]
+            setup_axes(self.ax, self.site, ref_day, meta)
+
+    @staticmethod
+    def meta_key(meta):
+        """Metadata that defines the static parts of the plot"""
+        keys = ["lat", "lon", "height", "timezone", "device_type", "instrument_id"]
+        return tuple(str(meta.get(key)) for key in keys)
+
+    @classmethod
+    def from_table(cls, tab):
+        """Create a renderer for a table, None if the table is empty"""
+        if len(tab) == 0:
+            return None
+        first = pytz.utc.localize(datetime.fromisoformat(str(tab["time_utc"][0])))
+        return cls(tab.meta, first)
+
+    def update(self, tab):
+        tval_local = local_times(tab, self.site)
+        magval = np.asarray(tab["mag"])
+        mask = magval > self.min_mag
+        self.line.set_data(tval_local[mask], magval[mask])
+        self.ax.relim()
+        self.ax.autoscale_view(scalex=False)
+
+    def save(self, filename):
+        with plt.style.context(my_style1):
+            self.fig.savefig(filename)
+
+    def close(self):
+        plt.close(self.fig)
+
+
+class RendererCache:
+    """Keep the renderers of the most recently plotted files"""
+
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self._renderers = {}
+
+    def plot_file(self, filed_f, filep_f):
+        table_obj = tesstractor.reader.read_file(filed_f)
+        renderer = self._renderers.pop(filed_f, None)
+        if renderer is not None and renderer.key != NightRenderer.meta_key(
+            table_obj.meta
+        ):
+            renderer.close()
+            renderer = None
+        if renderer is None:
+            renderer = NightRenderer.from_table(table_obj)
+            if renderer is None:
+                logging.getLogger(__name__).info("%s is empty, not plotted", filed_f)
+                return
+        renderer.update(table_obj)
+        renderer.save(filep_f)
+
+        # Most recently used at the end
+        self._renderers[filed_f] = renderer
+        while len(self._renderers) > self.maxsize:
+            oldest = next(iter(self._renderers))
+            self._renderers.pop(oldest).close()
+
+    def close(self):
+        for renderer in self._renderers.values():
+            renderer.close()
+        self._renderers = {}
+
+
 def main(args=None):
     # Parse CLI
     parser = argparse.ArgumentParser()
@@ -266,6 +412,23 @@ def main(args=None):
         default="INFO",
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRTICAL", "NOTSET"],
     )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and update the plots when the files in path change",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=5.0,
+        help="wait until a file is unchanged for this time (s) before plotting",
+    )
+    parser.add_argument(
+        "--min-period",
+        type=float,
+        default=60.0,
+        help="minimum time (s) between updates of the same plot",
+    )
     parser.add_argument("path")
     pargs = parser.parse_args(args=args)
 
@@ -275,7 +438,14 @@ def main(args=None):
     logger = logging.getLogger(__name__)
     logger.info("tesstractor-plot, starting")
 
-    if os.path.isdir(pargs.path):
+    if pargs.watch:
+        if not os.path.isdir(pargs.path):
+            parser.error("--watch requires a directory")
+        try:
+            watch_plots(pargs.path, pargs.debounce, pargs.min_period)
+        except KeyboardInterrupt:
+            logger.info("tesstractor-plot, ending")
+    elif os.path.isdir(pargs.path):
         logger.debug("path is dir")
         do_plots_on_dir(pargs.path)
     else:
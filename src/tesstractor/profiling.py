@@ -0,0 +1,226 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Profiling of the running daemon
+
+Two profilers are available:
+
+- sample, a thread takes the stacks of all the threads every
+  interval seconds. The dumps are counts of collapsed stacks,
+  prefixed by the name of the thread, as used by flame graph tools
+- cprofile, a cProfile.Profile in each thread started after the
+  profiler. The dumps are pstats files, one per thread. In Python
+  3.12 and later only one cProfile can be active, so it is replaced
+  by sample
+
+With tracemalloc, a snapshot of the allocated memory is dumped too.
+Nothing is installed if profiling is not enabled.
+"""
+
+import cProfile
+import collections
+import datetime
+import logging
+import marshal
+import os
+import os.path
+import sys
+import threading
+import time
+import tracemalloc
+
+
+_logger = logging.getLogger(__name__)
+
+MODES = ["sample", "cprofile"]
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+    )
+
+
+def collapse_stack(frame):
+    """Stack of frame as 'outer;...;inner'"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class StackSampler:
+    """Sample the stacks of all the threads periodically"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = 0
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="profile_sampler", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {th.ident: th.name for th in threading.enumerate()}
+            frames = sys._current_frames()
+            stacks = [
+                "{};{}".format(names.get(ident, ident), collapse_stack(frame))
+                for ident, frame in frames.items()
+                if ident != own
+            ]
+            with self._lock:
+                self._counts.update(stacks)
+                self.samples += 1
+
+    def dump(self, path):
+        with self._lock:
+            counts = dict(self._counts)
+        with open(path, "w") as fd:
+            for stack, count in sorted(counts.items()):
+                print(stack, count, file=fd)
+        return [path]
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class ThreadProfiler:
+    """A cProfile.Profile in each new thread
+
+    A profile can only be disabled from its own thread, so after
+    stop each thread removes its profile in the next call of the
+    timer
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # thread name -> Profile
+        self._profiles = {}
+        self._stopped = False
+
+    def _timer(self):
+        if self._stopped:
+            sys.setprofile(None)
+        return time.perf_counter_ns()
+
+    def _hook(self, frame, event, arg):
+        # Called once in each new thread, it is replaced by the profile
+        profile = cProfile.Profile(self._timer, 1e-9)
+        name = threading.current_thread().name
+        with self._lock:
+            if name in self._profiles:
+                name = "{}_{}".format(name, threading.get_ident())
+            self._profiles[name] = profile
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self._hook)
+
+    def dump(self, path):
+        base, _ = os.path.splitext(path)
+        paths = []
+        with self._lock:
+            profiles = dict(self._profiles)
+        for name, profile in sorted(profiles.items()):
+            # Like dump_stats, without disabling the profile
+            profile.snapshot_stats()
+            fname = "{}_{}.prof".format(base, name)
+            with open(fname, "wb") as fd:
+                marshal.dump(profile.stats, fd)
+            paths.append(fname)
+        return paths
+
+    def stop(self):
+        threading.setprofile(None)
+        self._stopped = True
+
+
+class Profiler:
+    """Profiling and memory snapshots, dumped in outdir"""
+
+    def __init__(
+        self, outdir, mode=None, interval=0.01, tracemalloc_frames=0, period=0
+    ):
+        if mode not in MODES + [None]:
+            raise ValueError("unknown profiling mode {}".format(mode))
+        if mode == "cprofile" and sys.version_info >= (3, 12):
+            _logger.warning("one cProfile per thread needs Python < 3.12, sampling")
+            mode = "sample"
+        self.outdir = outdir
+        self.mode = mode
+        self.tracemalloc_frames = tracemalloc_frames
+        self.period = period
+        if mode == "sample":
+            self._profiler = StackSampler(interval)
+        elif mode == "cprofile":
+            self._profiler = ThreadProfiler()
+        else:
+            self._profiler = None
+        self._next_dump = None
+
+    @property
+    def enabled(self):
+        return self._profiler is not None or self.tracemalloc_frames > 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.outdir, exist_ok=True)
+        if self._profiler is not None:
+            _logger.info("starting %s profiler", self.mode)
+            self._profiler.start()
+        if self.tracemalloc_frames > 0:
+            _logger.info("tracing memory allocations")
+            tracemalloc.start(self.tracemalloc_frames)
+        if self.period > 0:
+            self._next_dump = time.monotonic() + self.period
+
+    def due(self):
+        """A scheduled dump is due"""
+        return self._next_dump is not None and time.monotonic() >= self._next_dump
+
+    def dump(self):
+        """Write the profiles and the memory snapshot, return the file names"""
+        if not self.enabled:
+            return []
+        if self._next_dump is not None:
+            self._next_dump = time.monotonic() + self.period
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        paths = []
+        if self._profiler is not None:
+            ext = "folded" if self.mode == "sample" else "prof"
+            path = os.path.join(self.outdir, "profile_{}.{}".format(stamp, ext))
+            paths.extend(self._profiler.dump(path))
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            path = os.path.join(self.outdir, "memory_{}.snap".format(stamp))
+            snapshot.dump(path)
+            paths.append(path)
+            for stat in snapshot.statistics("lineno")[:5]:
+                _logger.info("memory: %s", stat)
+        _logger.info("profile written to %s", ", ".join(paths))
+        return paths
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
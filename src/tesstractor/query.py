@@ -0,0 +1,152 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Query IDA files over a time range"""
+
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import os.path
+import sys
+import warnings
+
+import astropy.table
+import pytz
+
+import tesstractor.reader
+import tesstractor.writef as writef
+
+
+_logger = logging.getLogger(__name__)
+
+# File names use local time, UTC offsets are within +/-14 hours
+_MAX_UTC_OFFSET = datetime.timedelta(hours=14)
+
+# Header entries that must agree in all the files
+_CONSISTENT_META = ["device_type", "instrument_id"]
+
+
+def parse_time(value):
+    """Parse a ISO time, naive times are UTC"""
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return dt
+
+
+def find_files(dirname, name, start, end):
+    """IDA files of a device that may contain data between start and end (UTC)"""
+    rot = writef.TimedDailyRotator(when=datetime.time(hour=12, minute=0, second=0))
+    selected = []
+    for fname, dt in writef.list_files(dirname, name):
+        file_start = dt - _MAX_UTC_OFFSET
+        file_end = rot.in_interval(dt).max_val + _MAX_UTC_OFFSET
+        if file_start < end and file_end > start:
+            selected.append(os.path.join(dirname, fname))
+    return selected
+
+
+def read_range(path, start, end):
+    """Read the rows of a file between start and end (UTC)"""
+    table_obj = tesstractor.reader.read_file(path)
+    # ISO strings of fixed length compare as times
+    start_str = start.isoformat("T", timespec="milliseconds")
+    end_str = end.isoformat("T", timespec="milliseconds")
+    time_utc = table_obj["time_utc"]
+    mask = (time_utc >= start_str) & (time_utc < end_str)
+    return table_obj[mask]
+
+
+def empty_table():
+    dtypes = [str, str, float, float, float, float, float]
+    return astropy.table.Table(names=tesstractor.reader.IDA_COLUMNS, dtype=dtypes)
+
+
+def query_range(dirname, name, start, end, jobs=None):
+    """Read the data of a device between start and end (UTC) in one table.
+
+    The files are read in parallel with up to jobs processes.
+    The metadata is the header of the first file, the names
+    of the files read are in meta['files']
+    """
+    paths = find_files(dirname, name, start, end)
+    _logger.debug("reading %d files", len(paths))
+    if jobs == 1 or len(paths) <= 1:
+        tables = [read_range(path, start, end) for path in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            tables = list(
+                executor.map(
+                    read_range,
+                    paths,
+                    [start] * len(paths),
+                    [end] * len(paths),
+                )
+            )
+
+    used = [(path, tab) for path, tab in zip(paths, tables) if len(tab) > 0]
+    if not used:
+        result = empty_table()
+        result.meta["files"] = []
+        return result
+
+    meta = dict(used[0][1].meta)
+    for path, tab in used[1:]:
+        for key in _CONSISTENT_META:
+            if tab.meta.get(key) != meta.get(key):
+                msg = "{} of {} is {}, expected {}".format(
+                    key, path, tab.meta.get(key), meta.get(key)
+                )
+                warnings.warn(msg, RuntimeWarning)
+
+    result = astropy.table.vstack([tab for _, tab in used], metadata_conflicts="silent")
+    result.meta = meta
+    result.meta["files"] = [os.path.basename(path) for path, _ in used]
+    return result
+
+
+def main(args=None):
+    # Parse CLI
+    parser = argparse.ArgumentParser(description="Query IDA files over a time range")
+    parser.add_argument("--device", required=True, help="name of the device")
+    parser.add_argument(
+        "--from", dest="time_from", required=True, type=parse_time, help="ISO time"
+    )
+    parser.add_argument(
+        "--to", dest="time_to", required=True, type=parse_time, help="ISO time"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("-o", "--output", help="output file, default is stdout")
+    parser.add_argument("--format", default="ascii.csv", help="astropy table format")
+    parser.add_argument(
+        "--log",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRTICAL", "NOTSET"],
+    )
+    parser.add_argument("dirname")
+    pargs = parser.parse_args(args=args)
+
+    loglevel = getattr(logging, pargs.log.upper())
+    logging.basicConfig(level=loglevel)
+
+    result = query_range(
+        pargs.dirname, pargs.device, pargs.time_from, pargs.time_to, pargs.jobs
+    )
+    _logger.info("%d rows from %d files", len(result), len(result.meta["files"]))
+    # Only scalar metadata can be written
+    result.meta = {k: str(v) for k, v in result.meta.items()}
+    if pargs.output:
+        result.write(pargs.output, format=pargs.format, overwrite=True)
+    else:
+        result.write(sys.stdout, format=pargs.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,12 +10,16 @@
 
 import re
 import argparse
+import lzma
+import zlib
 
 # from astropy.io import registry
 import astropy.table
 import astropy.io.ascii
 import astropy.units as u
 
+from tesstractor.writef import compression_from_filename
+
 
 def meta_as_type(key, conv):
     """Convert entries in file header"""
@@ -43,6 +47,9 @@ def remove_quotes(value):
     return value
 
 
+# Columns of the data
+IDA_COLUMNS = ["time_utc", "time_local", "temp", "sky_temp", "freq", "mag", "zp"]
+
 # Entries in the header that are read
 _header_entries = {
     "device_type": meta_as_type("device_type", str),
@@ -109,7 +116,7 @@ class IDAHeader(astropy.io.ascii.basic.BasicHeader):
 
         # self.names = next(self.splitter([line]))
         # This could come from the last but one line in the header
-        self.names = ["time_utc", "time_local", "temp", "sky_temp", "freq", "mag", "zp"]
+        self.names = list(IDA_COLUMNS)
         self._set_cols_from_names()
 
 
@@ -144,9 +151,44 @@ class IDAReader(astropy.io.ascii.BaseReader):
         raise NotImplementedError
 
 
+def _decompress(data, decompressor_factory):
+    """Decompress concatenated streams, the last one can be truncated"""
+    chunks = []
+    while data:
+        decompressor = decompressor_factory()
+        chunks.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            # Truncated stream, keep what could be decompressed
+            break
+        data = decompressor.unused_data
+    return b"".join(chunks)
+
+
+def read_text(filed_f):
+    """Read the contents of a IDA file, plain or compressed.
+
+    A compressed file truncated by a crash is read
+    up to the last complete line
+    """
+    compression = compression_from_filename(str(filed_f))
+    if compression is None:
+        with open(filed_f) as fd:
+            return fd.read()
+
+    with open(filed_f, "rb") as fd:
+        data = fd.read()
+    if compression == "gzip":
+        raw = _decompress(data, lambda: zlib.decompressobj(wbits=31))
+    else:
+        raw = _decompress(data, lzma.LZMADecompressor)
+    text = raw.decode("utf-8", errors="replace")
+    # Remove a partial line
+    return text[: text.rfind("\n") + 1]
+
+
 def read_file(filed_f):
 
-    table_obj = astropy.table.Table.read(filed_f, format="ascii.IDA")
+    table_obj = astropy.table.Table.read(read_text(filed_f), format="ascii.IDA")
     return table_obj
 
 
@@ -0,0 +1,158 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Replay measurements recorded in IDA files"""
+
+import datetime
+import glob
+import logging
+import os.path
+import time
+
+from .device import Device, PhotometerConf
+from .timeutil import datetime_to_ns, now_ns, set_tstamp
+import tesstractor.reader
+import tesstractor.writef
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ReplayConf(PhotometerConf):
+    pass
+
+
+def expand_paths(path):
+    """Expand a directory, a file or a glob pattern into a sorted list of files"""
+    if os.path.isdir(path):
+        path = os.path.join(path, "*.dat*")
+        paths = glob.glob(path)
+        paths = [p for p in paths if p.endswith(tesstractor.writef.IDA_SUFFIXES)]
+    else:
+        paths = glob.glob(path)
+    return sorted(paths)
+
+
+class ReplayDevice(Device):
+    """Device that reads its measurements from IDA files
+
+    The rows are returned by read_data as measurement records,
+    paced with the recorded time stamps. With speed=N the data
+    is replayed N times faster than real time, with speed=0
+    the rows are returned as fast as possible.
+
+    If retime is True, the time stamps are shifted so that the
+    first row happens when the replay starts.
+    """
+
+    def __init__(self, paths, name="replay", speed=1.0, retime=False):
+        super().__init__(name=name, model="REPLAY")
+        self.paths = list(paths)
+        self.speed = speed
+        self.retime = retime
+        self.mac = "00:00:00:00:00:00"
+        self.firmware = 0
+
+        self._rows = None
+        self._next_row = None
+        self._t0 = None
+        self._wall0 = None
+        self._utc0 = None
+
+    def static_conf(self):
+        conf = ReplayConf()
+        conf.name = self.name
+        conf.model = self.model
+        conf.serial_number = self.serial_number
+        conf.firmware = self.firmware
+        conf.zero_point = self.calibration
+        conf.mac_address = self.mac
+        return conf
+
+    def register_id(self):
+        return self.mac
+
+    def start_connection(self):
+        """Read the first file and its header"""
+        if not self.paths:
+            raise ValueError("no files to replay")
+
+        self._rows = self._iter_rows()
+        # Reading the first row loads the metadata of the first file
+        self._next_row = next(self._rows, None)
+        self._t0 = None
+
+    def close_connection(self):
+        self._rows = None
+        self._next_row = None
+
+    def _iter_rows(self):
+        for path in self.paths:
+            _logger.debug("replaying %s", path)
+            table_obj = tesstractor.reader.read_file(path)
+            self._update_meta(table_obj.meta)
+            for row in table_obj:
+                yield row
+
+    def _update_meta(self, meta):
+        device_type = meta.get("device_type")
+        if device_type in tesstractor.writef.IDA_TMPL:
+            self.model = device_type
+        instrument_id = meta.get("instrument_id")
+        if instrument_id:
+            self.serial_number = instrument_id
+
+    def _pace(self, tstamp):
+        """Sleep until the replayed time stamp is due, return it in ns"""
+        if self._t0 is None:
+            self._t0 = tstamp
+            self._wall0 = time.monotonic()
+            self._utc0 = now_ns()
+
+        elapsed = (tstamp - self._t0).total_seconds()
+        if self.speed > 0:
+            elapsed = elapsed / self.speed
+            delay = self._wall0 + elapsed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if self.retime:
+            return self._utc0 + int(elapsed * 10**9)
+        else:
+            return datetime_to_ns(tstamp)
+
+    def process_msg(self, row) -> dict:
+        """Convert a row of a IDA file to unified format"""
+        tstamp = datetime.datetime.fromisoformat(str(row["time_utc"]))
+        result = dict()
+        result["name"] = self.name
+        result["model"] = self.model
+        result["cmd"] = "r"
+        result["magnitude"] = float(row["mag"])
+        result["freq_sensor"] = float(row["freq"])
+        result["temp_ambient"] = float(row["temp"])
+        result["temp_sky"] = float(row["sky_temp"])
+        result["zero_point"] = float(row["zp"])
+        result["valid"] = True
+        set_tstamp(result, self._pace(tstamp))
+        self.calibration = result["zero_point"]
+        return result
+
+    def read_data(self, tries=1):
+        """Return the next recorded row.
+
+        Raises EOFError when all the files have been replayed
+        """
+        if self._rows is None:
+            self.start_connection()
+        row = self._next_row
+        if row is None:
+            raise EOFError("end of replayed data")
+        self._next_row = next(self._rows, None)
+        return self.process_msg(row)
@@ -0,0 +1,352 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Rebuild IDA files from raw captures"""
+
+import argparse
+import concurrent.futures
+import configparser
+import datetime
+import json
+import logging
+import os
+import os.path
+
+import pytz
+
+import tesstractor.capture as capture
+import tesstractor.cli as cli
+import tesstractor.sqm as sqm
+import tesstractor.tess as tess
+import tesstractor.writef as writef
+from tesstractor.timeutil import datetime_to_ns, ns_to_datetime, payload_ns, set_tstamp
+from tesstractor.workers import avg_device_buffer
+
+
+_logger = logging.getLogger(__name__)
+
+# Number of previous days searched for the
+# metadata and calibration of SQM devices
+_HANDSHAKE_DAYS = 60
+
+
+class _NullConn:
+    """Stand-in for a serial connection, devices are only used to parse"""
+
+    is_open = False
+
+    def readline(self):
+        return b""
+
+    def write(self, cmd):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def build_offline_dev(section):
+    """Create a Device without connection from the configuration"""
+    model = section.get("model", "SQM-TEST")
+    name = cli.device_name_from_ini(section)
+    conn = _NullConn()
+    if model == "SQM-LU":
+        photo_dev = sqm.SQMLU(conn, name)
+    elif model in ["TESS-R", "TESS", "TESS-U"]:
+        photo_dev = tess.TessR(conn, name)
+        photo_dev.calibration = section.getfloat("zero_point", 20.0)
+    elif model in ["TESSv2"]:
+        photo_dev = tess.TessV2(conn, name)
+        photo_dev.calibration = section.getfloat("zero_point", 20.0)
+    else:
+        raise ValueError("model {} can't be reprocessed".format(model))
+
+    mac = section.get("mac")
+    if mac:
+        photo_dev.mac = mac
+    return photo_dev
+
+
+def parse_line(photo_dev, msg):
+    """Run the parser of the device on a raw line.
+
+    Returns a payload for measurements, None otherwise
+    """
+    if isinstance(photo_dev, tess.TessV2):
+        try:
+            res = json.loads(msg)
+        except ValueError:
+            return None
+        if res and isinstance(res, dict):
+            return photo_dev.process_msg(res)
+        return None
+    elif isinstance(photo_dev, tess.Tess):
+        match = tess.MEASURE_RE.match(msg)
+        if match:
+            return photo_dev.process_msg(match)
+        return None
+    elif isinstance(photo_dev, sqm.SQM):
+        match = sqm.MEASURE_RE.match(msg)
+        if match:
+            pmsg = photo_dev.process_msg(match)
+            if pmsg["magnitude"] < 0:
+                return None
+            return pmsg
+        match = sqm.META_RE.match(msg)
+        if match:
+            photo_dev.process_metadata(match)
+            return None
+        match = sqm.CALIB_RE.match(msg)
+        if match:
+            photo_dev.process_calibration(match)
+        return None
+    else:
+        raise TypeError("unsupported device {}".format(photo_dev))
+
+
+def read_handshake(photo_dev, capture_dir, capture_name, before):
+    """Recover the metadata and calibration of a SQM from previous captures"""
+    files = [
+        path
+        for day, path in capture.capture_files(capture_dir, capture_name)
+        if before.date() - datetime.timedelta(days=_HANDSHAKE_DAYS)
+        <= day
+        <= before.date()
+    ]
+    end_ns = datetime_to_ns(before)
+    meta = calib = None
+    # Newest file first; in a file, the last answer is the good one
+    for path in reversed(files):
+        file_meta = file_calib = None
+        for _, msg in capture.read_capture(path, end_ns=end_ns):
+            if sqm.META_RE.match(msg):
+                file_meta = msg
+            elif sqm.CALIB_RE.match(msg):
+                file_calib = msg
+        meta = meta or file_meta
+        calib = calib or file_calib
+        if meta is not None and calib is not None:
+            break
+    for msg in [meta, calib]:
+        if msg is not None:
+            parse_line(photo_dev, msg)
+
+
+def night_limits(night, tz):
+    """Limits in UTC of the night starting at noon of a date"""
+    rot = writef.TimedDailyRotator(when=datetime.time(hour=12, minute=0, second=0))
+    valid_inter = rot.in_interval(
+        datetime.datetime.combine(night, datetime.time(hour=12))
+    )
+    limits = []
+    for dt in [valid_inter.min_val, valid_inter.max_val]:
+        dt_utc = tz.localize(dt).astimezone(pytz.utc).replace(tzinfo=None)
+        limits.append(dt_utc)
+    return limits
+
+
+def aggregate(payloads, nsamples, interval):
+    """Average the payloads as the reader and the periodic buffer do"""
+    if nsamples > 1:
+        samples = []
+        for idx in range(0, len(payloads) - nsamples + 1, nsamples):
+            samples.append(avg_device_buffer(payloads[idx : idx + nsamples]))
+    else:
+        samples = payloads
+
+    interval_ns = int(interval * 10**9)
+    results = []
+    window = []
+    window_idx = None
+    for payload in samples:
+        this_idx = payload_ns(payload) // interval_ns
+        if window and this_idx != window_idx:
+            results.append(avg_device_buffer(window))
+            window = []
+        window_idx = this_idx
+        window.append(payload)
+    if window:
+        results.append(avg_device_buffer(window))
+
+    return [result for result in results if result["valid"]]
+
+
+def reprocess_night(
+    night, config_path, secname, capture_dir, dirname, interval, overwrite
+):
+    """Rebuild the IDA file of one night.
+
+    Returns the name of the file or None
+    """
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(cli.ini_defaults)
+    cparser.read(config_path)
+    section = cparser[secname]
+    loc_conf = cli.build_location_from_ini(cparser)
+    loc_tz = pytz.timezone(loc_conf.timezone)
+    readerconf = cli.readerconf_from_ini(section)
+
+    photo_dev = build_offline_dev(section)
+    capture_name = cli.capture_name_from_ini(section)
+    start, end = night_limits(night, loc_tz)
+
+    if isinstance(photo_dev, sqm.SQM):
+        read_handshake(photo_dev, capture_dir, capture_name, start)
+
+    payloads = []
+    for tstamp_ns, msg in capture.iter_capture(capture_dir, capture_name, start, end):
+        pmsg = parse_line(photo_dev, msg)
+        if pmsg is None:
+            continue
+        set_tstamp(pmsg, tstamp_ns)
+        pmsg["localtz"] = loc_tz
+        payloads.append(pmsg)
+
+    results = aggregate(payloads, readerconf["nsamples"], interval)
+    if not results:
+        return None
+
+    insconf = photo_dev.static_conf()
+    rot = writef.TimedDailyRotator(when=datetime.time(hour=12, minute=0, second=0))
+    for result in results:
+        writef.update_p(result)
+    first_local = ns_to_datetime(results[0]["tstamp_local_ns"])
+    valid_inter = rot.in_interval(first_local)
+    create, old_fname = writef.startup(valid_inter, insconf.name, dirname)
+    if not create:
+        if not overwrite:
+            _logger.info("%s already exists, skipping", old_fname)
+            return None
+        os.remove(os.path.join(dirname, old_fname))
+
+    fname = writef.calc_filename(first_local, name=insconf.name)
+    writef.init_file(os.path.join(dirname, fname), insconf, loc_conf)
+    for result in results:
+        writef.write_to_file(result, dirname, fname)
+    return fname
+
+
+def capture_nights(capture_dir, capture_name):
+    """Nights with captured data"""
+    nights = set()
+    for day, path in capture.capture_files(capture_dir, capture_name):
+        nights.add(day - datetime.timedelta(days=1))
+        nights.add(day)
+    return sorted(nights)
+
+
+def main(args=None):
+    # Parse CLI
+    parser = argparse.ArgumentParser(description="Rebuild IDA files from raw captures")
+    parser.add_argument("-c", "--config", required=True)
+    parser.add_argument(
+        "--device", help="photometer section or device name, default is the first one"
+    )
+    parser.add_argument("--capture-dir", help="default is capture_dir of the device")
+    parser.add_argument("--dirname", required=True, help="output directory")
+    parser.add_argument(
+        "--from",
+        dest="date_from",
+        type=datetime.date.fromisoformat,
+        help="first night, YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "--to",
+        dest="date_to",
+        type=datetime.date.fromisoformat,
+        help="last night, YYYY-MM-DD",
+    )
+    parser.add_argument("--interval", type=float, help="averaging interval (s)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument(
+        "--log",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRTICAL", "NOTSET"],
+    )
+    pargs = parser.parse_args(args=args)
+
+    loglevel = getattr(logging, pargs.log.upper())
+
+    logging.basicConfig(level=loglevel)
+    logger = logging.getLogger(__name__)
+    logger.info("tesstractor-reprocess, starting")
+
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(cli.ini_defaults)
+    cparser.read(pargs.config)
+
+    photo_sections = [sec for sec in cparser.sections() if sec.startswith("photometer")]
+    if pargs.device:
+        photo_sections = [
+            sec
+            for sec in photo_sections
+            if pargs.device in [sec, cparser[sec].get("name")]
+        ]
+    if not photo_sections:
+        logger.error("No device found in configuration")
+        return 1
+    secname = photo_sections[0]
+    section = cparser[secname]
+
+    capture_dir = pargs.capture_dir or section.get("capture_dir")
+    if not capture_dir:
+        logger.error("No capture directory")
+        return 1
+    capture_name = cli.capture_name_from_ini(section)
+
+    interval = pargs.interval
+    if interval is None:
+        file_sections = [sec for sec in cparser.sections() if sec.startswith("file")]
+        if file_sections:
+            interval = cparser[file_sections[0]].getfloat("interval", 300.0)
+        else:
+            interval = 300.0
+
+    nights = capture_nights(capture_dir, capture_name)
+    if pargs.date_from:
+        nights = [night for night in nights if night >= pargs.date_from]
+    if pargs.date_to:
+        nights = [night for night in nights if night <= pargs.date_to]
+    logger.info("reprocessing %d nights of %s", len(nights), capture_name)
+
+    os.makedirs(pargs.dirname, exist_ok=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=pargs.jobs) as executor:
+        futures = {
+            executor.submit(
+                reprocess_night,
+                night,
+                pargs.config,
+                secname,
+                capture_dir,
+                pargs.dirname,
+                interval,
+                pargs.overwrite,
+            ): night
+            for night in nights
+        }
+        for future in concurrent.futures.as_completed(futures):
+            night = futures[future]
+            try:
+                fname = future.result()
+            except Exception:
+                logger.exception("reprocessing night %s", night)
+                continue
+            if fname:
+                logger.info("night %s written to %s", night, fname)
+            else:
+                logger.debug("night %s, nothing written", night)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,10 @@
 import logging
 import time
 import re
-import datetime
 
 
 from .device import Device, PhotometerConf
-
+from .timeutil import set_tstamp
 
 MEASURE_RE = re.compile(
     rb"""
@@ -122,8 +121,7 @@ class SQM(Device):
         result["valid"] = True
         # Add time information
         # Complete the payload with tstamp
-        now = datetime.datetime.utcnow()
-        result["tstamp"] = now
+        set_tstamp(result, self.receive_ns())
         return result
 
     def process_calibration(self, match):
@@ -169,8 +167,8 @@ class SQM(Device):
             else:
                 logger.warning("malformed metadata, try again")
                 this_try += 1
-                time.sleep(self.cmd_wait)
-                self.reset_device()
+                self.resync(flush_input=True)
+                self.pass_command(cmd)
                 time.sleep(self.cmd_wait)
 
         logger.error("reading metadata after %d tries", tries)
@@ -199,8 +197,8 @@ class SQM(Device):
             else:
                 logger.warning("malformed calibration, try again")
                 this_try += 1
-                time.sleep(self.cmd_wait)
-                self.reset_device()
+                self.resync(flush_input=True)
+                self.pass_command(cmd)
                 time.sleep(self.cmd_wait)
 
         logger.error("reading calibration after %d tries", tries)
@@ -236,8 +234,8 @@ class SQM(Device):
                 logger.warning("malformed data, try again")
                 logger.debug("data is %s", msg)
                 this_try += 1
-                time.sleep(self.cmd_wait)
-                self.reset_device()
+                self.resync(flush_input=True)
+                self.pass_command(cmd)
                 time.sleep(self.cmd_wait)
 
         logger.error("reading data after %d tries", tries)
@@ -253,13 +251,15 @@ class SQM(Device):
 class SQMLU(SQM):
     def __init__(self, conn, name="", sleep_time=1, tries=10):
         super().__init__(name=name, model="SQM-LU")
-        self.serial = conn
+        self.transport = conn
         # Clearing buffer
         self.read_msg()
 
     def start_connection(self):
         """Start photometer connection"""
         _logger.debug("start connection")
+        if not self.transport.is_open:
+            self.transport.open()
         time.sleep(self.cmd_wait)
         self.read_metadata(tries=10)
         time.sleep(self.cmd_wait)
@@ -275,15 +275,61 @@ class SQMLU(SQM):
         while answer:
             answer = self.read_msg()
 
-        self.serial.close()
+        self.transport.close()
 
     def read_msg(self):
         """Read the data"""
-        msg = self.serial.readline()
+        msg = self.transport.readline()
         return msg
 
     def pass_command(self, cmd):
-        self.serial.write(cmd)
+        self.transport.write(cmd)
+
+
+class SQMLE(SQM):
+    """SQM-LE, the protocol of the SQM-LU over a TCP transport
+
+    The transport waits for the answers, so there is no cmd_wait.
+    The first commands are sent in one go
+    """
+
+    def __init__(self, conn, name=""):
+        super().__init__(name=name, model="SQM-LE")
+        self.transport = conn
+        self.cmd_wait = 0
+
+    def start_connection(self):
+        """Start photometer connection"""
+        _logger.debug("start connection")
+        if not self.transport.is_open:
+            self.transport.open()
+        self.transport.reset_input_buffer()
+        self.pass_command(b"ixcxrx")
+        try:
+            self.process_metadata(META_RE.match(self.read_msg()))
+            self.process_calibration(CALIB_RE.match(self.read_msg()))
+            match = MEASURE_RE.match(self.read_msg())
+            if not match:
+                raise ValueError("process_msg")
+            self.process_msg(match)
+        except ValueError:
+            _logger.warning("malformed answers, reading them one by one")
+            self.transport.reset_input_buffer()
+            self.read_metadata(tries=10)
+            self.read_calibration(tries=10)
+            self.read_data(tries=10)
+
+    def close_connection(self):
+        """End photometer connection"""
+        _logger.debug("close connection")
+        self.transport.close()
+
+    def read_msg(self):
+        """Read the data"""
+        return self.transport.readline()
+
+    def pass_command(self, cmd):
+        self.transport.write(cmd)
 
 
 class SQMTest(SQM):
@@ -0,0 +1,138 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Summary statistics of a night, computed while the data is written"""
+
+import datetime
+import json
+import logging
+import math
+import os.path
+
+import numpy
+
+
+_logger = logging.getLogger(__name__)
+
+# Altitude of the Sun at the limit of the astronomical night
+ASTRONOMICAL_TWILIGHT = -18.0
+
+
+def sun_altitude(dt, latitude, longitude):
+    """Approximate altitude of the Sun in degrees, for a naive UTC datetime.
+
+    The precision (about 0.1 deg) is enough to classify samples
+    """
+    d = (dt - datetime.datetime(2000, 1, 1, 12)).total_seconds() / 86400.0
+    g = math.radians(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    ecl_lon = math.radians(q + 1.915 * math.sin(g) + 0.020 * math.sin(2 * g))
+    obliquity = math.radians(23.439 - 0.00000036 * d)
+    ra = math.atan2(math.cos(obliquity) * math.sin(ecl_lon), math.cos(ecl_lon))
+    dec = math.asin(math.sin(obliquity) * math.sin(ecl_lon))
+    gmst = 18.697374558 + 24.06570982441908 * d
+    hour_angle = math.radians(gmst * 15.0 + longitude) - ra
+    lat = math.radians(latitude)
+    sin_alt = math.sin(lat) * math.sin(dec) + math.cos(lat) * math.cos(dec) * math.cos(
+        hour_angle
+    )
+    return math.degrees(math.asin(sin_alt))
+
+
+def summary_filename(name):
+    return f"{name}_summary.jsonl"
+
+
+class NightSummary:
+    """Running statistics of the measurements written to a file.
+
+    An interval between samples longer than max_gap seconds
+    is counted as a gap
+    """
+
+    def __init__(self, filename, latitude=0.0, longitude=0.0, max_gap=600.0):
+        self.filename = filename
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.max_gap = datetime.timedelta(seconds=max_gap)
+
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.darkest_mag = None
+        self.darkest_time = None
+        self.astro_mags = []
+        self.gaps = 0
+        self.gap_total = datetime.timedelta(0)
+        self.gap_longest = datetime.timedelta(0)
+
+    def add(self, tstamp, magnitude):
+        """Add a measurement, tstamp is a naive UTC datetime"""
+        self.count += 1
+        if self.first is None:
+            self.first = tstamp
+        if self.last is not None:
+            delta = tstamp - self.last
+            if delta > self.max_gap:
+                self.gaps += 1
+                self.gap_total += delta
+                self.gap_longest = max(self.gap_longest, delta)
+        self.last = tstamp
+
+        if self.darkest_mag is None or magnitude > self.darkest_mag:
+            self.darkest_mag = magnitude
+            self.darkest_time = tstamp
+
+        altitude = sun_altitude(tstamp, self.latitude, self.longitude)
+        if altitude < ASTRONOMICAL_TWILIGHT:
+            self.astro_mags.append(magnitude)
+
+    def add_from_file(self, path):
+        """Add the measurements already written in a file"""
+        # imported here, astropy is only needed on restart
+        import tesstractor.reader
+
+        table_obj = tesstractor.reader.read_file(path)
+        for time_utc, mag in zip(table_obj["time_utc"], table_obj["mag"]):
+            self.add(datetime.datetime.fromisoformat(str(time_utc)), float(mag))
+
+    def record(self):
+        """Summary of the night, as a dict"""
+
+        def iso(dt):
+            return None if dt is None else dt.isoformat("T", timespec="seconds")
+
+        if self.astro_mags:
+            astro_median = float(numpy.median(self.astro_mags))
+        else:
+            astro_median = None
+
+        return dict(
+            file=self.filename,
+            first=iso(self.first),
+            last=iso(self.last),
+            count=self.count,
+            darkest_mag=self.darkest_mag,
+            darkest_time=iso(self.darkest_time),
+            astro_count=len(self.astro_mags),
+            astro_median_mag=astro_median,
+            gaps=self.gaps,
+            gap_total_s=self.gap_total.total_seconds(),
+            gap_longest_s=self.gap_longest.total_seconds(),
+        )
+
+
+def write_summary(dirname, name, summary: NightSummary):
+    """Append the summary of a night, one JSON line per night"""
+    path = os.path.join(dirname, summary_filename(name))
+    try:
+        with open(path, "a") as fd:
+            print(json.dumps(summary.record()), file=fd)
+    except OSError:
+        _logger.exception("writing summary %s", path)
@@ -9,15 +9,14 @@
 
 
 import logging
-import time
 import re
 import math
-import datetime
 import json
 import typing
 import warnings
 
 from .device import Device, PhotometerConf
+from .timeutil import payload_ns, set_tstamp
 
 
 MEASURE_RE = re.compile(
@@ -95,7 +94,10 @@ class Tess(Device):
         result["name"] = self.name
         result["model"] = "TESS"
         result["freq_sensor"] = 0.0
+        result["zero_point"] = self.calibration
         result["valid"] = False
+        # Add time information
+        set_tstamp(result, self.receive_ns())
 
         if re_m["freq_pref"] is None:
             return result
@@ -186,9 +188,7 @@ class Tess(Device):
             result["magnitude"] = self.calibration - 2.5 * math.log10(result["freq"])
 
         # average times
-        ts0 = payloads[0]["tstamp"]
-        ts = [(p["tstamp"] - ts0) for p in payloads]
-        result["tstamp"] = ts0 + sum(ts, datetime.timedelta(0)) / npayloads
+        set_tstamp(result, sum(payload_ns(p) for p in payloads) // npayloads)
         return result
 
     def process_calibration(self, match):
@@ -260,9 +260,7 @@ class Tess(Device):
                 logger.warning("malformed data, ignoring %s", msg)
                 logger.debug("data is %s", msg)
                 this_try += 1
-                time.sleep(self.cmd_wait)
-                self.reset_device()
-                time.sleep(self.cmd_wait)
+                self.resync()
                 return None
 
         msg = "reading data after {} tries".format(tries)
@@ -279,15 +277,15 @@ class Tess(Device):
 class TessR(Tess):
     def __init__(self, conn, name="tess", sleep_time=1, tries=10):
         super().__init__(name=name, model="TESS-R")
-        self.serial = conn
+        self.transport = conn
         # Clearing buffer
         self.read_msg()
 
     def start_connection(self):
         """Start photometer connection"""
         _logger.debug("start connection")
-        if not self.serial.is_open:
-            self.serial.open()
+        if not self.transport.is_open:
+            self.transport.open()
 
         self.read_metadata(tries=10)
         self.read_calibration(tries=10)
@@ -297,15 +295,15 @@ class TessR(Tess):
         """End photometer connection"""
         # Check until there is no answer from device
         _logger.debug("close connection")
-        self.serial.close()
+        self.transport.close()
 
     def read_msg(self):
         """Read the data"""
-        msg = self.serial.readline()
+        msg = self.transport.readline()
         return msg
 
     def pass_command(self, cmd):
-        self.serial.write(cmd)
+        self.transport.write(cmd)
 
 
 class TessV2(Tess):
@@ -331,18 +329,18 @@ class TessV2(Tess):
 
     def __init__(self, conn, name="tess", sleep_time=1, tries=10):
         super().__init__(name=name, model="TESSv2")
-        self.serial = conn
+        self.transport = conn
         # Clearing buffer
         self.read_msg()
 
     def close_connection(self):
         """End photometer connection"""
         _logger.debug("close connection")
-        self.serial.close()
+        self.transport.close()
 
     def read_msg(self):
         """Read messages from the photometer"""
-        msg = self.serial.readline()
+        msg = self.transport.readline()
         return msg
 
     def pass_command(self, cmd):
@@ -422,6 +420,5 @@ class TessV2(Tess):
 
         # Add time information
         # Complete the payload with tstamp and TZ
-        now = datetime.datetime.utcnow()
-        payload["tstamp"] = now
+        set_tstamp(payload, self.receive_ns())
         return payload
@@ -0,0 +1,31 @@
+import datetime
+
+import pytest
+import pytz
+
+from ..cli import LocationConf
+from ..sqm import SQMTest
+from ..writef import init_file, write_to_file
+
+
+@pytest.fixture
+def ida_dir(tmp_path):
+    insconf = SQMTest().static_conf()
+    insconf.model = "SQM-LU"
+    insconf.serial_number = 2142
+    fname = "20240101_120000_sqmtest.dat"
+    init_file(tmp_path / fname, insconf, LocationConf())
+    t0 = datetime.datetime(2024, 1, 1, 20, 0, 0)
+    for i in range(5):
+        payload = dict(
+            cmd="r",
+            tstamp=t0 + datetime.timedelta(seconds=60 * i),
+            tstamp_local=pytz.utc.localize(t0 + datetime.timedelta(seconds=60 * i)),
+            temp_ambient=10.0,
+            temp_sky=-5.0,
+            freq_sensor=2.5 + i,
+            magnitude=19.0 + 0.1 * i,
+            zero_point=19.84,
+        )
+        write_to_file(payload, tmp_path, fname)
+    return tmp_path
@@ -0,0 +1,113 @@
+import queue
+import threading
+
+from ..bus import Bus
+from ..workers import periodic_avg
+
+
+def payload(cmd, name, seq=0):
+    return dict(cmd=cmd, name=name, seq=seq)
+
+
+def test_bus_filters():
+    bus = Bus()
+    all_sub = bus.subscribe()
+    dev_sub = bus.subscribe(kinds=["r"], device="dev1")
+
+    msgs = [
+        payload("id", "dev1"),
+        payload("r", "dev1", 1),
+        payload("r", "dev2", 1),
+        payload("r", "dev1", 2),
+    ]
+    for msg in msgs:
+        bus.publish(msg)
+
+    # Delivered in one batch, by reference
+    batch = all_sub.get_batch(timeout=0)
+    assert len(batch) == 4
+    assert all(a is b for a, b in zip(batch, msgs))
+    assert dev_sub.get_batch(timeout=0) == [msgs[1], msgs[3]]
+    # Read by all the subscriptions
+    assert bus._log == []
+    assert all_sub.get_batch(timeout=0) == []
+
+
+def test_bus_cursors():
+    bus = Bus()
+    # Nothing is kept without subscriptions
+    bus.publish(payload("r", "dev1"))
+    fast = bus.subscribe()
+    slow = bus.subscribe()
+    bus.publish_many([payload("r", "dev1", seq) for seq in range(3)])
+    assert [p["seq"] for p in fast.get_batch(timeout=0)] == [0, 1, 2]
+    bus.publish(payload("r", "dev1", 3))
+    assert [p["seq"] for p in fast.get_batch(timeout=0)] == [3]
+    assert len(bus._log) == 4
+    assert [p["seq"] for p in slow.get_batch(timeout=0)] == [0, 1, 2, 3]
+    assert bus._log == []
+
+    slow.close()
+    assert slow.get_batch() is None
+    assert len(bus) == 1
+    bus.publish(payload("r", "dev1", 4))
+    bus.close()
+    # Pending payloads are read before the end
+    assert [p["seq"] for p in fast.get_batch()] == [4]
+    assert fast.get_batch() is None
+
+
+def test_periodic_avg():
+    bus = Bus()
+    sub = bus.subscribe(device="dev1")
+    id_payload = payload("id", "dev1")
+    sub.inject([id_payload])
+    q_out = queue.Queue()
+    thread = threading.Thread(target=periodic_avg, args=(sub, q_out, 0.05, None))
+    thread.start()
+    assert q_out.get(timeout=1) is id_payload
+
+    msgs = []
+    for freq in [10.0, 20.0, 30.0]:
+        msg = payload("r", "dev1")
+        msg.update(freq_sensor=freq, zero_point=20.0, tstamp_ns=10**9)
+        msgs.append(msg)
+    bus.publish_many(msgs)
+    result = q_out.get(timeout=1)
+    assert result["freq_sensor"] == 20.0
+    bus.close()
+    thread.join()
+    assert q_out.get(timeout=1) is None
+
+
+def test_periodic_avg_tiers(tmp_path):
+    from ..cli import OtherConf
+    from ..tiers import TierAggregator, read_tier, tier_filename
+
+    bus = Bus()
+    sub = bus.subscribe(device="dev1")
+    other = OtherConf()
+    other.tier_agg = TierAggregator(tmp_path, "dev1", tiers=(60,))
+    q_out = queue.Queue()
+    # The interval is longer than the tier
+    thread = threading.Thread(target=periodic_avg, args=(sub, q_out, 300.0, other))
+    thread.start()
+
+    msgs = []
+    for i in range(19):
+        msg = payload("r", "dev1", seq=i)
+        msg.update(
+            freq_sensor=1.0,
+            magnitude=20.0 + i,
+            zero_point=20.0,
+            tstamp_ns=(1704139200 + 10 * i) * 10**9,
+        )
+        msgs.append(msg)
+    msgs[3]["valid"] = False
+    bus.publish_many(msgs)
+    bus.close()
+    thread.join()
+
+    tier60 = read_tier(tmp_path / tier_filename("dev1", 60))
+    assert tier60["count"].tolist() == [5, 6, 6]
+    assert tier60["mag_max"][1] == 31.0
@@ -0,0 +1,62 @@
+import datetime
+import gzip
+
+from ..capture import (
+    CaptureLog,
+    CaptureTee,
+    capture_files,
+    datetime_to_ns,
+    iter_capture,
+    read_index,
+)
+
+
+class LineConn:
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.is_open = True
+
+    def readline(self):
+        if self.lines:
+            return self.lines.pop(0)
+        return b""
+
+
+def test_capture_tee(tmp_path):
+    capture = CaptureLog(tmp_path, "dev1", block_records=2)
+    capture.start()
+    conn = CaptureTee(LineConn([b"a\r\n", b"", b"b\r\n", b"c\r\n"]), capture)
+    assert conn.is_open
+    lines = [conn.readline() for _ in range(4)]
+    capture.stop()
+
+    assert lines == [b"a\r\n", b"", b"b\r\n", b"c\r\n"]
+    captured = [msg for _, msg in iter_capture(tmp_path, "dev1")]
+    assert captured == [b"a\r\n", b"b\r\n", b"c\r\n"]
+
+
+def test_capture_time_range(tmp_path):
+    t0 = datetime.datetime(2024, 3, 1, 23, 59, 0)
+    capture = CaptureLog(tmp_path, "dev1", block_records=10)
+    capture.start()
+    for i in range(120):
+        tstamp = t0 + datetime.timedelta(seconds=i)
+        capture.record(b"r,%03d\r\n" % i, datetime_to_ns(tstamp))
+    capture.stop()
+
+    files = capture_files(tmp_path, "dev1")
+    assert [day for day, _ in files] == [
+        datetime.date(2024, 3, 1),
+        datetime.date(2024, 3, 2),
+    ]
+    # Each block is a gzip member
+    path = files[0][1]
+    assert len(read_index(path)) == 6
+    with gzip.open(path) as fd:
+        assert len(fd.read()) > 0
+
+    start = t0 + datetime.timedelta(seconds=55)
+    end = t0 + datetime.timedelta(seconds=65)
+    res = list(iter_capture(tmp_path, "dev1", start, end))
+    assert [msg for _, msg in res] == [b"r,%03d\r\n" % i for i in range(55, 65)]
+    assert res[0][0] == datetime_to_ns(start)
@@ -9,3 +9,243 @@ def test_config(capsys):
     out, err = capsys.readouterr()
     # last character in out is \n
     assert data == out[:-1]
+
+
+def wait_handshakes(station, timeout=10.0):
+    import time
+
+    deadline = time.monotonic() + timeout
+    while station.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not station.pending
+
+
+def test_station_reload(tmp_path):
+    import configparser
+
+    from ..cli import Station, ini_defaults
+
+    def make_config(**file_opts):
+        cparser = configparser.ConfigParser()
+        cparser.read_dict(ini_defaults)
+        cparser.read_dict(
+            {
+                "photometer": {"model": "SQM-TEST", "nsamples": 1, "tsample": 0.01},
+                "file": dict(dirname=str(tmp_path), interval=0.1, **file_opts),
+            }
+        )
+        return cparser
+
+    station = Station()
+    try:
+        station.apply(make_config())
+        wait_handshakes(station)
+        handle = station.devices["photometer"]
+        photo_dev = handle.photo_dev
+        sink = station.sinks[("file", "sqmtest")]
+
+        # Nothing changes
+        station.apply(make_config())
+        assert station.devices["photometer"] is handle
+        assert station.sinks[("file", "sqmtest")] is sink
+
+        # The sink is restarted, the device is kept
+        station.apply(make_config(flush_lines=1))
+        assert station.devices["photometer"] is handle
+        assert station.sinks[("file", "sqmtest")] is not sink
+        assert len(station.bus) == 1
+
+        # The reader is restarted on the same connection
+        cparser = make_config(flush_lines=1)
+        cparser["photometer"]["nsamples"] = "2"
+        station.apply(cparser)
+        assert station.devices["photometer"] is handle
+        assert handle.photo_dev is photo_dev
+        assert handle.readerconf["nsamples"] == 2
+
+        # Removing the device removes its file writer
+        cparser.remove_section("photometer")
+        station.apply(cparser)
+        assert station.devices == {}
+        assert station.sinks == {}
+        assert len(station.bus) == 0
+    finally:
+        station.stop()
+
+    assert list(tmp_path.glob("*_sqmtest.dat"))
+
+
+def test_station_concurrent_handshakes(tmp_path, monkeypatch):
+    import configparser
+    import time
+
+    from .. import cli
+    from ..sqm import SQMTest
+
+    class SlowDevice(SQMTest):
+        def __init__(self, name, delay):
+            super().__init__()
+            self.name = name
+            self.delay = delay
+
+        def start_connection(self):
+            time.sleep(self.delay)
+            super().start_connection()
+
+    def build_dev(section):
+        return SlowDevice(section["name"], section.getfloat("delay"))
+
+    monkeypatch.setattr(cli, "build_dev_from_ini", build_dev)
+
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(cli.ini_defaults)
+    cparser.read_dict(
+        {
+            "photometer1": {"name": "fast", "delay": 0.0, "tsample": 0.01},
+            "photometer2": {"name": "slow", "delay": 0.5, "tsample": 0.01},
+            "photometer3": {
+                "name": "absent",
+                "delay": 3.0,
+                "tsample": 0.01,
+                "handshake_timeout": 0.2,
+            },
+            "file": {"dirname": str(tmp_path), "interval": 0.1},
+        }
+    )
+    station = cli.Station()
+    try:
+        start = time.monotonic()
+        station.apply(cparser)
+        # Nothing waits for the handshakes
+        assert time.monotonic() - start < 0.4
+        while "photometer2" in station.pending:
+            station.check_pending()
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        assert elapsed < 1.5
+        assert sorted(station.devices) == ["photometer1", "photometer2"]
+        assert sorted(station.sinks) == [("file", "fast"), ("file", "slow")]
+        assert station.pending == {}
+        assert station.error_event.is_set()
+        assert not station.ended()
+    finally:
+        station.stop()
+
+
+def test_station_max_open(tmp_path, monkeypatch):
+    import configparser
+    import time
+
+    from .. import cli, writef
+    from ..reader import read_file
+    from ..sqm import SQMTest
+
+    class NamedDevice(SQMTest):
+        def __init__(self, name):
+            super().__init__()
+            self.name = name
+
+    monkeypatch.setattr(
+        cli, "build_dev_from_ini", lambda section: NamedDevice(section["name"])
+    )
+    # Largest number of open files, after each open
+    max_len = [0]
+    cache_get = writef.FileHandleCache.get
+
+    def get(self, key, path):
+        fd = cache_get(self, key, path)
+        max_len[0] = max(max_len[0], len(self))
+        return fd
+
+    monkeypatch.setattr(writef.FileHandleCache, "get", get)
+
+    names = ["dev{}".format(idx) for idx in range(5)]
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(cli.ini_defaults)
+    for idx, name in enumerate(names):
+        cparser["photometer{}".format(idx)] = {"name": name, "tsample": 0.01}
+    cparser["file"] = {"dirname": str(tmp_path), "interval": 0.05, "max_open": 2}
+
+    station = cli.Station()
+    try:
+        station.apply(cparser)
+        wait_handshakes(station)
+        deadline = time.monotonic() + 5.0
+        written = False
+        while not written and time.monotonic() < deadline:
+            time.sleep(0.05)
+            paths = [list(tmp_path.glob("*_{}.dat".format(name))) for name in names]
+            written = all(path and len(read_file(path[0])) >= 3 for path in paths)
+        assert written
+    finally:
+        station.stop()
+
+    # The five writers share the files, one per device
+    location = cli.build_location_from_ini(cparser)
+    files = writef.shared_nightly_files(tmp_path, location, max_open=2)
+    assert files.cache.opened > 2
+    assert max_len[0] == 2
+    assert len(files.cache) == 0
+
+
+def test_station_mqtt_per_device(monkeypatch):
+    import configparser
+
+    from .. import cli
+    from ..sqm import SQMTest
+
+    created = {}
+
+    def create_mqtt_workers(sub, mqtt_config, device):
+        created[device] = sub
+        return []
+
+    def build_dev(section):
+        photo_dev = SQMTest()
+        photo_dev.name = section["name"]
+        return photo_dev
+
+    monkeypatch.setattr(cli, "create_mqtt_workers", create_mqtt_workers)
+    monkeypatch.setattr(cli, "build_dev_from_ini", build_dev)
+
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(cli.ini_defaults)
+    cparser.read_dict(
+        {
+            "photometer1": {"name": "sqm1", "tsample": 0.01},
+            "photometer2": {"name": "sqm2", "tsample": 0.01},
+            "mqtt_server": {"hostname": "localhost"},
+        }
+    )
+    station = cli.Station()
+    try:
+        station.apply(cparser)
+        wait_handshakes(station)
+        # The readings of each device are averaged apart
+        assert sorted(station.sinks) == [
+            ("mqtt_server", "sqm1"),
+            ("mqtt_server", "sqm2"),
+        ]
+        assert created["sqm1"].device == "sqm1"
+        assert created["sqm2"].device == "sqm2"
+    finally:
+        station.stop()
+
+
+def test_profile_dir():
+    import argparse
+    import configparser
+
+    from ..cli import profile_dir_from_config
+
+    def pargs(**kwds):
+        opts = dict(profile_dir=None, dirname=None)
+        opts.update(kwds)
+        return argparse.Namespace(**opts)
+
+    cparser = configparser.ConfigParser()
+    assert profile_dir_from_config(pargs(), cparser) == "/var/lib/tesstractor/profile"
+    cparser.read_dict({"file": {"dirname": "/data"}})
+    assert profile_dir_from_config(pargs(), cparser) == "/data/profile"
+    assert profile_dir_from_config(pargs(dirname="/cli"), cparser) == "/cli/profile"
+    assert profile_dir_from_config(pargs(profile_dir="/prof"), cparser) == "/prof"
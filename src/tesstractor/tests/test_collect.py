@@ -0,0 +1,117 @@
+import configparser
+import json
+import queue
+import threading
+
+import pytest
+
+from ..cli import LocationConf
+from ..collect import Collector, collect, conf_from_register, mqtt_section_from_ini
+from ..collect import topic_pattern
+from ..reader import read_file
+
+
+def register_msg(name, calib=20.44):
+    msg = dict(name=name, model="TESS-W", mac="AA:BB", calib=calib, rev=1)
+    msg["tstamp"] = "2024-01-01T17:00:00"
+    return json.dumps(msg).encode("utf-8")
+
+
+def reading_msg(name, tstamp, mag=20.0, freq=1.0):
+    msg = dict(seq=1, name=name, freq=freq, mag=mag, tamb=5.0, tsky=-10.0, rev=1)
+    msg["tstamp"] = tstamp
+    return json.dumps(msg).encode("utf-8")
+
+
+def test_topic_pattern():
+    sub, regex = topic_pattern("STARS4ALL/{name}/reading")
+    assert sub == "STARS4ALL/+/reading"
+    assert regex.match("STARS4ALL/stars1/reading").group("name") == "stars1"
+    assert regex.match("STARS4ALL/register") is None
+
+
+def test_conf_from_register():
+    msg = json.loads(register_msg("le1"))
+    msg["model"] = "SQM-LE"
+    assert conf_from_register(msg).model == "SQM-LE"
+    msg["model"] = "unknown"
+    assert conf_from_register(msg).model == "TESS"
+
+
+def test_collector(tmp_path):
+    location = LocationConf(timezone="Europe/Madrid")
+    collector = Collector(str(tmp_path), location)
+    msg_q = queue.Queue()
+    stop_event = threading.Event()
+    msg_q.put(("register", register_msg("stars1")))
+    for minute in range(10):
+        tstamp = "2024-01-01T20:{:02d}:00".format(minute)
+        msg_q.put(("reading", reading_msg("stars1", tstamp, mag=20 + 0.1 * minute)))
+        msg_q.put(("reading", reading_msg("stars2", tstamp, freq=10.0)))
+    # Next night, local time
+    msg_q.put(("reading", reading_msg("stars1", "2024-01-02T11:30:00")))
+    msg_q.put(("reading", b"{bad json"))
+    stop_event.set()
+    collect(collector, msg_q, stop_event, batch_lines=4, flush_interval=10.0)
+    assert collector.received == 23
+
+    files = sorted(path.name for path in tmp_path.glob("*.dat"))
+    assert files == [
+        "20240101_210000_stars1.dat",
+        "20240101_210000_stars2.dat",
+        "20240102_123000_stars1.dat",
+    ]
+    table_obj = read_file(tmp_path / files[0])
+    assert len(table_obj) == 10
+    assert table_obj["time_local"][0] == "2024-01-01T21:00:00.000"
+    assert table_obj["mag"][-1] == pytest.approx(20.9)
+    assert table_obj["zp"][0] == pytest.approx(20.44)
+
+    # Not registered, the zero point comes from the readings
+    table_obj = read_file(tmp_path / files[1])
+    assert len(table_obj) == 10
+    assert table_obj["zp"][0] == pytest.approx(22.5)
+    assert len(read_file(tmp_path / files[2])) == 1
+
+
+def test_collector_invalid(tmp_path):
+    location = LocationConf(timezone="Europe/Madrid")
+    collector = Collector(str(tmp_path), location)
+    # Not registered, the zero point is still unknown
+    collector.handle("reading", reading_msg("stars1", "2024-01-01T20:00:00", freq=0))
+    assert collector.pending == 0
+    collector.handle("reading", reading_msg("stars1", "2024-01-01T20:01:00"))
+    collector.handle("reading", reading_msg("stars1", "2024-01-01T20:02:00", freq=0))
+    collector.close()
+
+    (path,) = tmp_path.glob("*.dat")
+    assert "nan" not in path.read_text()
+    table_obj = read_file(path)
+    assert table_obj["zp"].tolist() == [20.0, 20.0]
+    assert table_obj["mag"].tolist() == [20.0, -99.0]
+    assert table_obj["freq"][-1] == 0
+
+
+def test_collector_write_error(tmp_path):
+    location = LocationConf(timezone="Europe/Madrid")
+    # The files can't be created
+    collector = Collector(str(tmp_path / "missing"), location)
+    collector.handle("register", register_msg("stars1"))
+    collector.handle("reading", reading_msg("stars1", "2024-01-01T20:00:00"))
+    assert collector.received == 2
+    assert collector.pending == 0
+    collector.close()
+
+
+def test_mqtt_section():
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(
+        {
+            "mqtt": {"hostname": "off", "enabled": "false"},
+            "mqtt_broker": {"hostname": "localhost"},
+        }
+    )
+    assert mqtt_section_from_ini(cparser)["hostname"] == "localhost"
+    cparser["mqtt_broker"]["enabled"] = "false"
+    with pytest.raises(ValueError):
+        mqtt_section_from_ini(cparser)
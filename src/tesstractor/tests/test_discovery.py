@@ -0,0 +1,92 @@
+import configparser
+
+from ..cli import build_dev_from_ini
+from ..discovery import discover, identify_tess, match_section
+
+SQM_IX = b"i,00000004,00000003,00000023,00002142\r\n"
+TESSR_LINE = b"<fH 04606><tA +2987><tO +2481><mZ -0000>\r\n"
+TESSV2_LINE = (
+    b'{"udp":83471, "rev":2, "name":"stars605", "freq":13.38, "mag":17.52,'
+    b' "tamb":30.39, "tsky":29.23, "wdBm":-50, "ain":448, "ZP":20.34}\r\n'
+)
+
+
+class FakeSerial:
+    """Each port answers only at its baudrate"""
+
+    devices = {
+        "/dev/ttyUSB0": (9600, [b"WiFi connecting\r\n", TESSV2_LINE]),
+        "/dev/ttyUSB1": (115200, [SQM_IX]),
+        "/dev/ttyUSB2": (9600, [TESSR_LINE]),
+        "/dev/ttyUSB3": (9600, []),
+    }
+
+    def __init__(self, port, baudrate, timeout=None):
+        dev_baudrate, lines = self.devices[port]
+        self.model_lines = list(lines) if baudrate == dev_baudrate else []
+        self.is_sqm = dev_baudrate == 115200
+        self.lines = [] if self.is_sqm else list(self.model_lines)
+
+    def write(self, cmd):
+        if self.is_sqm and cmd == b"ix":
+            self.lines = list(self.model_lines)
+
+    def read(self, size=1):
+        if not self.lines:
+            return b""
+        chunk, rest = self.lines[0][:size], self.lines[0][size:]
+        if rest:
+            self.lines[0] = rest
+        else:
+            self.lines.pop(0)
+        return chunk
+
+    def readline(self):
+        if self.lines:
+            return self.lines.pop(0)
+        return b""
+
+    def close(self):
+        pass
+
+
+def make_section(**opts):
+    cparser = configparser.ConfigParser()
+    cparser.read_dict({"photometer": opts})
+    return cparser["photometer"]
+
+
+def test_identify_tess():
+    assert identify_tess(TESSR_LINE)["model"] == "TESS-R"
+    res = identify_tess(TESSV2_LINE)
+    assert res["model"] == "TESSv2"
+    assert res["name"] == "stars605"
+    assert identify_tess(b"WiFi connecting\r\n") is None
+
+
+def test_discover_and_match():
+    ports = sorted(FakeSerial.devices)
+    results = discover(ports, timeout=0.3, serial_factory=FakeSerial)
+    assert sorted((res.port, res.model) for res in results) == [
+        ("/dev/ttyUSB0", "TESSv2"),
+        ("/dev/ttyUSB1", "SQM-LU"),
+        ("/dev/ttyUSB2", "TESS-R"),
+    ]
+
+    found = match_section(make_section(serial_number="2142"), results)
+    assert found.port == "/dev/ttyUSB1"
+    found = match_section(make_section(model="TESSv2", name="stars605"), results)
+    assert found.port == "/dev/ttyUSB0"
+    # TESS-R does not send an identifier, it is the only one
+    found = match_section(make_section(model="TESS", mac="AA:BB"), results)
+    assert found.port == "/dev/ttyUSB2"
+    assert results == []
+    assert match_section(make_section(model="SQM-LU"), results) is None
+
+
+def test_build_tessr(monkeypatch):
+    import serial
+
+    monkeypatch.setattr(serial, "Serial", FakeSerial)
+    dev = build_dev_from_ini(make_section(model="TESS-R", port="/dev/ttyUSB2"))
+    assert dev.model == "TESS-R"
@@ -0,0 +1,62 @@
+import datetime
+import json
+import os
+
+import numpy
+import pytest
+
+from ..cli import LocationConf
+from ..export import export_device, list_devices, main
+from ..sqm import SQMTest
+from ..writef import IDAWriter, calc_filename, init_file
+from .test_writef import write_rows
+
+
+def make_archive(dirname, days=3):
+    paths = []
+    for day in range(days):
+        ref = datetime.datetime(2024, 1, 1 + day, 19, 0, 0)
+        fname = calc_filename(ref, "sqmtest")
+        init_file(dirname / fname, SQMTest().static_conf(), LocationConf())
+        writer = IDAWriter()
+        write_rows(dirname, fname, 10, writer)
+        writer.close()
+        paths.append(dirname / fname)
+    return paths
+
+
+def test_export_npz(tmp_path):
+    archive = tmp_path / "ida"
+    archive.mkdir()
+    paths = make_archive(archive)
+    outdir = tmp_path / "out"
+    assert list_devices(archive) == ["sqmtest"]
+
+    filename = export_device(
+        archive, "sqmtest", outdir, start=datetime.date(2024, 1, 2), jobs=2
+    )
+    with numpy.load(filename) as data:
+        assert data["time_utc"].dtype == numpy.dtype("datetime64[ns]")
+        assert len(data["mag"]) == 20
+        assert data["mag"][-1] == pytest.approx(19.09)
+        meta = json.loads(str(data["meta"]))
+    assert meta["files"] == [path.name for path in paths[1:]]
+    assert meta["device_type"] == "SQM-TEST"
+
+    # Already converted nights are skipped
+    night = outdir / "nights" / (paths[1].name + ".npz")
+    mtime = os.path.getmtime(night)
+    export_device(archive, "sqmtest", outdir, start=datetime.date(2024, 1, 2))
+    assert os.path.getmtime(night) == mtime
+
+
+def test_export_npy(tmp_path):
+    archive = tmp_path / "ida"
+    archive.mkdir()
+    make_archive(archive, days=2)
+    outdir = tmp_path / "out"
+    main(["--format", "npy", "-o", str(outdir), "-j", "1", str(archive)])
+    freq = numpy.load(outdir / "sqmtest" / "freq.npy", mmap_mode="r")
+    assert len(freq) == 20
+    with open(outdir / "sqmtest" / "meta.json") as fd:
+        assert len(json.load(fd)["files"]) == 2
@@ -0,0 +1,117 @@
+import configparser
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy
+import pytest
+
+from ..bus import Bus
+from ..httpapi import DeviceHistory, HttpServer, RecentStore, payloads_to_rows
+
+T0 = 1704139200 * 10**9  # 2024-01-01T20:00:00
+
+
+def reading(name, minute, mag=20.0):
+    return dict(
+        cmd="r",
+        name=name,
+        tstamp_ns=T0 + minute * 60 * 10**9,
+        freq_sensor=2.5,
+        magnitude=mag,
+        zero_point=20.5,
+        temp_ambient=5.0,
+        valid=True,
+    )
+
+
+def test_device_history():
+    hour = 3600 * 10**9
+    history = DeviceHistory(span=hour, capacity=4)
+    history.extend(payloads_to_rows([reading("dev1", m) for m in range(0, 90, 10)]))
+    # Only the last hour is kept
+    assert history.records["tstamp"][0] == T0 + 20 * 60 * 10**9
+    assert len(history) == 7
+    # Out of order
+    history.extend(payloads_to_rows([reading("dev1", 95), reading("dev1", 85)]))
+    assert numpy.all(numpy.diff(history.records["tstamp"]) >= 0)
+    assert history.latest()["tstamp"] == T0 + 95 * 60 * 10**9
+    sel = history.range(T0 + 60 * 60 * 10**9, T0 + 85 * 60 * 10**9)
+    assert len(sel) == 3
+
+
+@pytest.fixture
+def server():
+    store = RecentStore(hours=2)
+    store.add([reading("dev1", m, 20 + 0.1 * m) for m in range(10)])
+    store.add([dict(cmd="id", name="dev2"), reading("dev2", 3)])
+    latency = {
+        "count": 12,
+        "delay": {"mean_ms": 1.5, "p95_ms": 2.0, "max_ms": 3.0},
+        "response": None,
+    }
+    status = dict(cmd="status", name="dev1", latency=latency, tstamp_ns=T0)
+    store.add([status])
+    server = HttpServer(("127.0.0.1", 0), store)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return response.read().decode("utf-8")
+
+
+def test_http_api(server):
+    devices = json.loads(get(server + "/devices"))
+    assert [dev["name"] for dev in devices] == ["dev1", "dev2"]
+    assert devices[0]["last"] == "2024-01-01T20:09:00.000"
+
+    assert devices[0]["latency"]["delay"]["max_ms"] == 3.0
+    assert devices[1]["latency"] is None
+
+    latency = json.loads(get(server + "/latency?device=dev1"))
+    assert latency["count"] == 12
+    assert latency["time_utc"] == "2024-01-01T20:00:00.000"
+    assert [lat["name"] for lat in json.loads(get(server + "/latency"))] == ["dev1"]
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        get(server + "/latency?device=dev2")
+    assert exc_info.value.code == 404
+
+    latest = json.loads(get(server + "/latest?device=dev1"))
+    assert latest["mag"] == pytest.approx(20.9)
+    assert latest["sky_temp"] is None
+    assert len(json.loads(get(server + "/latest"))) == 2
+
+    url = server + "/range?device=dev1&from=2024-01-01T20:02:00&to=2024-01-01T20:05:00"
+    rows = json.loads(get(url))
+    assert [row["time_utc"][11:16] for row in rows] == ["20:02", "20:03", "20:04"]
+    lines = get(url + "&format=csv").splitlines()
+    assert lines[0] == "name,time_utc,temp,sky_temp,freq,mag,zp"
+    assert lines[1] == "dev1,2024-01-01T20:02:00.000,5.0,,2.5,20.2,20.5"
+    assert len(lines) == 4
+
+    for path, code in [("/range?device=nodev", 404), ("/range?from=xx", 400)]:
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            get(server + path)
+        assert exc.value.code == code
+
+
+def test_consumer_http():
+    from ..httpapi import consumer_http
+
+    cparser = configparser.ConfigParser()
+    cparser.read_dict({"http": {"port": "0"}})
+    bus = Bus()
+    sub = bus.subscribe()
+    thread = threading.Thread(target=consumer_http, args=(sub, cparser["http"]))
+    thread.start()
+    bus.publish(reading("dev1", 0))
+    bus.close()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
@@ -0,0 +1,95 @@
+import configparser
+import datetime
+import multiprocessing
+import queue
+import threading
+
+from ..multiproc import DeviceProcess, RecordRing, record_to_payload
+from ..timeutil import datetime_to_ns
+
+
+def test_ring_roundtrip():
+    ring = RecordRing(capacity=4)
+    try:
+        t0 = datetime.datetime(2024, 1, 1, 20, 0, 0, 500000)
+        for i in range(5):
+            payload = dict(
+                cmd="r",
+                tstamp=t0 + datetime.timedelta(seconds=i),
+                seq=i,
+                freq_sensor=10.0 + i,
+                magnitude=18.0,
+                zero_point=20.5,
+                temp_ambient=12.5,
+                valid=True,
+            )
+            assert ring.put(payload) == (i < 4)
+        assert ring.dropped == 1
+
+        # Attach as the consumer does
+        other = RecordRing(capacity=4, name=ring.name)
+        recs = other.get_all()
+        assert len(recs) == 4
+        assert len(other.get_all()) == 0
+        base = dict(name="dev1", model="SQM-LU")
+        res = record_to_payload(recs[3], base)
+        assert res["name"] == "dev1"
+        assert res["tstamp_ns"] == datetime_to_ns(t0 + datetime.timedelta(seconds=3))
+        assert res["freq_sensor"] == 13.0
+        assert res["temp_ambient"] == 12.5
+        assert "temp_sky" not in res
+        assert "protocol_revision" not in res
+        # There is space again
+        assert ring.put(payload)
+        other.close()
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+class LateQueue:
+    """The messages are not seen until the process has ended"""
+
+    def __init__(self, ctrl_q, process):
+        self.ctrl_q = ctrl_q
+        self.process = process
+
+    def get_nowait(self):
+        if self.process is not None and self.process.is_alive():
+            raise queue.Empty
+        self.process = None
+        raise queue.Empty
+
+    def get(self, timeout=None):
+        return self.ctrl_q.get(timeout=timeout)
+
+
+def test_device_process_end(ida_dir):
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(
+        {
+            "photometer": {
+                "model": "REPLAY",
+                "name": "replay",
+                "path": str(ida_dir),
+                "speed": 0,
+            }
+        }
+    )
+    readerconf = dict(nsamples=1, tsample=0.0, tz="UTC")
+    devproc = DeviceProcess(
+        cparser["photometer"], readerconf, multiprocessing.Event(), poll=0.5
+    )
+    devproc.start()
+    assert devproc.wait_ready(timeout=10)
+    # The end of the replay is only seen after the process has ended
+    devproc.ctrl_q = LateQueue(devproc.ctrl_q, devproc.process)
+
+    output_q = queue.Queue()
+    error_event = threading.Event()
+    devproc.forward(output_q, error_event)
+    assert not error_event.is_set()
+    payloads = []
+    while not output_q.empty():
+        payloads.append(output_q.get())
+    assert [p["cmd"] for p in payloads] == ["id"] + ["r"] * 5
@@ -0,0 +1,92 @@
+import pstats
+import sys
+import threading
+import time
+
+import pytest
+
+from ..profiling import Profiler
+
+
+def busy(stop_event):
+    while not stop_event.is_set():
+        sum(range(1000))
+
+
+def run_profiled(profiler, name="photo_reader_sqmtest"):
+    profiler.start()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop_event,), name=name)
+    thread.start()
+    time.sleep(0.2)
+    paths = profiler.dump()
+    stop_event.set()
+    thread.join()
+    profiler.stop()
+    return paths
+
+
+def test_profiler_disabled(tmp_path):
+    profiler = Profiler(str(tmp_path / "profile"))
+    assert not profiler.enabled
+    profiler.start()
+    assert not profiler.due()
+    assert profiler.dump() == []
+    assert not (tmp_path / "profile").exists()
+
+
+def test_profiler_sample(tmp_path):
+    profiler = Profiler(str(tmp_path), mode="sample", interval=0.005)
+    paths = run_profiled(profiler)
+    assert len(paths) == 1
+    with open(paths[0]) as fd:
+        lines = fd.read().splitlines()
+    thread_lines = [line for line in lines if line.startswith("photo_reader_sqmtest;")]
+    assert thread_lines
+    assert any("busy (test_profiling.py" in line for line in thread_lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+@pytest.mark.skipif(sys.version_info >= (3, 12), reason="one cProfile at a time")
+def test_profiler_cprofile(tmp_path):
+    profiler = Profiler(str(tmp_path), mode="cprofile", tracemalloc_frames=5)
+    paths = run_profiled(profiler, name="consumer_write_file_0")
+    prof = [path for path in paths if path.endswith("_consumer_write_file_0.prof")]
+    assert len(prof) == 1
+    stats = pstats.Stats(prof[0])
+    # Functions are counted when they return, busy is still running
+    assert any("builtins.sum" in func[2] for func in stats.stats)
+    assert any(path.endswith(".snap") for path in paths)
+
+
+@pytest.mark.skipif(sys.version_info >= (3, 12), reason="one cProfile at a time")
+def test_profiler_cprofile_stop(tmp_path):
+    profiler = Profiler(str(tmp_path), mode="cprofile")
+    profiler.start()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop_event,), name="worker")
+    thread.start()
+    time.sleep(0.1)
+    profiler.stop()
+    time.sleep(0.05)
+    # The profile of the worker does not count calls after stop
+    stats = profiler._profiler._profiles["worker"]
+    stats.snapshot_stats()
+    before = {func: val[1] for func, val in stats.stats.items()}
+    time.sleep(0.1)
+    stats.snapshot_stats()
+    after = {func: val[1] for func, val in stats.stats.items()}
+    stop_event.set()
+    thread.join()
+    assert before == after
+
+
+def test_profiler_schedule(tmp_path):
+    profiler = Profiler(str(tmp_path), tracemalloc_frames=1, period=0.05)
+    profiler.start()
+    assert not profiler.due()
+    time.sleep(0.06)
+    assert profiler.due()
+    profiler.dump()
+    assert not profiler.due()
+    profiler.stop()
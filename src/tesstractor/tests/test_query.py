@@ -0,0 +1,36 @@
+import datetime
+
+import pytz
+
+from ..cli import LocationConf
+from ..query import query_range
+from ..sqm import SQMTest
+from ..writef import calc_filename, init_file, write_to_file
+
+
+def test_query_two_nights(tmp_path):
+    insconf = SQMTest().static_conf()
+    for day in [1, 2, 3]:
+        t0 = datetime.datetime(2024, 1, day, 20, 0, 0)
+        fname = calc_filename(t0, insconf.name)
+        init_file(tmp_path / fname, insconf, LocationConf())
+        for i in range(10):
+            tstamp = t0 + datetime.timedelta(hours=i)
+            payload = dict(
+                cmd="r",
+                tstamp=tstamp,
+                tstamp_local=pytz.utc.localize(tstamp),
+                freq_sensor=2.5,
+                magnitude=19.0,
+                zero_point=19.84,
+            )
+            write_to_file(payload, tmp_path, fname)
+
+    start = datetime.datetime(2024, 1, 2, 3, 0, 0)
+    end = datetime.datetime(2024, 1, 2, 23, 0, 0)
+    result = query_range(tmp_path, insconf.name, start, end, jobs=2)
+    assert len(result) == 6
+    assert result["time_utc"][0] == "2024-01-02T03:00:00.000"
+    assert result["time_utc"][-1] == "2024-01-02T22:00:00.000"
+    assert len(result.meta["files"]) == 2
+    assert result.meta["device_type"] == "SQM-TEST"
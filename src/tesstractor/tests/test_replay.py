@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+
+from ..replay import ReplayDevice, expand_paths
+from ..timeutil import datetime_to_ns, now_ns
+
+
+def test_replay_rows(ida_dir):
+    paths = expand_paths(str(ida_dir))
+    assert len(paths) == 1
+
+    dev = ReplayDevice(paths, name="replay", speed=0)
+    dev.start_connection()
+    assert dev.model == "SQM-LU"
+    assert dev.static_conf().serial_number == "2142"
+
+    records = []
+    with pytest.raises(EOFError):
+        while True:
+            records.append(dev.read_data())
+
+    assert len(records) == 5
+    assert records[0]["tstamp_ns"] == datetime_to_ns(datetime.datetime(2024, 1, 1, 20))
+    assert records[4]["magnitude"] == pytest.approx(19.4)
+    assert records[2]["zero_point"] == pytest.approx(19.84)
+
+
+def test_replay_retime(ida_dir):
+    dev = ReplayDevice(expand_paths(str(ida_dir)), speed=0, retime=True)
+    now = now_ns()
+    first = dev.read_data()
+    second = dev.read_data()
+    assert first["tstamp_ns"] >= now
+    assert second["tstamp_ns"] - first["tstamp_ns"] == 60 * 10**9
+
+
+def replay_to_files(paths, dirname):
+    """Replay paths into the file writer of dirname"""
+    import queue
+
+    import pytz
+
+    from ..cli import LocationConf, OtherConf
+    from ..writef import consumer_write_file
+
+    dev = ReplayDevice(paths, name="replay", speed=0)
+    dev.start_connection()
+    config = OtherConf()
+    config.dirname = str(dirname)
+    config.devconf = dev.static_conf()
+    config.location = LocationConf()
+    q = queue.Queue()
+    with pytest.raises(EOFError):
+        while True:
+            payload = dev.read_data()
+            payload["localtz"] = pytz.utc
+            q.put(payload)
+    q.put(None)
+    consumer_write_file(q, config)
+
+
+def test_replay_noon(tmp_path):
+    import pytz
+
+    from ..cli import LocationConf
+    from ..reader import read_file
+    from ..sqm import SQMTest
+    from ..writef import init_file, write_to_file
+
+    src = tmp_path / "src"
+    src.mkdir()
+    fname = "20231231_120000_sqmtest.dat"
+    init_file(src / fname, SQMTest().static_conf(), LocationConf())
+    t0 = datetime.datetime(2024, 1, 1, 10, 0, 0)
+    for i in range(9):
+        tstamp = t0 + datetime.timedelta(minutes=30 * i)
+        payload = dict(
+            cmd="r",
+            tstamp=tstamp,
+            tstamp_local=pytz.utc.localize(tstamp),
+            freq_sensor=2.5,
+            magnitude=19.0 + 0.1 * i,
+            zero_point=19.84,
+        )
+        write_to_file(payload, src, fname)
+    paths = expand_paths(str(src))
+
+    out = tmp_path / "out"
+    out.mkdir()
+    replay_to_files(paths, out)
+    # Again, back in time, the files of both nights are appended
+    replay_to_files(paths, out)
+    files = sorted(path.name for path in out.glob("2024*.dat"))
+    assert files == ["20240101_100000_replay.dat", "20240101_120000_replay.dat"]
+    assert len(read_file(out / files[0])) == 2 * 4
+    assert len(read_file(out / files[1])) == 2 * 5
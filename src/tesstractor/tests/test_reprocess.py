@@ -0,0 +1,45 @@
+import configparser
+import datetime
+
+import pytest
+
+from ..capture import CaptureLog
+from ..cli import capture_name_from_ini
+from ..reprocess import _NullConn, read_handshake
+from ..sqm import SQMLU
+from ..timeutil import datetime_to_ns
+
+IX_OLD = b"i,00000004,00000003,00000023,00001111\r\n"
+IX_NEW = b"i,00000004,00000003,00000023,00002142\r\n"
+CX_OLD = b"c,00000019.00m,0000151.517s, 022.2C,00000008.71m, 023.2C\r\n"
+
+
+def test_read_handshake_newest(tmp_path):
+    log = CaptureLog(str(tmp_path), "sqm1")
+    day1 = datetime.datetime(2024, 1, 1, 20, 0)
+    day2 = datetime.datetime(2024, 1, 2, 20, 0)
+    log.start()
+    log.record(IX_OLD, datetime_to_ns(day1))
+    log.record(CX_OLD, datetime_to_ns(day1) + 10**9)
+    # Only the metadata is answered the next day
+    log.record(IX_NEW, datetime_to_ns(day2))
+    log.stop()
+
+    photo_dev = SQMLU(_NullConn(), "sqm1")
+    read_handshake(photo_dev, str(tmp_path), "sqm1", day2 + datetime.timedelta(1))
+    assert photo_dev.serial_number == 2142
+    assert photo_dev.calibration == pytest.approx(19.00)
+
+
+@pytest.mark.parametrize(
+    "options, name",
+    [
+        ({"model": "TESS-R"}, "TESS-test"),
+        ({"model": "TESSv2", "name": "stars1"}, "stars1"),
+        ({"model": "SQM-LU"}, "photometer_a"),
+    ],
+)
+def test_capture_name(options, name):
+    cparser = configparser.ConfigParser()
+    cparser.read_dict({"photometer_a": options})
+    assert capture_name_from_ini(cparser["photometer_a"]) == name
@@ -28,3 +28,152 @@ def test_metadata_re1(msg):
 def test_calibration_re1(msg):
     matches = CALIB_RE.match(msg)
     assert matches
+
+
+def test_circuit_breaker():
+    from ..device import CircuitBreaker
+
+    now = [0.0]
+    breaker = CircuitBreaker(
+        budget=2, window=10.0, backoff=1.0, max_backoff=3.0, clock=lambda: now[0]
+    )
+    assert not breaker.record_error()
+    assert not breaker.record_error()
+    # Errors out of the window are forgotten
+    now[0] = 20.0
+    assert not breaker.record_error()
+    assert not breaker.record_error()
+    assert breaker.record_error()
+
+    breaker.reset_failed()
+    assert breaker.is_open
+    assert not breaker.record_error()
+    now[0] = 21.0
+    assert breaker.record_error()
+    breaker.reset_failed()
+    now[0] = 22.5
+    assert breaker.is_open
+    now[0] = 23.0
+    breaker.reset_failed()
+    breaker.reset_failed()
+    assert breaker._delay == 3.0
+
+    breaker.reset_succeeded()
+    assert not breaker.is_open
+    assert not breaker.record_error()
+
+
+class FakeConn:
+    is_open = True
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.commands = []
+        self.flushed = 0
+        self.closed = 0
+
+    def read(self, size=1):
+        if not self.lines:
+            return b""
+        chunk, self.lines[0] = self.lines[0][:size], self.lines[0][size:]
+        if not self.lines[0]:
+            self.lines.pop(0)
+        return chunk
+
+    def readline(self):
+        if self.lines:
+            return self.lines.pop(0)
+        return b""
+
+    def write(self, cmd):
+        self.commands.append(cmd)
+
+    def reset_input_buffer(self):
+        self.flushed += 1
+
+    def close(self):
+        self.closed += 1
+
+
+def test_sqm_resync():
+    from ..sqm import SQMLU
+
+    good = b"r, 19.29m,0000000002Hz,0000277871c,0000000.603s, 029.9C\r\n"
+    conn = FakeConn([b"", b"r, 19.2\xff\r\n", good])
+    dev = SQMLU(conn, "sqm1")
+    dev.cmd_wait = 0
+    pmsg = dev.read_data(tries=3)
+    assert pmsg["magnitude"] == 19.29
+    # The command is sent again, the connection is kept
+    assert conn.commands == [b"rx", b"rx"]
+    assert conn.flushed == 1
+    assert conn.closed == 0
+
+
+def test_tess_resync():
+    from ..device import CircuitBreaker
+    from ..tess import TessR
+
+    good = b"<fH 04606><tA +2987><tO +2481><mZ -0000>\r\n"
+    conn = FakeConn([b"", b"<fH 04\xff\r\n", good, b"garbage\r\n"])
+    dev = TessR(conn, "tess1")
+    dev.breaker = CircuitBreaker(budget=1)
+    assert dev.read_data() is None
+    assert conn.closed == 0
+    assert dev.read_data()["valid"]
+    # Budget exhausted, the connection is reset
+    assert dev.read_data() is None
+    assert conn.closed == 1
+    # The device does not answer, the reset has failed
+    assert dev.breaker.is_open
+
+
+class GarbageConn(FakeConn):
+    """Each line is garbage, followed by a timeout"""
+
+    def __init__(self):
+        super().__init__([])
+        self.count = 0
+
+    def readline(self):
+        self.count += 1
+        return b"garbage\r\n" if self.count % 2 else b""
+
+
+def test_sqmlu_reset_once():
+    from ..device import CircuitBreaker
+    from ..sqm import SQMLU
+
+    now = [0.0]
+    conn = GarbageConn()
+    dev = SQMLU(conn, "sqm1")
+    dev.cmd_wait = 0
+    dev.breaker = CircuitBreaker(budget=3, clock=lambda: now[0])
+    assert dev.read_data(tries=10) is None
+    # The errors during the reset don't start another one
+    assert conn.closed == 1
+    assert dev.breaker.is_open
+    assert dev.read_data(tries=10) is None
+    assert conn.closed == 1
+    # After the backoff, the budget is exhausted again
+    now[0] = 2.0
+    assert dev.read_data(tries=10) is None
+    assert conn.closed == 2
+
+
+def test_sqmlu_cmd_wait(monkeypatch):
+    import configparser
+
+    import serial
+
+    from .. import cli
+
+    monkeypatch.setattr(serial, "Serial", lambda *args, **kwargs: FakeConn([]))
+    cparser = configparser.ConfigParser()
+    cparser.read_dict(
+        {"photometer": {"model": "SQM-LU"}, "photometer_fast": {"model": "SQM-LU"}}
+    )
+    cparser["photometer_fast"]["cmd_wait"] = "0"
+    # The wait of the old firmware is kept by default
+    assert cli.build_dev_from_ini(cparser["photometer"]).cmd_wait == 1.0
+    assert cli.build_dev_from_ini(cparser["photometer_fast"]).cmd_wait == 0.0
@@ -0,0 +1,77 @@
+import datetime
+import time
+
+import pytest
+import pytz
+
+from ..timeutil import (
+    OffsetTable,
+    ReceiveClock,
+    datetime_to_ns,
+    format_ns,
+    ns_to_datetime,
+    payload_iso,
+    round_seconds,
+    set_tstamp,
+)
+
+
+def test_ns_roundtrip():
+    dt = datetime.datetime(2024, 3, 31, 0, 59, 59, 999000)
+    assert ns_to_datetime(datetime_to_ns(dt)) == dt
+
+
+@pytest.mark.parametrize("zone", ["Europe/Madrid", "America/Santiago", "UTC"])
+def test_offset_table(zone):
+    tz = pytz.timezone(zone)
+    table = OffsetTable(tz)
+    start = datetime.datetime(2023, 1, 1)
+    # Every 7 hours for two years, in both directions
+    times = [start + datetime.timedelta(hours=7 * i) for i in range(2500)]
+    for dt in times + times[::-1]:
+        expected = pytz.utc.localize(dt).astimezone(tz)
+        local = table.localize(datetime_to_ns(dt))
+        assert local.utcoffset() == expected.utcoffset()
+        assert local.replace(tzinfo=None) == expected.replace(tzinfo=None)
+
+
+def test_offset_table_transition():
+    tz = pytz.timezone("Europe/Madrid")
+    table = OffsetTable(tz)
+    change = datetime_to_ns(datetime.datetime(2024, 3, 31, 1, 0))
+    assert table.utcoffset_ns(change - 1) == 3600 * 10**9
+    assert table.utcoffset_ns(change) == 7200 * 10**9
+
+
+def test_format_ns():
+    dt = datetime.datetime(2024, 5, 6, 23, 59, 59, 999999)
+    ns = datetime_to_ns(dt)
+    assert format_ns(ns) == dt.isoformat("T", timespec="milliseconds")
+    assert format_ns(round_seconds(ns), "seconds") == "2024-05-07T00:00:00"
+
+
+def test_payload_iso():
+    ns = datetime_to_ns(datetime.datetime(2024, 5, 6, 23, 59, 59, 600000))
+    payload = set_tstamp(dict(cmd="r"), ns)
+    assert sorted(payload) == ["cmd", "tstamp_ns"]
+    assert payload_iso(payload) == "2024-05-06T23:59:59.600"
+    assert payload_iso(payload, "seconds") == "2024-05-07T00:00:00"
+    # Formatted once, the other sinks reuse the strings
+    payload["tstamp_str"] = "cached"
+    assert payload_iso(payload) == "cached"
+    # A copy with a new time stamp is formatted again
+    other = set_tstamp(dict(payload), ns + 10**9)
+    assert payload_iso(other) == "2024-05-07T00:00:00.600"
+    with pytest.raises(ValueError):
+        payload_iso(payload, "minutes")
+
+
+def test_receive_clock():
+    clock = ReceiveClock(period=0.0)
+    before = time.time_ns()
+    stamp = clock.to_ns(time.monotonic_ns())
+    after = time.time_ns()
+    # Allow for the rounding of the calibration
+    assert before - 10**6 <= stamp <= after + 10**6
+    # Readings in the past are mapped to the past
+    assert clock.to_ns(time.monotonic_ns() - 10**9) < before
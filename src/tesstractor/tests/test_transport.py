@@ -0,0 +1,193 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from ..sqm import SQMLE
+from ..timeutil import payload_ns
+from ..transport import SerialTransport, TCPLoop, TCPTransport
+
+ANSWERS = {
+    b"i": b"i,00000004,00000003,00000023,00002142\r\n",
+    b"c": b"c,00000019.84m,0000151.517s, 022.2C,00000008.71m, 023.2C\r\n",
+    b"r": b"r, 19.29m,0000000002Hz,0000277871c,0000000.603s, 029.9C\r\n",
+}
+
+
+class StandInSQMLE:
+    """Answer the commands of a SQM-LE in a local port"""
+
+    def __init__(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.clients = []
+        self.accepted = 0
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            self.clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        pending = b""
+        while True:
+            try:
+                data = client.recv(64)
+            except OSError:
+                return
+            if not data:
+                return
+            pending += data
+            while b"x" in pending:
+                cmd, pending = pending.split(b"x", 1)
+                try:
+                    client.sendall(ANSWERS.get(cmd, b"?\r\n"))
+                except OSError:
+                    # The client has closed the connection
+                    return
+
+    def drop_clients(self):
+        for client in self.clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already closed by the client
+                pass
+            client.close()
+        self.clients = []
+
+    def close(self):
+        self.drop_clients()
+        self.server.close()
+
+
+@pytest.fixture
+def loop():
+    loop = TCPLoop(max_wait=0.05)
+    yield loop
+    loop.stop()
+
+
+def test_sqmle_units(loop):
+    servers = [StandInSQMLE() for _ in range(3)]
+    devs = []
+    for idx, server in enumerate(servers):
+        conn = TCPTransport("127.0.0.1", server.port, timeout=1.0, loop=loop)
+        dev = SQMLE(conn, "sqmle{}".format(idx))
+        dev.start_connection()
+        devs.append(dev)
+
+    for dev in devs:
+        assert dev.serial_number == 2142
+        assert dev.calibration == pytest.approx(19.84)
+        pmsg = dev.read_data(tries=2)
+        assert pmsg["magnitude"] == pytest.approx(19.29)
+        assert pmsg["name"] == dev.name
+
+    for dev in devs:
+        dev.close_connection()
+    for server in servers:
+        server.close()
+
+
+def test_tcp_reconnect(loop):
+    server = StandInSQMLE()
+    conn = TCPTransport("127.0.0.1", server.port, timeout=1.0, backoff=0.05, loop=loop)
+    conn.open()
+    conn.write(b"rx")
+    assert conn.readline() == ANSWERS[b"r"]
+
+    server.drop_clients()
+    conn.timeout = 0.1
+    # The commands are lost while the connection is down
+    while conn.readline() != ANSWERS[b"r"]:
+        conn.write(b"rx")
+    assert conn.connected
+    assert server.accepted == 2
+    conn.close()
+    server.close()
+
+
+def test_tcp_close_open(loop):
+    server = StandInSQMLE()
+    conn = TCPTransport("127.0.0.1", server.port, timeout=1.0, loop=loop)
+    conn.open()
+    # The loop is busy, the connection is removed later
+    loop.call(time.sleep, 0.2)
+    conn.close()
+    assert not conn.connected
+    # As in a reset of the device
+    conn.open()
+    conn.write(b"rx")
+    assert conn.readline() == ANSWERS[b"r"]
+    assert server.accepted == 2
+    conn.close()
+    server.close()
+
+
+def test_tcp_unreachable(loop):
+    # A closed port
+    sock = socket.create_server(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    conn = TCPTransport("127.0.0.1", port, timeout=0.2, backoff=0.05, loop=loop)
+    with pytest.raises(ConnectionError):
+        conn.open()
+    assert conn.readline() == b""
+    conn.close()
+
+
+def test_receive_time(loop):
+    server = StandInSQMLE()
+    conn = TCPTransport("127.0.0.1", server.port, timeout=1.0, loop=loop)
+    dev = SQMLE(conn, "sqmle")
+    dev.start_connection()
+    assert dev.latency.count == 1
+
+    start = time.time_ns()
+    conn.write(b"rx")
+    # The answer waits in the transport, the stamp is its arrival
+    time.sleep(0.2)
+    pmsg = dev.read_data()
+    assert start <= payload_ns(pmsg) < start + 10**8
+    summary = dev.latency.summary()
+    assert summary["count"] == 2
+    assert summary["delay"]["max_ms"] >= 200
+    assert summary["response"]["max_ms"] < 100
+    dev.close_connection()
+    server.close()
+
+
+class FakeSerial:
+    is_open = True
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size):
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    def readline(self):
+        end = self.data.find(b"\n") + 1 or len(self.data)
+        line, self.data = self.data[:end], self.data[end:]
+        return line
+
+
+def test_serial_transport():
+    conn = SerialTransport(FakeSerial(b"abc\r\n\nde"))
+    before = time.monotonic_ns()
+    assert conn.readline() == b"abc\r\n"
+    assert conn.rx_mono_ns >= before
+    assert conn.readline() == b"\n"
+    assert conn.readline() == b"de"
+    assert conn.readline() == b""
+    assert conn.rx_mono_ns is None
@@ -0,0 +1,39 @@
+import pytest
+
+from ..watch import DebouncedScheduler, InotifyWatcher, PollWatcher, make_watcher
+
+
+def test_scheduler_debounce():
+    sched = DebouncedScheduler(debounce=5.0, min_period=60.0)
+    sched.add("a.dat", 100.0)
+    assert sched.due(102.0) == []
+    sched.add("a.dat", 103.0)
+    assert sched.due(107.0) == []
+    assert sched.next_timeout(107.0, default=10.0) == pytest.approx(1.0)
+    assert sched.due(108.0) == ["a.dat"]
+    # Modified again, but recently processed
+    sched.add("a.dat", 110.0)
+    assert sched.due(120.0) == []
+    assert sched.next_timeout(120.0, default=100.0) == pytest.approx(48.0)
+    assert sched.due(168.0) == ["a.dat"]
+    assert sched.due(300.0) == []
+
+
+@pytest.mark.parametrize("watcher_cls", [make_watcher, PollWatcher])
+def test_watcher(tmp_path, watcher_cls):
+    watcher = watcher_cls(str(tmp_path))
+    try:
+        assert watcher.read(0.01) == set()
+        with open(tmp_path / "a.dat", "w") as fd:
+            fd.write("line\n")
+        names = set()
+        for _ in range(5):
+            names |= watcher.read(0.05)
+        assert names == {"a.dat"}
+    finally:
+        watcher.close()
+
+
+def test_inotify_missing_dir(tmp_path):
+    with pytest.raises(OSError):
+        InotifyWatcher(str(tmp_path / "missing"))
@@ -0,0 +1,100 @@
+import datetime
+import math
+import queue
+import threading
+import time
+
+import numpy
+import pytest
+
+from ..sqm import SQMTest
+from ..timeutil import datetime_to_ns
+from ..workers import Aggregator, avg_device_buffer, read_photometer_timed
+
+
+def make_payloads(freqs):
+    t0 = datetime.datetime(2024, 1, 1, 20, 0, 0)
+    return [
+        dict(
+            cmd="r",
+            tstamp=t0 + datetime.timedelta(seconds=i),
+            freq_sensor=freq,
+            zero_point=20.0,
+            temp_ambient=10.0 + i,
+        )
+        for i, freq in enumerate(freqs)
+    ]
+
+
+def test_avg_default():
+    result = avg_device_buffer(make_payloads([10.0, 0.0, 12.0, 11.0]))
+    assert result["valid"]
+    assert result["freq_sensor"] == 11.0
+    assert result["magnitude"] == pytest.approx(20.0 - 2.5 * math.log10(11.0))
+    assert result["nonpositive"] == 1
+    assert result["temp_ambient"] == 11.5
+    tstamp = datetime.datetime(2024, 1, 1, 20, 0, 1, 500000)
+    assert result["tstamp_ns"] == datetime_to_ns(tstamp)
+    assert "mag_mad" not in result
+
+    result = avg_device_buffer(make_payloads([0.0, -1.0]))
+    assert not result["valid"]
+
+
+@pytest.mark.parametrize(
+    "estimator, expected",
+    [
+        ("median", 10.0),
+        ("mean", 20.0),
+        ("sigma_clip", 189.0 / 19),
+        ("trimmed", 10.0),
+    ],
+)
+def test_estimators(estimator, expected):
+    freqs = [9.0, 10.0, 10.0, 10.0, 11.0] * 4
+    freqs[-1] = 211.0
+    aggregator = Aggregator(estimator, sigma=3.0, trim=0.1)
+    result = avg_device_buffer(make_payloads(freqs), aggregator)
+    assert result["freq_sensor"] == pytest.approx(expected)
+
+
+def test_dispersion():
+    freqs = numpy.linspace(1.0, 100.0, 101)
+    aggregator = Aggregator(mad=True, percentiles=[10, 90])
+    result = avg_device_buffer(make_payloads(freqs), aggregator)
+    mags = 20.0 - 2.5 * numpy.log10(freqs)
+    assert result["mag_p10"] == pytest.approx(numpy.percentile(mags, 10))
+    assert result["mag_p90"] == pytest.approx(numpy.percentile(mags, 90))
+    median = numpy.median(mags)
+    assert result["mag_mad"] == pytest.approx(numpy.median(numpy.abs(mags - median)))
+
+
+def test_aggregator_errors():
+    with pytest.raises(ValueError):
+        Aggregator("mode")
+    with pytest.raises(ValueError):
+        Aggregator("trimmed", trim=0.5)
+
+
+def test_reader_status():
+    device = SQMTest()
+    device.latency.record(2 * 10**6, 5 * 10**6)
+    output_q = queue.Queue()
+    exit_event = threading.Event()
+    error_event = threading.Event()
+    readerconf = dict(nsamples=1, tsample=0.01, status_interval=0.0, tz="UTC")
+    thread = threading.Thread(
+        target=read_photometer_timed,
+        args=(device, output_q, readerconf, exit_event, error_event),
+    )
+    thread.start()
+    while output_q.qsize() < 4:
+        time.sleep(0.01)
+    exit_event.set()
+    thread.join()
+    payloads = list(output_q.queue)
+    status = [p for p in payloads if p["cmd"] == "status"]
+    assert status
+    assert status[-1]["name"] == "sqmtest"
+    assert status[-1]["latency"]["count"] == 1
+    assert status[-1]["latency"]["response"]["max_ms"] == pytest.approx(5.0)
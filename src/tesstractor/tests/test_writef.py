@@ -0,0 +1,254 @@
+import datetime
+import os
+
+import numpy
+import pytest
+import pytz
+
+from ..cli import LocationConf
+from ..reader import read_file
+from ..sqm import SQMTest
+from ..timeutil import datetime_to_ns
+from ..writef import IDAWriter, calc_filename, init_file, startup, write_to_file
+from ..writef import TimedDailyRotator
+
+
+def write_rows(dirname, fname, nrows, writer):
+    t0 = datetime.datetime(2024, 1, 1, 20, 0, 0)
+    for i in range(nrows):
+        tstamp = t0 + datetime.timedelta(seconds=60 * i)
+        payload = dict(
+            cmd="r",
+            tstamp=tstamp,
+            tstamp_local=pytz.utc.localize(tstamp),
+            freq_sensor=2.5,
+            magnitude=19.0 + 0.01 * i,
+            zero_point=19.84,
+        )
+        write_to_file(payload, dirname, fname, writer)
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "xz"])
+def test_compressed_roundtrip(tmp_path, compression):
+    ref = datetime.datetime(2024, 1, 1, 19, 0, 0)
+    fname = calc_filename(ref, "sqmtest", compression=compression)
+    init_file(tmp_path / fname, SQMTest().static_conf(), LocationConf())
+    writer = IDAWriter()
+    write_rows(tmp_path, fname, 30, writer)
+    writer.close()
+
+    table_obj = read_file(tmp_path / fname)
+    assert len(table_obj) == 30
+    assert table_obj["mag"][-1] == pytest.approx(19.29)
+
+    rot = TimedDailyRotator(when=datetime.time(hour=12))
+    create, found = startup(rot.in_interval(ref), "sqmtest", tmp_path)
+    assert not create
+    assert found == fname
+
+
+@pytest.mark.parametrize("compression", ["gzip", "xz"])
+def test_compressed_truncated(tmp_path, compression):
+    ref = datetime.datetime(2024, 1, 1, 19, 0, 0)
+    fname = calc_filename(ref, "sqmtest", compression=compression)
+    init_file(tmp_path / fname, SQMTest().static_conf(), LocationConf())
+    writer = IDAWriter(flush_lines=5)
+    write_rows(tmp_path, fname, 12, writer)
+    # Simulate a crash, the writer is not closed
+    path = tmp_path / fname
+    size = os.path.getsize(path)
+    with open(path, "r+b") as fd:
+        fd.truncate(size - 2)
+
+    table_obj = read_file(path)
+    assert len(table_obj) >= 9
+
+
+def test_sqmle_file(tmp_path):
+    from ..sqm import SQMLE
+    from ..transport import TCPTransport
+
+    dev = SQMLE(TCPTransport("localhost", 10001), "le1")
+    fname = calc_filename(datetime.datetime(2024, 1, 1, 19), "le1")
+    init_file(tmp_path / fname, dev.static_conf(), LocationConf())
+    write_rows(tmp_path, fname, 3, IDAWriter())
+    with open(tmp_path / fname) as fd:
+        header = fd.read()
+    assert "SQM-LE" in header
+    assert len(read_file(tmp_path / fname)) == 3
+
+
+def write_night(dirname, compression, nrows=720):
+    """A night of measurements every minute, return the size of the data"""
+    ref = datetime.datetime(2024, 1, 1, 19, 0, 0)
+    fname = calc_filename(ref, "sqmtest", compression=compression)
+    path = dirname / fname
+    init_file(path, SQMTest().static_conf(), LocationConf())
+    header = os.path.getsize(path)
+    writer = IDAWriter()
+    t0 = datetime.datetime(2024, 1, 1, 18, 0, 0)
+    for i in range(nrows):
+        tstamp = t0 + datetime.timedelta(seconds=60 * i)
+        # Dusk, then a dark sky with some noise
+        mag = 21.0 - 4 * numpy.exp(-i / 40.0) + 0.03 * numpy.sin(1.7 * i)
+        payload = dict(
+            cmd="r",
+            tstamp=tstamp,
+            tstamp_local=pytz.utc.localize(tstamp),
+            freq_sensor=10 ** ((19.84 - mag) / 2.5),
+            magnitude=mag,
+            zero_point=19.84,
+            temp_ambient=8.0 - 0.005 * i,
+            temp_sky=-12.0 + 0.3 * numpy.sin(i / 50.0),
+        )
+        write_to_file(payload, dirname, fname, writer)
+    writer.close()
+    assert len(read_file(path)) == nrows
+    return os.path.getsize(path) - header
+
+
+@pytest.mark.parametrize("compression", ["gzip", "xz"])
+def test_compression_ratio(tmp_path, compression):
+    plain_dir = tmp_path / "plain"
+    plain_dir.mkdir()
+    plain = write_night(plain_dir, None)
+    size = write_night(tmp_path, compression)
+    # With a flush point per line, the ratio is below 3 for gzip
+    # and xz is larger than the plain file
+    assert plain / size > 4
+
+
+def test_tiers(tmp_path):
+    from ..tiers import TierAggregator, read_tier, tier_filename
+
+    agg = TierAggregator(tmp_path, "dev1", tiers=(60, 300))
+    t0 = datetime.datetime(2024, 1, 1, 20, 0, 0)
+    for i in range(31):
+        payload = dict(
+            tstamp=t0 + datetime.timedelta(seconds=10 * i),
+            magnitude=19.0 + i,
+            temp_ambient=5.0,
+        )
+        agg.add(payload)
+
+    tier60 = read_tier(tmp_path / tier_filename("dev1", 60))
+    assert len(tier60) == 5
+    assert tier60["count"].tolist() == [6] * 5
+    assert tier60["mag_min"][1] == 25.0
+    assert tier60["mag_max"][1] == 30.0
+    assert tier60["mag_median"][1] == 27.5
+    assert tier60["temp_ambient_median"][0] == 5.0
+    assert numpy.isnan(tier60["temp_sky_median"][0])
+    tier300 = read_tier(tmp_path / tier_filename("dev1", 300))
+    assert len(tier300) == 1
+    assert tier300["count"][0] == 30
+
+
+def test_summary(tmp_path):
+    from ..summary import NightSummary, sun_altitude, write_summary
+
+    assert sun_altitude(datetime.datetime(2024, 1, 1, 12), 40.4, -3.7) > 20
+    assert sun_altitude(datetime.datetime(2024, 1, 1, 23), 40.4, -3.7) < -18
+
+    ref = datetime.datetime(2024, 1, 1, 19, 0, 0)
+    fname = calc_filename(ref, "sqmtest")
+    init_file(tmp_path / fname, SQMTest().static_conf(), LocationConf())
+    writer = IDAWriter()
+    write_rows(tmp_path, fname, 30, writer)
+    writer.close()
+
+    summary = NightSummary(fname, latitude=40.4, longitude=-3.7, max_gap=120)
+    summary.add_from_file(tmp_path / fname)
+    summary.add(datetime.datetime(2024, 1, 1, 21, 0, 0), 21.5)
+    record = summary.record()
+    assert record["count"] == 31
+    assert record["darkest_mag"] == 21.5
+    assert record["darkest_time"] == "2024-01-01T21:00:00"
+    assert record["astro_count"] == 31
+    assert record["gaps"] == 1
+    assert record["gap_longest_s"] == 1860.0
+
+    write_summary(tmp_path, "sqmtest", summary)
+    write_summary(tmp_path, "sqmtest", summary)
+    lines = (tmp_path / "sqmtest_summary.jsonl").read_text().splitlines()
+    assert len(lines) == 2
+
+
+def test_journal_recover(tmp_path):
+    from ..writef import JournalWriter
+
+    ref = datetime.datetime(2024, 1, 1, 19, 0, 0)
+    fname = calc_filename(ref, "sqmtest")
+    path = tmp_path / fname
+    init_file(path, SQMTest().static_conf(), LocationConf())
+    journal_path = tmp_path / "sqmtest.journal"
+    journal = JournalWriter(journal_path, group_lines=4)
+    write_rows(tmp_path, fname, 8, journal)
+    assert journal.timeout() is None
+    assert len(read_file(path)) == 8
+
+    # Simulate a crash, the last lines did not reach the disk
+    # and the last entry of the journal is incomplete
+    data = path.read_bytes()
+    path.write_bytes(data[: data.rfind(b"\n", 0, len(data) - 1) - 10])
+    with open(journal_path, "a") as fd:
+        fd.write("0badc0de\t")
+
+    journal = JournalWriter(journal_path)
+    assert journal.recover() == 2
+    table_obj = read_file(path)
+    assert len(table_obj) == 8
+    assert table_obj["mag"][-1] == pytest.approx(19.07)
+    assert os.path.getsize(journal_path) == 0
+
+    # Nothing to recover twice
+    journal = JournalWriter(journal_path, group_lines=4)
+    assert journal.recover() == 0
+    write_rows(tmp_path, fname, 1, journal)
+    assert journal.timeout() > 0
+    journal.close()
+    assert len(read_file(path)) == 9
+
+
+def test_file_handle_cache(tmp_path):
+    from ..writef import FileHandleCache
+
+    cache = FileHandleCache(max_open=2)
+    for name in ["a", "b", "a", "c", "a"]:
+        fd = cache.get(name, tmp_path / (name + ".dat.xz"))
+        fd.write(name + "\n")
+    # "b" was evicted to open "c"
+    assert len(cache) == 2
+    assert cache.opened == 3
+    # The xz files are closed to end the stream
+    cache.flush()
+    assert len(cache) == 0
+    assert (tmp_path / "b.dat.xz").exists()
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_nightly_files(tmp_path, compression):
+    from ..writef import NightlyFiles, open_ida
+
+    files = NightlyFiles(tmp_path, LocationConf(), compression, max_open=3)
+    t0 = datetime.datetime(2024, 1, 1, 20, 0, 0)
+    for i in range(8):
+        now_local = t0 + datetime.timedelta(hours=3 * i)
+        for dev in range(5):
+            conf = SQMTest().static_conf()
+            conf.name = "dev{}".format(dev)
+            line = "{:%Y-%m-%dT%H:%M:%S}.000;x".format(now_local)
+            files.write(conf, datetime_to_ns(now_local), line)
+    # The files of the first night are closed at noon
+    assert len(files.cache) == 3
+    assert all(
+        os.path.basename(path).startswith("20240102_140000")
+        for path in files.cache._handles
+    )
+    files.close()
+
+    paths = sorted(tmp_path.glob("*_dev0.dat*"))
+    assert [path.name[:15] for path in paths] == ["20240101_200000", "20240102_140000"]
+    with open_ida(paths[0], "r", compression) as fd:
+        rows = [line for line in fd if not line.startswith("#")]
+    assert len(rows) == 6
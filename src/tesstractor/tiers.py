@@ -0,0 +1,116 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Downsampled tiers of the measurements
+
+For each tier (a window length in seconds), the median, minimum and
+maximum of the magnitude and the temperatures, and the number of
+measurements, are computed for each window. A record is appended to
+the tier file {name}_{seconds}s.tier when its window closes, so a
+partial window at shutdown is not written.
+
+The tier files are arrays of TIER_DTYPE, they can be read with
+read_tier or numpy.fromfile.
+"""
+
+import logging
+import os.path
+import warnings
+
+import numpy
+
+from tesstractor.timeutil import payload_ns
+
+
+_logger = logging.getLogger(__name__)
+
+_FIELDS = ["mag", "temp_ambient", "temp_sky"]
+
+_PAYLOAD_KEYS = {
+    "mag": "magnitude",
+    "temp_ambient": "temp_ambient",
+    "temp_sky": "temp_sky",
+}
+
+TIER_DTYPE = numpy.dtype(
+    [("tstamp", "i8"), ("count", "i4")]
+    + [
+        (f"{field}_{stat}", "f4")
+        for field in _FIELDS
+        for stat in ["median", "min", "max"]
+    ]
+)
+
+DEFAULT_TIERS = (60, 900, 3600)
+
+
+def tier_filename(name, seconds):
+    return f"{name}_{seconds}s.tier"
+
+
+def parse_tiers(value):
+    """Parse a comma separated list of tiers in seconds"""
+    if value is None or value.strip().lower() in ["", "none"]:
+        return ()
+    return tuple(int(val) for val in value.split(","))
+
+
+def read_tier(path):
+    """Read a tier file, the time stamp is the start of the window in ns (UTC)"""
+    return numpy.fromfile(path, dtype=TIER_DTYPE)
+
+
+class TierAggregator:
+    """Rolling aggregates of the measurements of a device"""
+
+    def __init__(self, dirname, name, tiers=DEFAULT_TIERS):
+        self.dirname = dirname
+        self.name = name
+        self.tiers = tuple(tiers)
+        # Current window index and values, per tier
+        self._windows = {tier: (None, []) for tier in self.tiers}
+        os.makedirs(dirname, exist_ok=True)
+
+    def add(self, payload):
+        tstamp_ns = payload_ns(payload)
+        values = tuple(
+            payload.get(_PAYLOAD_KEYS[field], numpy.nan) for field in _FIELDS
+        )
+        for tier in self.tiers:
+            idx = tstamp_ns // (tier * 10**9)
+            cur_idx, cur_values = self._windows[tier]
+            if cur_idx is not None and idx != cur_idx:
+                self._write(tier, cur_idx, cur_values)
+                cur_values = []
+            cur_values.append(values)
+            self._windows[tier] = (idx, cur_values)
+
+    def _write(self, tier, idx, values):
+        arr = numpy.array(values, dtype="f8")
+        rec = numpy.zeros(1, dtype=TIER_DTYPE)
+        rec["tstamp"] = idx * tier * 10**9
+        rec["count"] = len(arr)
+        with warnings.catch_warnings():
+            # columns without values are NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            stats = {
+                "median": numpy.nanmedian(arr, axis=0),
+                "min": numpy.nanmin(arr, axis=0),
+                "max": numpy.nanmax(arr, axis=0),
+            }
+        for col, field in enumerate(_FIELDS):
+            for stat, res in stats.items():
+                rec[f"{field}_{stat}"] = res[col]
+
+        path = os.path.join(self.dirname, tier_filename(self.name, tier))
+        try:
+            with open(path, "ab") as fd:
+                rec.tofile(fd)
+        except OSError:
+            _logger.exception("writing tier %s", path)
@@ -0,0 +1,263 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Time stamps as integer nanoseconds since the epoch (UTC)
+
+The payloads carry the time stamp as an int in 'tstamp_ns', set with
+set_tstamp. No datetime is built for each payload; the ISO string of
+the time stamp is formatted by payload_iso, once, and kept in the
+payload for the other sinks.
+
+The transports record the arrival of the messages with the monotonic
+clock, mono_to_ns converts those readings to UTC.
+"""
+
+import bisect
+import datetime
+import functools
+import threading
+import time
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_NS = 10**9
+_MINUTE_NS = 60 * _NS
+
+
+def datetime_to_ns(dt):
+    """Convert a naive UTC datetime to ns since epoch"""
+    delta = dt - _EPOCH
+    return (delta // datetime.timedelta(microseconds=1)) * 1000
+
+
+def ns_to_datetime(ns):
+    """Convert ns since epoch to a naive UTC datetime"""
+    return _EPOCH + datetime.timedelta(microseconds=ns // 1000)
+
+
+def now_ns():
+    return time.time_ns()
+
+
+class ReceiveClock:
+    """Map the monotonic clock to UTC
+
+    The offset between both clocks is measured again every period
+    seconds, to follow the adjustments of the system clock
+    """
+
+    def __init__(self, period=60.0):
+        self.period_ns = int(period * _NS)
+        # (monotonic time of the measure, offset)
+        self._cal = self._calibrate()
+
+    @staticmethod
+    def _calibrate():
+        mono0 = time.monotonic_ns()
+        utc = time.time_ns()
+        mono1 = time.monotonic_ns()
+        mono = (mono0 + mono1) // 2
+        return mono, utc - mono
+
+    def offset_ns(self):
+        """Offset to add to a monotonic time to get UTC"""
+        cal_mono, offset = self._cal
+        if time.monotonic_ns() - cal_mono >= self.period_ns:
+            self._cal = self._calibrate()
+            _, offset = self._cal
+        return offset
+
+    def to_ns(self, mono_ns):
+        """Convert a reading of time.monotonic_ns to ns since epoch"""
+        return mono_ns + self.offset_ns()
+
+
+receive_clock = ReceiveClock()
+
+
+def mono_to_ns(mono_ns):
+    """Convert a reading of time.monotonic_ns to ns since epoch"""
+    return receive_clock.to_ns(mono_ns)
+
+
+# Keys of the payload derived from the time stamp, by timespec
+_ISO_KEYS = {"milliseconds": "tstamp_str", "seconds": "tstamp_str_s"}
+_DERIVED_KEYS = ("tstamp", "tstamp_local_ns", "tstamp_local_str") + tuple(
+    _ISO_KEYS.values()
+)
+
+
+def set_tstamp(payload, ns):
+    """Set the time stamp of a payload"""
+    # i.e. a copy of other payload, its time stamps are not valid
+    for key in _DERIVED_KEYS:
+        payload.pop(key, None)
+    payload["tstamp_ns"] = ns
+    return payload
+
+
+def payload_ns(payload):
+    """Time stamp of a payload in ns, or from a naive UTC datetime in 'tstamp'"""
+    ns = payload.get("tstamp_ns")
+    if ns is None:
+        ns = datetime_to_ns(payload["tstamp"])
+    return ns
+
+
+def payload_iso(payload, timespec="milliseconds"):
+    """ISO string of the time stamp of a payload, formatted once
+
+    With timespec seconds, the time stamp is rounded to the nearest
+    second
+    """
+    key = _ISO_KEYS.get(timespec)
+    if key is None:
+        raise ValueError("unknown timespec {}".format(timespec))
+    iso = payload.get(key)
+    if iso is None:
+        ns = payload_ns(payload)
+        if timespec == "seconds":
+            ns = round_seconds(ns)
+        iso = payload[key] = format_ns(ns, timespec)
+    return iso
+
+
+@functools.lru_cache(maxsize=256)
+def _minute_prefix(minute):
+    """ISO string of a minute, up to the seconds"""
+    return ns_to_datetime(minute * _MINUTE_NS).strftime("%Y-%m-%dT%H:%M:")
+
+
+def format_ns(ns, timespec="milliseconds"):
+    """Format ns as ISO 8601, without time zone.
+
+    Consecutive time stamps share the cached date part
+    """
+    minute, rem = divmod(ns, _MINUTE_NS)
+    prefix = _minute_prefix(minute)
+    if timespec == "milliseconds":
+        ms = rem // 10**6
+        return "{}{:02d}.{:03d}".format(prefix, ms // 1000, ms % 1000)
+    elif timespec == "seconds":
+        return "{}{:02d}".format(prefix, rem // _NS)
+    else:
+        raise ValueError("unknown timespec {}".format(timespec))
+
+
+def round_seconds(ns):
+    """Round ns to the nearest second"""
+    return (ns + _NS // 2) // _NS * _NS
+
+
+class OffsetTable:
+    """UTC offsets of a time zone, with the transitions cached
+
+    The offset of a time is searched in a sorted table of transitions,
+    instead of converting each datetime. The table is extended around
+    the requested times, one year at a time
+    """
+
+    _SPAN = 366 * 86400 * _NS
+    _STEP = 900 * _NS
+
+    def __init__(self, tz):
+        self.tz = tz
+        self._lock = threading.Lock()
+        # Sorted start times and offsets (ns) of the known intervals
+        self._starts = []
+        self._offsets = []
+        self._lo = None
+        self._hi = None
+
+    def _offset_at(self, ns):
+        dt = datetime.datetime.fromtimestamp(ns / _NS, tz=datetime.timezone.utc)
+        return int(dt.astimezone(self.tz).utcoffset().total_seconds()) * _NS
+
+    def _scan(self, lo, hi):
+        """Transitions in [lo, hi), as (start, offset), transitions happen
+        at multiples of 15 minutes"""
+        result = [(lo, self._offset_at(lo))]
+        current = result[0][1]
+        # Coarse steps of a day, refined when the offset changes
+        day = 86400 * _NS
+        t = lo
+        while t < hi:
+            nxt = min(t + day, hi)
+            off = self._offset_at(nxt)
+            if off != current:
+                a, b = t, nxt
+                while b - a > self._STEP:
+                    mid = (a + b) // 2 // self._STEP * self._STEP
+                    if mid <= a:
+                        break
+                    if self._offset_at(mid) == current:
+                        a = mid
+                    else:
+                        b = mid
+                result.append((b, off))
+                current = off
+            t = nxt
+        return result
+
+    def _extend(self, ns):
+        if self._lo is None:
+            lo = ns // self._SPAN * self._SPAN
+            hi = lo + self._SPAN
+            entries = self._scan(lo, hi)
+            self._starts = [start for start, _ in entries]
+            self._offsets = [off for _, off in entries]
+            self._lo, self._hi = lo, hi
+        while ns < self._lo:
+            lo = self._lo - self._SPAN
+            entries = self._scan(lo, self._lo)
+            self._starts = [start for start, _ in entries] + self._starts
+            self._offsets = [off for _, off in entries] + self._offsets
+            self._lo = lo
+        while ns >= self._hi:
+            hi = self._hi + self._SPAN
+            entries = self._scan(self._hi, hi)
+            self._starts.extend(start for start, _ in entries)
+            self._offsets.extend(off for _, off in entries)
+            self._hi = hi
+
+    def utcoffset_ns(self, ns):
+        """UTC offset in ns of the time ns (UTC)"""
+        with self._lock:
+            if self._lo is None or not self._lo <= ns < self._hi:
+                self._extend(ns)
+            idx = bisect.bisect_right(self._starts, ns) - 1
+            return self._offsets[idx]
+
+    def local_ns(self, ns):
+        """Local time as ns since the epoch"""
+        return ns + self.utcoffset_ns(ns)
+
+    def localize(self, ns):
+        """Local time as an aware datetime with a fixed offset"""
+        offset = self.utcoffset_ns(ns)
+        tzinfo = _fixed_tz(offset)
+        return ns_to_datetime(ns + offset).replace(tzinfo=tzinfo)
+
+
+@functools.lru_cache(maxsize=64)
+def _fixed_tz(offset_ns):
+    return datetime.timezone(datetime.timedelta(microseconds=offset_ns // 1000))
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def offset_table(tz):
+    """Shared OffsetTable of a time zone"""
+    with _tables_lock:
+        key = str(tz)
+        table = _tables.get(key)
+        if table is None:
+            table = _tables[key] = OffsetTable(tz)
+        return table
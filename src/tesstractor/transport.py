@@ -0,0 +1,416 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Line oriented connections with the photometers
+
+A transport has the subset of the interface of serial.Serial used
+by the devices: open, close, is_open, write, readline and
+reset_input_buffer. readline returns b"" after the timeout.
+
+The transports record in rx_mono_ns the time.monotonic_ns of the
+arrival of the first byte of the last line, and in tx_mono_ns the
+time of the last write.
+
+The TCP connections of all the network photometers are served by
+one thread, TCPLoop. It keeps the sockets open, reconnects them with
+a backoff and splits the input in lines, so the commands to many
+units are in flight at the same time, and each reader only waits
+for the answers of its own unit.
+"""
+
+import errno
+import logging
+import queue
+import selectors
+import socket
+import threading
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Transport:
+    """Connection with a photometer"""
+
+    rx_mono_ns = None
+    tx_mono_ns = None
+
+    @property
+    def is_open(self) -> bool:
+        return False
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def readline(self) -> bytes:
+        raise NotImplementedError
+
+    def reset_input_buffer(self):
+        pass
+
+
+class SerialTransport(Transport):
+    """A serial port"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def is_open(self):
+        return self.conn.is_open
+
+    def open(self):
+        self.conn.open()
+
+    def close(self):
+        self.conn.close()
+
+    def write(self, data):
+        self.tx_mono_ns = time.monotonic_ns()
+        self.conn.write(data)
+
+    def readline(self):
+        # The first byte is waited alone, to know when it arrives
+        first = self.conn.read(1)
+        if not first:
+            self.rx_mono_ns = None
+            return first
+        self.rx_mono_ns = time.monotonic_ns()
+        if first == b"\n":
+            return first
+        return first + self.conn.readline()
+
+    def reset_input_buffer(self):
+        self.conn.reset_input_buffer()
+
+
+class _Connection:
+    """State of a TCP connection, owned by the thread of TCPLoop"""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sock = None
+        self.connecting = False
+        self.connect_deadline = 0.0
+        self.next_connect = 0.0
+        self.delay = transport.backoff
+        self.rbuf = bytearray()
+        # Arrival of the first byte in rbuf
+        self.rbuf_mono_ns = 0
+        self.wbuf = bytearray()
+
+
+class TCPLoop:
+    """Serve the TCP transports from one thread"""
+
+    def __init__(self, max_wait=1.0):
+        self.max_wait = max_wait
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._lock = threading.Lock()
+        self._calls = []
+        # transport -> _Connection
+        self._conns = {}
+        self._stop = False
+        self._thread = threading.Thread(
+            target=self._run, name="tcp_transport", daemon=True
+        )
+        self._thread.start()
+
+    def call(self, func, *args):
+        """Run func(*args) in the thread of the loop"""
+        with self._lock:
+            self._calls.append((func, args))
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            # Already awake
+            pass
+
+    def add(self, transport):
+        self.call(self._add, transport)
+
+    def remove(self, transport):
+        self.call(self._remove, transport)
+
+    def send(self, transport, data):
+        self.call(self._send, transport, data)
+
+    def clear(self, transport):
+        self.call(self._clear, transport)
+
+    def stop(self):
+        self._stop = True
+        self.call(lambda: None)
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop:
+            for key, events in self._selector.select(self._timeout()):
+                conn = key.data
+                if conn is None:
+                    self._run_calls()
+                elif key.fileobj is not conn.sock:
+                    # Closed by a previous event
+                    continue
+                elif conn.connecting:
+                    self._end_connect(conn)
+                else:
+                    if events & selectors.EVENT_READ:
+                        self._recv(conn)
+                    if events & selectors.EVENT_WRITE and conn.sock is not None:
+                        self._flush(conn)
+            self._check_connections()
+        for conn in list(self._conns.values()):
+            self._disconnect(conn)
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _timeout(self):
+        now = time.monotonic()
+        timeout = self.max_wait
+        for conn in self._conns.values():
+            if conn.sock is None:
+                timeout = min(timeout, conn.next_connect - now)
+            elif conn.connecting:
+                timeout = min(timeout, conn.connect_deadline - now)
+        return max(timeout, 0.0)
+
+    def _run_calls(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            calls, self._calls = self._calls, []
+        for func, args in calls:
+            func(*args)
+
+    def _add(self, transport):
+        if transport not in self._conns:
+            self._conns[transport] = _Connection(transport)
+
+    def _remove(self, transport):
+        conn = self._conns.pop(transport, None)
+        if conn is not None:
+            self._disconnect(conn)
+
+    def _send(self, transport, data):
+        conn = self._conns.get(transport)
+        if conn is None or conn.sock is None or conn.connecting:
+            _logger.debug("%s is not connected, dropping %s", transport, data)
+            return
+        conn.wbuf += data
+        self._flush(conn)
+
+    def _clear(self, transport):
+        conn = self._conns.get(transport)
+        if conn is not None:
+            conn.rbuf.clear()
+
+    def _check_connections(self):
+        now = time.monotonic()
+        for conn in self._conns.values():
+            if conn.sock is None and now >= conn.next_connect:
+                self._start_connect(conn)
+            elif conn.connecting and now >= conn.connect_deadline:
+                _logger.warning("timeout connecting to %s", conn.transport)
+                self._drop(conn)
+
+    def _start_connect(self, conn):
+        transport = conn.transport
+        _logger.debug("connecting to %s", transport)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            err = sock.connect_ex((transport.host, transport.port))
+        except OSError as ex:
+            # i.e. the name of the host can't be resolved
+            err = ex.errno
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            _logger.warning(
+                "connecting to %s: %s", transport, errno.errorcode.get(err, err)
+            )
+            conn.sock = None
+            self._schedule(conn)
+            return
+        conn.sock = sock
+        conn.connecting = True
+        conn.connect_deadline = time.monotonic() + transport.timeout
+        self._selector.register(sock, selectors.EVENT_WRITE, conn)
+
+    def _end_connect(self, conn):
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            _logger.warning(
+                "connecting to %s: %s", conn.transport, errno.errorcode.get(err, err)
+            )
+            self._drop(conn)
+            return
+        _logger.info("connected to %s", conn.transport)
+        conn.connecting = False
+        conn.delay = conn.transport.backoff
+        self._selector.modify(conn.sock, selectors.EVENT_READ, conn)
+        conn.transport._connected.set()
+
+    def _recv(self, conn):
+        try:
+            data = conn.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as ex:
+            _logger.warning("reading from %s: %s", conn.transport, ex)
+            self._drop(conn)
+            return
+        if not data:
+            _logger.warning("%s has closed the connection", conn.transport)
+            self._drop(conn)
+            return
+        now = time.monotonic_ns()
+        if not conn.rbuf:
+            conn.rbuf_mono_ns = now
+        conn.rbuf += data
+        start = 0
+        while True:
+            end = conn.rbuf.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(conn.rbuf[start : end + 1])
+            conn.transport._lines.put((conn.rbuf_mono_ns, line))
+            # The next line has arrived in this data
+            conn.rbuf_mono_ns = now
+            start = end + 1
+        del conn.rbuf[:start]
+
+    def _flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.wbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as ex:
+            _logger.warning("writing to %s: %s", conn.transport, ex)
+            self._drop(conn)
+            return
+        del conn.wbuf[:sent]
+        events = selectors.EVENT_READ
+        if conn.wbuf:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(conn.sock, events, conn)
+
+    def _disconnect(self, conn):
+        conn.transport._connected.clear()
+        if conn.sock is not None:
+            self._selector.unregister(conn.sock)
+            conn.sock.close()
+            conn.sock = None
+        conn.connecting = False
+        conn.rbuf.clear()
+        conn.wbuf.clear()
+
+    def _schedule(self, conn):
+        conn.next_connect = time.monotonic() + conn.delay
+        conn.delay = min(2 * conn.delay, conn.transport.max_backoff)
+
+    def _drop(self, conn):
+        """Close a broken connection, it is opened again after the backoff"""
+        self._disconnect(conn)
+        self._schedule(conn)
+
+
+_shared_loop = None
+_shared_lock = threading.Lock()
+
+
+def shared_loop() -> TCPLoop:
+    """The TCPLoop of the process, started when needed"""
+    global _shared_loop
+    with _shared_lock:
+        if _shared_loop is None:
+            _shared_loop = TCPLoop()
+        return _shared_loop
+
+
+class TCPTransport(Transport):
+    """A persistent TCP connection, i.e. with a SQM-LE"""
+
+    def __init__(
+        self, host, port, timeout=2.0, backoff=1.0, max_backoff=60.0, loop=None
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.loop = loop
+        self._open = False
+        self._lines = queue.SimpleQueue()
+        self._connected = threading.Event()
+
+    def __repr__(self):
+        return "{}:{}".format(self.host, self.port)
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def open(self):
+        """Start the connection and wait until it is ready"""
+        if self.loop is None:
+            self.loop = shared_loop()
+        self.loop.add(self)
+        self._open = True
+        if not self._connected.wait(self.timeout):
+            raise ConnectionError("unable to connect to {}".format(self))
+
+    def close(self):
+        if self._open:
+            # Cleared here, a following open must wait for a new connection
+            self._connected.clear()
+            self.loop.remove(self)
+            self._open = False
+
+    def write(self, data):
+        if self._open:
+            self.tx_mono_ns = time.monotonic_ns()
+            self.loop.send(self, bytes(data))
+
+    def readline(self):
+        try:
+            self.rx_mono_ns, line = self._lines.get(timeout=self.timeout)
+        except queue.Empty:
+            self.rx_mono_ns = None
+            return b""
+        return line
+
+    def reset_input_buffer(self):
+        if self._open:
+            self.loop.clear(self)
+        try:
+            while True:
+                self._lines.get_nowait()
+        except queue.Empty:
+            pass
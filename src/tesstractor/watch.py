@@ -0,0 +1,165 @@
+#
+# Copyright 2018-2024 Universidad Complutense de Madrid
+#
+# This file is part of tesstractor
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Watch a directory for modified files
+
+On Linux, inotify is used through ctypes; elsewhere, or if inotify
+is not available, the modification times are polled.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import os.path
+import select
+import struct
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+
+_EVENT = struct.Struct("iIII")
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+class InotifyWatcher:
+    """Report the files modified in a directory, using inotify"""
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        libname = ctypes.util.find_library("c") or "libc.so.6"
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(dirname), ctypes.c_uint32(_WATCH_MASK)
+        )
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, f"inotify_add_watch failed on {dirname}")
+
+    def read(self, timeout):
+        """Wait up to timeout seconds, return the set of modified file names"""
+        rlist, _, _ = select.select([self._fd], [], [], timeout)
+        if not rlist:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        names = set()
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos : pos + length].rstrip(b"\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                _logger.warning("inotify queue overflow, rescanning %s", self.dirname)
+                names.update(os.listdir(self.dirname))
+            elif name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollWatcher:
+    """Report the files modified in a directory, comparing modification times"""
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._mtimes = self._scan()
+
+    def _scan(self):
+        mtimes = {}
+        with os.scandir(self.dirname) as it:
+            for entry in it:
+                try:
+                    mtimes[entry.name] = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    pass
+        return mtimes
+
+    def read(self, timeout):
+        """Wait timeout seconds, return the set of modified file names"""
+        time.sleep(timeout)
+        mtimes = self._scan()
+        names = {
+            name for name, mtime in mtimes.items() if self._mtimes.get(name) != mtime
+        }
+        self._mtimes = mtimes
+        return names
+
+    def close(self):
+        pass
+
+
+def make_watcher(dirname):
+    """Return an InotifyWatcher if possible, a PollWatcher otherwise"""
+    try:
+        return InotifyWatcher(dirname)
+    except (OSError, AttributeError) as ex:
+        _logger.info("inotify not available (%s), polling %s", ex, dirname)
+        return PollWatcher(dirname)
+
+
+class DebouncedScheduler:
+    """Decide when the modified files must be processed.
+
+    A file is due when it has not been modified for debounce seconds,
+    and at least min_period seconds have passed since it was processed
+    """
+
+    def __init__(self, debounce=5.0, min_period=60.0):
+        self.debounce = debounce
+        self.min_period = min_period
+        self._modified = {}
+        self._processed = {}
+
+    def add(self, name, now):
+        self._modified[name] = now
+
+    def due(self, now):
+        """Return the files due at time now, they are removed from the pending set"""
+        names = []
+        for name, modified in list(self._modified.items()):
+            if now - modified < self.debounce:
+                continue
+            if now - self._processed.get(name, -self.min_period) < self.min_period:
+                continue
+            del self._modified[name]
+            self._processed[name] = now
+            names.append(name)
+        return sorted(names)
+
+    def next_timeout(self, now, default):
+        """Time until the next file could be due"""
+        timeout = default
+        for name, modified in self._modified.items():
+            ready = max(
+                modified + self.debounce,
+                self._processed.get(name, -self.min_period) + self.min_period,
+            )
+            timeout = min(timeout, max(0.0, ready - now))
+        return timeout
@@ -7,23 +7,29 @@
 # License-Filename: LICENSE.txt
 #
 
-import datetime
 import logging
 import math
 import queue
 import threading
-import typing
-import warnings
+import time
 
 import numpy
 import tzlocal
 
+from tesstractor.bus import Subscription
 from tesstractor.sqm import Device
+from tesstractor.timeutil import now_ns, payload_ns, set_tstamp
 
 
 _logger = logging.getLogger(__name__)
 
 
+def status_payload(device: Device) -> dict:
+    """Payload with the latency statistics of a device"""
+    payload = dict(cmd="status", name=device.name, latency=device.latency.summary())
+    return set_tstamp(payload, now_ns())
+
+
 def read_photometer_timed(
     device: Device,
     output_q: queue.Queue,
@@ -39,6 +45,9 @@ def read_photometer_timed(
 
     nsamples = readerconf.get("nsamples", 5)
     exit_check_timeout = readerconf.get("tsample", 1)
+    # The latency statistics are sent every status_interval seconds
+    status_interval = readerconf.get("status_interval", 60.0)
+    next_status = time.monotonic() + status_interval
     # print('(1)timed_reader, reading every ', timeout, 's')
     # initialice connection. read metadata and calibration
 
@@ -48,7 +57,7 @@ def read_photometer_timed(
         # Read calibration
         # device.read_calibration()
 
-        now = datetime.datetime.utcnow()
+        now = now_ns()
         local_tz = readerconf.get("tz", tzlocal.get_localzone())
 
         payload_init = dict(
@@ -58,9 +67,9 @@ def read_photometer_timed(
             calib=device.calibration,
             rev=1,
             cmd="id",
-            tstamp=now,
             localtz=local_tz,
         )
+        set_tstamp(payload_init, now)
 
         output_q.put(payload_init)
         # exit after this
@@ -105,22 +114,106 @@ def read_photometer_timed(
                 # Send averaged measurement for further work
                 output_q.put(res)
                 seq += 1
+            if device.latency.count and time.monotonic() >= next_status:
+                output_q.put(status_payload(device))
+                next_status = time.monotonic() + status_interval
             # Check if exit_event is set. If it is not set,
             # wait a little (exit_check_timeout) and continue
             do_exit = exit_event.wait(timeout=exit_check_timeout)
+    except EOFError:
+        # The device has no more data, i.e. a replay has ended
+        _logger.info("end of data from %s", device.name)
+        if internal_buffer:
+            res = avg_device_buffer(internal_buffer)
+            res["seq"] = seq
+            output_q.put(res)
     except Exception as ex:
         _logger.debug("exception happened %s", ex)
         error_event.set()
     finally:
+        if device.latency.count:
+            _logger.info("latency of %s: %s", device.name, device.latency.summary())
+            output_q.put(status_payload(device))
         _logger.debug("end read thread")
         _logger.debug("signalling producers to end")
         exit_event.set()
-        _logger.debug("signalling consumers to end")
-        output_q.put(None)
 
 
-def avg_device_buffer(payloads):
+class Aggregator:
+    """Estimators used to collapse a window of measurements
+
+    The frequency is estimated with:
+
+    - median
+    - mean
+    - sigma_clip, the mean after rejecting iteratively the values
+      further than sigma standard deviations from the median
+    - trimmed, the mean after removing a fraction trim of the
+      values at each end
+
+    With mad, the median absolute deviation of the magnitudes is
+    added to the result as mag_mad. Each percentile N of the
+    magnitudes is added as mag_pN.
+    """
+
+    ESTIMATORS = ["median", "mean", "sigma_clip", "trimmed"]
+
+    def __init__(
+        self, estimator="median", sigma=3.0, trim=0.1, mad=False, percentiles=()
+    ):
+        if estimator not in self.ESTIMATORS:
+            raise ValueError("unknown estimator {}".format(estimator))
+        if not 0 <= trim < 0.5:
+            raise ValueError("trim must be in [0, 0.5)")
+        self.estimator = estimator
+        self.sigma = sigma
+        self.trim = trim
+        self.mad = mad
+        self.percentiles = tuple(percentiles)
+
+    def frequency(self, vals):
+        """Estimate the frequency of an array of positive values"""
+        if self.estimator == "median":
+            return numpy.median(vals)
+        elif self.estimator == "mean":
+            return numpy.mean(vals)
+        elif self.estimator == "sigma_clip":
+            data = vals
+            for _ in range(5):
+                center = numpy.median(data)
+                std = data.std()
+                keep = numpy.abs(data - center) <= self.sigma * std
+                if std == 0 or keep.all():
+                    break
+                data = data[keep]
+            return numpy.mean(data)
+        else:
+            ntrim = int(self.trim * len(vals))
+            data = numpy.sort(vals)[ntrim : len(vals) - ntrim]
+            return numpy.mean(data)
+
+    def dispersion(self, vals, zero_point):
+        """Dispersion of the magnitudes, as a dict"""
+        result = {}
+        if not self.mad and not self.percentiles:
+            return result
+        mags = zero_point - 2.5 * numpy.log10(vals)
+        # One pass for the median and all the percentiles
+        qs = numpy.percentile(mags, (50,) + self.percentiles)
+        if self.mad:
+            result["mag_mad"] = float(numpy.median(numpy.abs(mags - qs[0])))
+        for perc, value in zip(self.percentiles, qs[1:]):
+            result["mag_p{:g}".format(perc)] = float(value)
+        return result
+
+
+DEFAULT_AGGREGATOR = Aggregator()
+
+
+def avg_device_buffer(payloads, aggregator: Aggregator = None):
     """Average n measurements"""
+    if aggregator is None:
+        aggregator = DEFAULT_AGGREGATOR
     npayloads = len(payloads)
     result = dict(payloads[0])
     result["valid"] = True
@@ -130,17 +223,17 @@ def avg_device_buffer(payloads):
     # magnitude corresponds to the mag of the average freq
     zero_point = result["zero_point"]
 
-    vals = [p["freq_sensor"] for p in payloads]
-    # TODO: analyze if there are values <= 0, extreme values, etc.
-    vals_0 = list(filter(lambda x: x > 0, vals))
+    vals = numpy.array([p["freq_sensor"] for p in payloads], dtype="float")
+    vals_0 = vals[vals > 0]
     if len(vals_0) != len(vals):
-        msg = "some measurements have freq <= 0"
-        warnings.warn(msg, RuntimeWarning)
+        # This is common with the sensor in darkness, no warning
+        result["nonpositive"] = len(vals) - len(vals_0)
+        _logger.debug("%d measurements have freq <= 0", result["nonpositive"])
 
-    if vals_0:
-        # Computing median
-        result["freq_sensor"] = numpy.median(vals_0)
+    if len(vals_0) > 0:
+        result["freq_sensor"] = aggregator.frequency(vals_0)
         result["magnitude"] = zero_point - 2.5 * math.log10(result["freq_sensor"])
+        result.update(aggregator.dispersion(vals_0, zero_point))
     else:
         result["freq_sensor"] = 0
         result["magnitude"] = -99
@@ -152,90 +245,49 @@ def avg_device_buffer(payloads):
             result[key] = numpy.mean([p[key] for p in payloads])
 
     # Time is average of times
-    ts0 = result["tstamp"]
-    ts = [(p["tstamp"] - ts0) for p in payloads]
-    result["tstamp"] = ts0 + sum(ts, datetime.timedelta(0)) / npayloads
+    set_tstamp(result, sum(payload_ns(p) for p in payloads) // npayloads)
     return result
 
 
-def splitter(inputq: queue.Queue, qs: typing.Sequence[queue.Queue]):
-    """Reads the input queue and sends the values to all the queues"""
-    thisth = threading.current_thread()
-    _logger.debug("starting {} thread".format(thisth.name))
-    while True:
-        payload = inputq.get()
-        inputq.task_done()
-        for wq in qs:
-            # Sending to all tasks...
-            wq.put(payload)
-        if payload is None:
-            _logger.debug("end {} thread".format(thisth.name))
-            break
-
-
-def simple_buffer(q_in, q_out, q_buffer, other):
-    """Separates payload per command
+def periodic_avg(sub: Subscription, q_out: queue.Queue, interval, other):
+    """Read a subscription, forward 'id' payloads and average 'r' payloads
 
-    If cmd is 'r', goes to q_buffer
-    If cmd is 'id', it goes to q_out
+    The 'r' payloads are averaged every interval seconds. If
+    other.aggregator is set, it is used to collapse the buffer.
+    If other.tier_agg is set, the valid 'r' payloads are added
+    to it before averaging
     """
     thisth = threading.current_thread()
-    _logger.debug(f"starting filter buffer thread, {thisth.name}")
+    _logger.debug(f"starting {thisth.name} thread")
+    aggregator = getattr(other, "aggregator", None)
+    tier_agg = getattr(other, "tier_agg", None)
+    buffer = []
+    deadline = time.monotonic() + interval
     while True:
-        payload = q_in.get()
-        if payload:
-            if payload["cmd"] == "id":
-                q_out.put(payload)
-            elif payload["cmd"] == "r":
-                q_buffer.put(payload)
-            else:
-                _logger.warning(f"unknown cmd, {payload}")
-            q_in.task_done()
-        else:
-            # If payload is None is a signal to exit
-            # put None in all queues and exit
+        batch = sub.get_batch(timeout=max(0.0, deadline - time.monotonic()))
+        if batch is None:
+            # The subscription has ended, signal the consumer to end
             q_out.put(None)
-            q_buffer.put(None)
             _logger.debug(f"end {thisth.name} thread")
             break
-
-
-def periodic_avg_task(q_in1: queue.Queue, q_out: queue.Queue, other):
-    """Average the buffer periodically"""
-
-    thisth = threading.current_thread()
-    # thisth is a Timer, it has interval
-    interval = thisth.interval
-
-    _logger.debug(f"wakeup timer thread, {thisth.name}")
-    # other.set()
-
-    # copy queue in buffer
-    buffer = []
-    _logger.debug("fill buffer, empty input queue")
-    try:
-        while True:
-            p = q_in1.get_nowait()
-            if p is None:
-                # None is a signal to exit
-                return
-            buffer.append(p)
-            q_in1.task_done()
-    except queue.Empty:
-        pass
-
-    _logger.debug(f"process buffer, len={len(buffer)}")
-    if buffer:
-        # Queue processed value
-        result = avg_device_buffer(buffer)
-        # Send result to output queue if value is valid
-        if result["valid"]:
-            q_out.put(result)
-    else:
-        pass
-
-    # After doing the work, start a new timed thread
-    _logger.debug(f"launch new timer thread, {thisth.name}")
-    t = threading.Timer(interval, periodic_avg_task, args=(q_in1, q_out, other))
-    t.name = thisth.name
-    t.start()
+        for payload in batch:
+            if payload["cmd"] == "id":
+                q_out.put(payload)
+            else:
+                buffer.append(payload)
+                if tier_agg is not None and payload.get("valid", True):
+                    tier_agg.add(payload)
+
+        now = time.monotonic()
+        if now >= deadline:
+            _logger.debug(f"process buffer, len={len(buffer)}")
+            if buffer:
+                result = avg_device_buffer(buffer, aggregator)
+                # Send result to output queue if value is valid
+                if result["valid"]:
+                    q_out.put(result)
+                buffer = []
+            deadline += interval
+            if deadline <= now:
+                # Do not try to catch up after a stall
+                deadline = now + interval
@@ -8,14 +8,22 @@
 #
 
 
+import collections
 import logging
 import pkgutil
 import datetime
 import glob
+import gzip
+import lzma
 import os.path
 import queue
+import threading
+import time
+import zlib
 
-import pytz
+from tesstractor.summary import NightSummary, write_summary
+from tesstractor.timeutil import datetime_to_ns, format_ns, ns_to_datetime, offset_table
+from tesstractor.timeutil import payload_iso, payload_ns
 
 
 _logger = logging.getLogger(__name__)
@@ -28,7 +36,9 @@ IDA_TMPL = {
     "TESSv2": "IDA-TESS-template.tpl",
     "SQM": "IDA-SQM-template.tpl",
     "SQM-LU": "IDA-SQM-template.tpl",
+    "SQM-LE": "IDA-SQM-template.tpl",
     "SQM-TEST": "IDA-SQM-template.tpl",
+    "REPLAY": "IDA-TESS-template.tpl",
 }
 
 
@@ -36,6 +46,9 @@ class TimeInterval:
     def __init__(self, min_val, max_val):
         self.min_val = min_val
         self.max_val = max_val
+        # The limits in ns, to check time stamps without datetimes
+        self.min_ns = datetime_to_ns(min_val)
+        self.max_ns = datetime_to_ns(max_val)
 
     def in_co(self, dt):
 
@@ -50,6 +63,9 @@ class TimeInterval:
         else:
             return False
 
+    def in_co_ns(self, ns):
+        return self.min_ns <= ns < self.max_ns
+
 
 class TimedDailyRotator:
     def __init__(self, when):
@@ -71,9 +87,35 @@ class TimedDailyRotator:
         return TimeInterval(a, b)
 
 
-def calc_filename(now, name):
+# Suffix of the file for each compression
+COMPRESSION_SUFFIX = {None: "", "gzip": ".gz", "xz": ".xz"}
+
+IDA_SUFFIXES = tuple(".dat" + suffix for suffix in COMPRESSION_SUFFIX.values())
+
+
+def compression_from_filename(filename):
+    """Compression of a file, from its suffix"""
+    for compression, suffix in COMPRESSION_SUFFIX.items():
+        if suffix and filename.endswith(suffix):
+            return compression
+    return None
+
+
+def open_ida(filename, mode, compression=None):
+    """Open a IDA file in text mode, plain or compressed"""
+    if compression == "gzip":
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+    elif compression == "xz":
+        return lzma.open(filename, mode + "t", encoding="utf-8")
+    elif compression is None:
+        return open(filename, mode)
+    else:
+        raise ValueError("unknown compression {}".format(compression))
+
+
+def calc_filename(now, name, compression=None):
     fname_tmpl = "{date:%Y%m%d_%H%M%S}_{name}.dat"
-    return fname_tmpl.format(date=now, name=name)
+    return fname_tmpl.format(date=now, name=name) + COMPRESSION_SUFFIX[compression]
 
 
 def init_file(filename, insconf, locconf):
@@ -81,23 +123,32 @@ def init_file(filename, insconf, locconf):
     tmpl_path = IDA_TMPL[model]
     tmpl_b = pkgutil.get_data("tesstractor", tmpl_path)
     template_string = tmpl_b.decode("utf-8")
-    with open(filename, "w") as fd:
+    compression = compression_from_filename(str(filename))
+    with open_ida(filename, "w", compression) as fd:
         sus = template_string.format(instrument=insconf, location=locconf)
         print(sus[:-1], end="", file=fd)
 
 
-def startup(time_interval, name, dirname):
-
+def list_files(dirname, name):
+    """Return the sorted list of (filename, datetime) of the IDA files of a device"""
     candidates = []
-    glob_pattern = "????????_??????_{}.dat".format(name)
+    glob_pattern = "????????_??????_{}.dat*".format(glob.escape(name))
     for f in glob.glob(os.path.join(dirname, glob_pattern)):
-        # A RE would be more general?
         g = os.path.basename(f)
+        if not g.endswith(IDA_SUFFIXES):
+            continue
         r = g.split("_")
         rr = "_".join(r[:2])
         mm = datetime.datetime.strptime(rr, "%Y%m%d_%H%M%S")
         candidates.append((g, mm))
-    candidates.sort(reverse=True)
+    candidates.sort(key=lambda cnd: cnd[1])
+    return candidates
+
+
+def startup(time_interval, name, dirname):
+
+    candidates = list_files(dirname, str(name))
+    candidates.reverse()
 
     # print(candidates)
     # check most recent
@@ -106,11 +157,12 @@ def startup(time_interval, name, dirname):
         # TODO: we are checking all files here
         # but they are sorted, so less checks
         # are required
-        if dt > time_interval.max_val:
+        if dt >= time_interval.max_val:
             # This file is in the future, weird:
             continue
 
-        if time_interval.in_oc(dt):
+        # A file created at the start of the interval belongs to it
+        if time_interval.in_co(dt):
             create = False
             filename = fname
             break
@@ -128,40 +180,57 @@ def startup(time_interval, name, dirname):
 
 
 def consumer_write_file(intput_q: queue.Queue, config):
-    """Thread to manage file writing"""
+    """Thread to manage file writing
+
+    The files are written through the NightlyFiles of the directory,
+    shared by the file writers of all the devices of the process
+    """
     _logger.info("starting file writer consumer")
+    _logger.debug("directory with previous files, %s", config.dirname)
+
+    insconf = config.devconf
+    files = shared_nightly_files(
+        config.dirname,
+        config.location,
+        getattr(config, "compression", None),
+        getattr(config, "max_open", 64),
+    )
+    writer = NightlyWriter(
+        files,
+        getattr(config, "flush_lines", 32),
+        getattr(config, "flush_interval", 600.0),
+    )
+    if getattr(config, "journal", False):
+        journal = JournalWriter(
+            os.path.join(config.dirname, journal_filename(insconf.name)),
+            writer,
+            group_lines=getattr(config, "journal_lines", 16),
+            group_interval=getattr(config, "journal_interval", 30.0),
+        )
+        # Lines lost in a crash after being journaled
+        journal.recover()
+        writer = journal
 
     # Open the correct file, create a new one if
     # it doesn't exist
     ref_dt = datetime.datetime.now()
     _logger.debug("current local time, %s", ref_dt)
-    # directory with logs
-
-    _logger.debug("directory with previous files, %s", config.dirname)
-
-    _logger.debug("interval of valid logs")
-    rot = TimedDailyRotator(when=datetime.time(hour=12, minute=0, second=0))
-    valid_inter = rot.in_interval(ref_dt)
-
-    last_change = valid_inter.min_val
-    next_change = valid_inter.max_val
-    _logger.debug("from %s upto %s", last_change, next_change)
-
-    insconf = config.devconf
-
-    create, valid_fname = startup(valid_inter, insconf.name, config.dirname)
-
-    if create:
-        valid_fname = calc_filename(ref_dt, name=insconf.name)
-        _logger.debug("valid file not found")
-        _logger.debug("create %s", valid_fname)
-        init_file(os.path.join(config.dirname, valid_fname), insconf, config.location)
+    create, valid_path = files.path(insconf, datetime_to_ns(ref_dt))
+    with_summary = getattr(config, "summary", False)
+    if with_summary:
+        summary = night_summary(os.path.basename(valid_path), create, config)
     else:
-        _logger.debug("valid file is %s", valid_fname)
+        summary = None
 
     while True:
         _logger.debug("enter thread loop")
-        payload = intput_q.get()
+        timeout = writer.timeout()
+        try:
+            payload = intput_q.get(timeout=timeout)
+        except queue.Empty:
+            # The pending lines are due, with a journal they are committed
+            writer.flush()
+            continue
         if payload:
             # We are not going to write this to file anyway
             if payload["cmd"] == "id":
@@ -170,59 +239,558 @@ def consumer_write_file(intput_q: queue.Queue, config):
             _logger.debug(f"got (w) payload {payload}")
             # Add local time to payload
             payload = update_p(payload)
-            #
-            # Verify the file is correct before writing
-            # if not, create a new one
-            now_local = payload["tstamp_local"]
-            now_local_n = now_local.replace(tzinfo=None)
-            if now_local_n >= next_change:
-                _logger.debug("read time is after scheduled time change")
-                _logger.debug("create new file")
-                _logger.debug("compute next change")
-                valid_inter = rot.in_interval(now_local_n)
-                next_change = valid_inter.max_val
-                valid_fname = calc_filename(now_local_n, name=insconf.name)
-                init_file(
-                    os.path.join(config.dirname, valid_fname), insconf, config.location
-                )
-            _logger.debug("write to file")
-            write_to_file(payload, config.dirname, valid_fname)
+            # The file of the night, it may exist, i.e. in a replay of old data
+            create, path = files.path(insconf, payload["tstamp_local_ns"])
+            if path != valid_path:
+                _logger.debug("write to %s", path)
+                if summary is not None:
+                    write_summary(config.dirname, insconf.name, summary)
+                if with_summary:
+                    summary = night_summary(os.path.basename(path), create, config)
+                valid_path = path
+            if summary is not None:
+                summary.add(ns_to_datetime(payload_ns(payload)), payload["magnitude"])
+            write_to_file(payload, config.dirname, os.path.basename(path), writer)
             intput_q.task_done()
         else:
+            writer.close()
             _logger.info("end file writer consumer thread")
             # other.client.loop_stop()
             break
 
 
+def night_summary(fname, create, config):
+    """Summary of a night, with the data already in its file"""
+    summary = new_summary(fname, config)
+    if not create:
+        try:
+            summary.add_from_file(os.path.join(config.dirname, fname))
+        except Exception:
+            _logger.exception("reading previous data of %s", fname)
+    return summary
+
+
+def new_summary(fname, config):
+    """Summary of a file, an interval longer than two periods is a gap"""
+    location = config.location
+    return NightSummary(
+        fname,
+        latitude=location.latitude,
+        longitude=location.longitude,
+        max_gap=2 * getattr(config, "interval", 300.0),
+    )
+
+
 def update_p(payload):
-    """Update payload with tstamp_local"""
-    now = payload["tstamp"]
-    local_tz = payload["localtz"]
-    now_utc = pytz.utc.localize(now)
-    now_local = now_utc.astimezone(local_tz)
-    payload["tstamp_local"] = now_local
+    """Update payload with tstamp_local_ns, the local time in ns
+
+    The UTC offset comes from the cached transitions of the time zone
+    """
+    table = offset_table(payload["localtz"])
+    payload["tstamp_local_ns"] = table.local_ns(payload_ns(payload))
+    payload.pop("tstamp_local_str", None)
     return payload
 
 
-def write_to_file(payload, dirname, filename):
-    """Write payload to file"""
-    payload["tstamp_str"] = payload["tstamp"].isoformat("T", timespec="milliseconds")
-    payload["tstamp_local_str"] = (
-        payload["tstamp_local"]
-        .replace(tzinfo=None)
-        .isoformat("T", timespec="milliseconds")
-    )
-    # m.isoformat('T', timespec='milliseconds')
+class IDAWriter:
+    """Append lines to IDA files
+
+    Plain files are opened and closed for each line.
+
+    Compressed files (by suffix) are kept open and a flush point
+    is added every flush_lines lines or flush_interval seconds, so
+    a crash loses at most the lines written after the last flush
+    point. For gzip, the flush point is a Z_SYNC_FLUSH; for xz, the
+    stream is ended and the next lines go to a new concatenated
+    stream. Each flush point costs compression, a line is only
+    about 100 bytes
+    """
+
+    def __init__(self, flush_lines=32, flush_interval=600.0):
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self._path = None
+        self._fd = None
+        self._compression = None
+        self._pending = 0
+        self._deadline = None
+
+    def write(self, path, line):
+        compression = compression_from_filename(str(path))
+        if compression is None:
+            with open(path, "a") as fd:
+                print(line, file=fd)
+            return
+
+        if path != self._path:
+            self.close()
+            self._path = path
+            self._compression = compression
+        if self._fd is None:
+            self._fd = open_ida(path, "a", compression)
+        print(line, file=self._fd)
+        if self._pending == 0:
+            self._deadline = time.monotonic() + self.flush_interval
+        self._pending += 1
+
+        if self._pending >= self.flush_lines or self.timeout() == 0:
+            self.flush()
+
+    def timeout(self):
+        """Seconds until the pending lines must be flushed, None if there are none"""
+        if not self._pending:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+    def flush(self):
+        if self._fd is None:
+            return
+        if self._compression == "xz":
+            self._fd.close()
+            self._fd = None
+        else:
+            self._fd.flush()
+        self._pending = 0
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+        self._path = None
+        self._pending = 0
+
+
+class FileHandleCache:
+    """LRU cache of IDA files open for appending
+
+    At most max_open files are open, the least recently used file
+    is closed to open a new one.
+    """
+
+    def __init__(self, max_open=64):
+        if max_open < 1:
+            raise ValueError("max_open must be positive")
+        self.max_open = max_open
+        self._handles = collections.OrderedDict()
+        # Number of files opened, for statistics
+        self.opened = 0
+
+    def __len__(self):
+        return len(self._handles)
+
+    def get(self, key, path):
+        """Return the open file of key, opening path if needed"""
+        fd = self._handles.get(key)
+        if fd is not None:
+            self._handles.move_to_end(key)
+            return fd
+        while len(self._handles) >= self.max_open:
+            old_key, old_fd = self._handles.popitem(last=False)
+            _logger.debug("closing %s", old_key)
+            old_fd.close()
+        fd = open_ida(path, "a", compression_from_filename(str(path)))
+        self.opened += 1
+        self._handles[key] = fd
+        return fd
+
+    def flush(self, keys=None):
+        """Flush the buffers of the open files, or of the files of keys"""
+        if keys is None:
+            keys = list(self._handles)
+        for key in [key for key in keys if key in self._handles]:
+            fd = self._handles[key]
+            if isinstance(fd.buffer, lzma.LZMAFile):
+                # The data of a xz file is complete when the stream ends
+                fd.close()
+                del self._handles[key]
+            else:
+                fd.flush()
+
+    def close_if(self, predicate):
+        """Close the files whose key satisfies predicate"""
+        for key in [key for key in self._handles if predicate(key)]:
+            self._handles.pop(key).close()
+
+    def close(self):
+        self.close_if(lambda key: True)
+
+
+class NightlyFiles:
+    """IDA files of many devices, one per night
+
+    The files are written through a FileHandleCache, with their
+    paths as keys. When the first line of a new night arrives, the
+    files of the previous nights of all the devices are closed at
+    once. The methods can be called from many threads.
+    """
+
+    def __init__(self, dirname, location, compression=None, max_open=64):
+        self.dirname = dirname
+        self.location = location
+        self.compression = compression
+        self.rot = TimedDailyRotator(when=datetime.time(hour=12, minute=0, second=0))
+        self.cache = FileHandleCache(max_open)
+        # Interval of the most recent night
+        self.valid_inter = None
+        # (device, night) -> file name
+        self._fnames = {}
+        # path -> night, of the files in _fnames
+        self._nights = {}
+        self._lock = threading.Lock()
+
+    def _interval(self, local_ns):
+        inter = self.valid_inter
+        if inter is not None and inter.in_co_ns(local_ns):
+            return inter
+        inter = self.rot.in_interval(ns_to_datetime(local_ns))
+        if self.valid_inter is None or inter.min_val > self.valid_inter.min_val:
+            self.rollover(inter)
+        return inter
+
+    def rollover(self, inter):
+        """Start a new night, close the files of the previous nights"""
+        _logger.debug("new night from %s", inter.min_val)
+        night = inter.min_val
+        self.cache.close_if(lambda path: self._nights.get(path, night) < night)
+        # Late lines of the previous night are still expected
+        last_night = night - self.rot.interval
+        for key in [key for key in self._fnames if key[1] < last_night]:
+            del self._nights[os.path.join(self.dirname, self._fnames.pop(key))]
+        self.valid_inter = inter
+
+    def _filename(self, insconf, inter, now_local):
+        """Find or create the file of a device in a night
+
+        Return (create, file name), create is True for a new file
+        """
+        create, fname = startup(inter, insconf.name, self.dirname)
+        if create:
+            fname = calc_filename(now_local, insconf.name, self.compression)
+            _logger.info("create %s", fname)
+            init_file(os.path.join(self.dirname, fname), insconf, self.location)
+        return create, fname
+
+    def path(self, insconf, local_ns):
+        """Path of the file of a device for the local time local_ns
+
+        The file is created if needed. Return (create, path),
+        create is True for a new file
+        """
+        with self._lock:
+            inter = self._interval(local_ns)
+            key = (insconf.name, inter.min_val)
+            fname = self._fnames.get(key)
+            create = fname is None
+            if create:
+                now_local = ns_to_datetime(local_ns)
+                create, fname = self._filename(insconf, inter, now_local)
+                self._fnames[key] = fname
+                self._nights[os.path.join(self.dirname, fname)] = inter.min_val
+            return create, os.path.join(self.dirname, fname)
+
+    def write_line(self, path, line):
+        """Write a line to the file in path"""
+        with self._lock:
+            fd = self.cache.get(path, path)
+            fd.write(line)
+            fd.write("\n")
+
+    def write(self, insconf, local_ns, line):
+        """Write a line of a device, local_ns is the local time in ns"""
+        _, path = self.path(insconf, local_ns)
+        self.write_line(path, line)
+
+    def flush(self, paths=None):
+        """Flush the open files, or the files in paths"""
+        with self._lock:
+            self.cache.flush(paths)
+
+    def close(self, paths=None):
+        """Close the open files, or the files in paths"""
+        with self._lock:
+            if paths is None:
+                self.cache.close()
+            else:
+                self.cache.close_if(lambda path: path in paths)
+
+
+_shared_files = {}
+_shared_lock = threading.Lock()
+
+
+def shared_nightly_files(dirname, location, compression=None, max_open=64):
+    """The NightlyFiles of dirname and compression in this process
+
+    The file writers of all the devices share it, so the open files
+    are bounded by max_open. The location and max_open of the last
+    call are used.
+    """
+    key = (os.path.abspath(dirname), compression)
+    with _shared_lock:
+        files = _shared_files.get(key)
+        if files is None:
+            files = NightlyFiles(dirname, location, compression, max_open)
+            _shared_files[key] = files
+        else:
+            files.location = location
+            files.cache.max_open = max_open
+        return files
+
+
+class NightlyWriter:
+    """Append lines to the files of a shared NightlyFiles
+
+    It has the interface of IDAWriter. Plain files are flushed after
+    each line, compressed files every flush_lines lines or after
+    flush_interval seconds. Only the files written by this writer
+    are flushed and closed.
+    """
+
+    def __init__(self, files: NightlyFiles, flush_lines=32, flush_interval=600.0):
+        self.files = files
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        # Files written, and files with pending lines
+        self._paths = set()
+        self._dirty = set()
+        self._pending = 0
+        self._deadline = None
+
+    def write(self, path, line):
+        self.files.write_line(path, line)
+        self._paths.add(path)
+        if compression_from_filename(str(path)) is None:
+            self.files.flush([path])
+            return
+        self._dirty.add(path)
+        if self._pending == 0:
+            self._deadline = time.monotonic() + self.flush_interval
+        self._pending += 1
+
+        if self._pending >= self.flush_lines or self.timeout() == 0:
+            self.flush()
+
+    def timeout(self):
+        """Seconds until the pending lines must be flushed, None if there are none"""
+        if not self._pending:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+    def flush(self):
+        if self._dirty:
+            self.files.flush(self._dirty)
+        self._dirty = set()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self.files.close(self._paths)
+        self._paths = set()
+
+
+def journal_filename(name):
+    return "{}.journal".format(name)
+
+
+def _last_tstamp(path):
+    """Time stamp (string) of the last line of a IDA file.
+
+    A incomplete last line of a plain file is removed
+    """
+    compression = compression_from_filename(str(path))
+    if compression is None:
+        with open(path, "rb+") as fd:
+            data = fd.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                _logger.warning("removing incomplete line at the end of %s", path)
+                fd.truncate(end)
+        lines = data[:end].decode("utf-8").splitlines()
+    else:
+        lines = []
+        try:
+            with open_ida(path, "r", compression) as fd:
+                for line in fd:
+                    lines.append(line)
+        except (EOFError, lzma.LZMAError, OSError):
+            _logger.warning("%s is truncated", path)
+    for line in reversed(lines):
+        if line.strip() and not line.startswith("#"):
+            return line.split(";", 1)[0]
+    return ""
+
+
+class JournalWriter:
+    """Write IDA lines through a write-ahead journal
+
+    The lines are appended to the journal, and the journal is synced
+    to disk (fsync) in groups, when group_lines lines are pending or
+    the oldest pending line is group_interval seconds old. After each
+    sync, the lines are written to the IDA files with writer.
+
+    When the journal is larger than max_bytes, the IDA files are
+    synced and the journal is emptied. recover writes the lines in
+    the journal missing from the IDA files, after a crash.
+
+    Each entry of the journal is a line with a CRC32, the name
+    of the IDA file and the IDA line, separated by tabs.
+    """
+
+    def __init__(
+        self,
+        path,
+        writer: IDAWriter = None,
+        group_lines=16,
+        group_interval=30.0,
+        max_bytes=65536,
+    ):
+        self.path = path
+        self.writer = IDAWriter() if writer is None else writer
+        self.group_lines = group_lines
+        self.group_interval = group_interval
+        self.max_bytes = max_bytes
+        self._fd = None
+        self._pending = []
+        self._first = None
+        # IDA files written since the journal was emptied
+        self._dirty = set()
+
+    @staticmethod
+    def _entry(filename, line):
+        body = "{}\t{}".format(filename, line)
+        crc = zlib.crc32(body.encode("utf-8"))
+        return "{:08x}\t{}\n".format(crc, body)
+
+    @staticmethod
+    def _parse(entry):
+        """Return (filename, line) of an entry, None if damaged"""
+        if not entry.endswith("\n"):
+            return None
+        crc, sep, body = entry[:-1].partition("\t")
+        if not sep:
+            return None
+        try:
+            if int(crc, 16) != zlib.crc32(body.encode("utf-8")):
+                return None
+        except ValueError:
+            return None
+        filename, _, line = body.partition("\t")
+        return filename, line
+
+    def _open(self):
+        if self._fd is None:
+            self._fd = open(self.path, "a", encoding="utf-8")
+
+    def recover(self):
+        """Write the lines of the journal missing in the IDA files"""
+        if not os.path.exists(self.path):
+            return 0
+        last = {}
+        nlines = 0
+        with open(self.path, encoding="utf-8") as fd:
+            for entry in fd:
+                parsed = self._parse(entry)
+                if parsed is None:
+                    # A torn write, the following entries are not reliable
+                    _logger.warning("damaged entry in journal %s", self.path)
+                    break
+                filename, line = parsed
+                if not os.path.exists(filename):
+                    _logger.warning("IDA file %s does not exist", filename)
+                    continue
+                if filename not in last:
+                    last[filename] = _last_tstamp(filename)
+                tstamp = line.split(";", 1)[0]
+                if tstamp > last[filename]:
+                    self.writer.write(filename, line)
+                    last[filename] = tstamp
+                    self._dirty.add(filename)
+                    nlines += 1
+        if nlines:
+            _logger.info("recovered %d lines from journal %s", nlines, self.path)
+        self.checkpoint()
+        return nlines
+
+    def write(self, path, line):
+        self._open()
+        self._fd.write(self._entry(path, line))
+        self._pending.append((path, line))
+        if self._first is None:
+            self._first = time.monotonic()
+        if len(self._pending) >= self.group_lines:
+            self.commit()
+
+    def timeout(self):
+        """Seconds until the pending lines must be committed, or None"""
+        if self._first is None:
+            return None
+        return max(0.0, self._first + self.group_interval - time.monotonic())
+
+    def commit(self):
+        """Sync the journal and write the pending lines to the IDA files"""
+        if not self._pending:
+            return
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        for path, line in self._pending:
+            self.writer.write(path, line)
+            self._dirty.add(path)
+        self._pending = []
+        self._first = None
+        if self._fd.tell() >= self.max_bytes:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Sync the IDA files and empty the journal"""
+        self.writer.flush()
+        for path in self._dirty:
+            with open(path, "ab") as fd:
+                os.fsync(fd.fileno())
+        self._dirty = set()
+        self._open()
+        self._fd.truncate(0)
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+
+    def flush(self):
+        self.commit()
+
+    def close(self):
+        self.commit()
+        if self._fd is not None:
+            self.checkpoint()
+            self._fd.close()
+            self._fd = None
+        self.writer.close()
+
+
+def format_line(payload):
+    """Format payload as a line of a IDA file"""
+    payload_iso(payload)
+    if "tstamp_local_str" not in payload:
+        local_ns = payload.get("tstamp_local_ns")
+        if local_ns is None:
+            local_ns = datetime_to_ns(payload["tstamp_local"].replace(tzinfo=None))
+        payload["tstamp_local_str"] = format_ns(local_ns)
     line_tpl = (
         "{tstamp_str};{tstamp_local_str};{temp_ambient:.2f};"
         "{temp_sky:.2f};{freq_sensor};{magnitude:.2f};{zero_point}"
     )
-    with open(os.path.join(dirname, filename), "a") as fd:
-        if payload["cmd"] == "r":
-            if "temp_ambient" not in payload:
-                payload["temp_ambient"] = 0.0
-            if "temp_sky" not in payload:
-                payload["temp_sky"] = 0.0
-            msg = line_tpl.format(**payload)
-            print(msg, file=fd)
+    if "temp_ambient" not in payload:
+        payload["temp_ambient"] = 0.0
+    if "temp_sky" not in payload:
+        payload["temp_sky"] = 0.0
+    return line_tpl.format(**payload)
+
+
+def write_to_file(payload, dirname, filename, writer=None):
+    """Write payload to file"""
+    if payload["cmd"] == "r":
+        msg = format_line(payload)
+        if writer is None:
+            writer = IDAWriter()
+            writer.write(os.path.join(dirname, filename), msg)
+            writer.close()
+        else:
+            writer.write(os.path.join(dirname, filename), msg)
     return 0